@@ -2,6 +2,9 @@ from pathlib import Path
 from dataclasses import dataclass
 import os
 import shutil
+from typing import Tuple
+from typing import List
+from typing import Iterator
 
 class NotAFileError(OSError):
     def __init__(self, msg=None):
@@ -68,12 +71,32 @@ class Archive(object):
     def create_archive(root_path: str): # TODO: declar type of return value ('Archive' gives undefined error)
         raise NotImplementedError()
 
-    def __init__(self, root_path: str, user_root_path: str=None):
+    def __init__(self, root_path: str, user_root_path: str=None, *, read_only: bool=False):
         raise NotImplementedError()
     
-    def list(self, path, recursive = False) -> dict:
+    def list(self, path, recursive = False, *, snapshot: bool=False) -> dict:
         raise NotImplementedError()
     
+    def list_entries(self, path, *, max_depth: int=None, snapshot: bool=False) -> Iterator[Tuple[int,bool,str,bool]]:
+        """(depth, is_dir, name, last) of the content of path in depth first order, see list for the order of siblings
+
+        last tells if an entry is the last one of its directory, the content of path has depth 1.
+        This implementation builds the nested content with list first.
+        """
+        def entries(content, depth):
+            if max_depth is not None and depth > max_depth:
+                return
+            n = len(content['dirs']) + len(content['files'])
+            for (i,(child,child_content)) in enumerate(content['dirs']):
+                yield (depth, True, child.name, i + 1 == n)
+                yield from entries(child_content, depth + 1)
+            for (i,child) in enumerate(content['files']):
+                yield (depth, False, child.name, len(content['dirs']) + i + 1 == n)
+        return entries(self.list(path, recursive=max_depth != 1, snapshot=snapshot), 1)
+
+    def list_records(self, path, *, max_depth: int=None) -> Iterator[Tuple[str,bool,int,int,str,bytes]]:
+        raise NotImplementedError()
+
     def add_file(self, src: str, dst:str) -> None:
         raise NotImplementedError()
         
@@ -95,16 +118,31 @@ class Archive(object):
     def commit(self) -> None:
         raise NotImplementedError()
 
+    def rollback(self) -> None:
+        raise NotImplementedError()
+
+    def savepoint(self):
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        raise NotImplementedError()
+
     def export_file(self, src:str, dst:str) -> None:
         raise NotImplementedError()
 
-    def export_dir(self, src: str, dst:str) -> None:
+    def export_dir(self, src: str, dst:str, *, jobs: int=1, snapshot: bool=False) -> None:
         raise NotImplementedError()
  
-    def dedup(self, src: str, hardlink=False) -> None:
+    def dedup(self, src: str, hardlink=False, *, confirm=False) -> None:
+        raise NotImplementedError()
+
+    def check(self, quick=False, *, jobs: int=1, snapshot: bool=False) -> None:
+        raise NotImplementedError()
+
+    def du(self, path) -> Tuple[int,int]:
         raise NotImplementedError()
 
-    def check(self) -> None:
+    def hardlinks(self, path) -> List[Path]:
         raise NotImplementedError()
     
 @dataclass(order=True)
@@ -1,11 +1,17 @@
 import argparse
+import json
 import logging
 import os
+import signal
+import sys
 from pathlib import Path, PurePath
-import io
+from typing import Iterator
 #from archman.dummyarchive import DummyArchive as ArchiveImpl
 from archman.sqlarchive import SqlArchive as ArchiveImpl
-from archman import NotAFileError
+from archman.sqlarchive import params
+from archman.sqlarchive.digest import ALGORITHMS
+from archman import NotAFileError, NotWithinArchiveError
+from archman.server import ArchiveServer, ArchiveClient
            
 def check_recursive(*, path:str, recursive:bool):
     isdir = os.path.isdir(path)
@@ -37,16 +43,20 @@ def check_file(*, path:str, may_not_exist=False):
     if isdir:
         raise NotAFileError(path)
 
-def path_to_archive(path):
+def check_within(*, path:str, root:Path):
+    if ArchiveImpl.get_archive_root(path) != root:
+        raise NotWithinArchiveError("'%s' is not within archive '%s'"%(path,root))
+
+def path_to_archive(path, *, read_only:bool=False):
     root = ArchiveImpl.get_archive_root(path)
-    return ArchiveImpl(root)
+    return ArchiveImpl(root, read_only=read_only)
 
 def cmd_args_new(args):
-    cmd_new(dst=args.dst)
+    cmd_new(dst=args.dst,algorithm=args.algorithm)
 
-def cmd_new(*, dst:str) -> None:
+def cmd_new(*, dst:str, algorithm:str=params.DEFAULT_ALGORITHM) -> None:
     check_dir(path=dst,expected_to_exist=False)
-    ArchiveImpl.create_archive(dst)
+    ArchiveImpl.create_archive(dst,algorithm=algorithm).close()
 
 def cmd_args_mkdir(args):
     cmd_mkdir(dst=args.dst)
@@ -54,20 +64,26 @@ def cmd_args_mkdir(args):
 def cmd_mkdir(*, dst:str) -> None:
     check_dir(path=dst,expected_to_exist=False)
     archive = path_to_archive(dst)
-    print('create new directory',os.path.abspath(dst), 'in archive', archive)
-    raise NotImplementedError()
+    try:
+        print('create new directory',os.path.abspath(dst), 'in archive', archive)
+        raise NotImplementedError()
+    finally:
+        archive.close()
 
 def cmd_args_add(args):
-    cmd_add(src=args.src,dst=args.dst,recursive=args.recursive)
+    run_cmd(args, cmd_add, src=args.src,dst=args.dst,recursive=args.recursive,jobs=args.jobs,processes=args.processes,verify=args.verify,dedup=args.dedup)
 
-def cmd_add(*,src:str, dst:str, recursive:bool=False) -> None:
+def cmd_add(*,src:str, dst:str, recursive:bool=False, jobs:int=1, processes:bool=False, verify:bool=False, dedup:bool=False) -> None:
     check_recursive(path=src,recursive=recursive)
     archive = path_to_archive(dst)
-    if recursive:
-        archive.add_dir(src=src, dst=dst)
-    else:
-        archive.add_file(src=src, dst=dst)
-    archive.commit()
+    try:
+        if recursive:
+            archive.add_dir(src=src, dst=dst, jobs=jobs, processes=processes, verify=verify, dedup=dedup)
+        else:
+            archive.add_file(src=src, dst=dst, verify=verify, dedup=dedup)
+        archive.commit()
+    finally:
+        archive.close()
 
 def cmd_args_delete(args):
     cmd_delete(dst=args.dst, recursive=args.recursive)
@@ -75,11 +91,14 @@ def cmd_args_delete(args):
 def cmd_delete(dst:str, recursive:bool=False):
     check_recursive(path=dst,recursive=recursive)
     archive = path_to_archive(dst)
-    if recursive:
-        archive.delete_dir(dst)
-    else:
-        archive.delete_file(dst)
-    archive.commit()
+    try:
+        if recursive:
+            archive.delete_dir(dst)
+        else:
+            archive.delete_file(dst)
+        archive.commit()
+    finally:
+        archive.close()
 
 def cmd_args_move(args):
     cmd_move(src=args.src,dst=args.dst)
@@ -87,109 +106,387 @@ def cmd_args_move(args):
 def cmd_move(*,src:str, dst:str, recursive:bool=False):
     check_recursive(path=src,recursive=recursive)
     archive = path_to_archive(src)
-    if recursive:
-        archive.move_dir(src=src,dst=dst)
-    else:
-        archive.move_file(src=src,dst=dst)
-    archive.commit()
+    try:
+        if recursive:
+            archive.move_dir(src=src,dst=dst)
+        else:
+            archive.move_file(src=src,dst=dst)
+        archive.commit()
+    finally:
+        archive.close()
 
 def cmd_args_export(args):
-    cmd_export(src=args.src,dst=args.dst, recursive=args.recursive)
+    run_cmd(args, cmd_export, src=args.src,dst=args.dst, recursive=args.recursive, jobs=args.jobs, snapshot=args.snapshot)
 
-def cmd_export(*,src:str, dst:str, recursive:bool=False):
+def cmd_export(*,src:str, dst:str, recursive:bool=False, jobs:int=1, snapshot:bool=False):
     check_recursive(path=src,recursive=recursive)
-    archive = path_to_archive(src)
-    if recursive:
-        archive.export_dir(src=src, dst=dst)
-    else:
-        archive.export_file(src=src, dst=dst)
+    archive = path_to_archive(src, read_only=True)
+    try:
+        if recursive:
+            archive.export_dir(src=src, dst=dst, jobs=jobs, snapshot=snapshot)
+        else:
+            archive.export_file(src=src, dst=dst)
+    finally:
+        archive.close()
 
 def cmd_args_update(args):
-    cmd_update(src=args.src,dst=args.dst)
+    cmd_update(src=args.src,dst=args.dst,verify=args.verify)
 
-def cmd_update(*, src, dst):
+def cmd_update(*, src, dst, verify:bool=False):
     check_file(path=src)
     archive = path_to_archive(dst)
-    archive.update_file(src=src, dst=dst)
-    archive.commit()
+    try:
+        archive.update_file(src=src, dst=dst, verify=verify)
+        archive.commit()
+    finally:
+        archive.close()
+
+def cmd_args_apply(args):
+    cmd_apply(src=args.src,manifest=args.manifest,jobs=args.jobs,processes=args.processes)
+
+# operations of a manifest: their paths and their optional flags
+APPLY_OPERATIONS = {
+    'add': (('src','dst'), ('recursive','verify','dedup')),
+    'delete': (('dst',), ('recursive',)),
+    'move': (('src','dst'), ('recursive',)),
+    'update': (('src','dst'), ('verify',)),
+}
+# paths of the operations which are within the archive, the others are outside of it
+APPLY_ARCHIVE_PATHS = {'add': ('dst',), 'delete': ('dst',), 'move': ('src','dst'), 'update': ('dst',)}
+
+def read_manifest(lines) -> list:
+    """(line number, operation) of the JSON objects of lines, all checked before any of them is applied
+
+    An operation looks like {"op": "add", "src": "a", "dst": "archive/a", "recursive": true}, see APPLY_OPERATIONS.
+    """
+    operations = []
+    for (n,line) in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            op = json.loads(line)
+        except ValueError as e:
+            raise ValueError("manifest line %d: %s"%(n,e))
+        if not isinstance(op, dict) or op.get('op') not in APPLY_OPERATIONS:
+            raise ValueError("manifest line %d: 'op' must be one of %s"%(n,', '.join(APPLY_OPERATIONS)))
+        (paths,flags) = APPLY_OPERATIONS[op['op']]
+        for k in paths:
+            if not isinstance(op.get(k), str):
+                raise ValueError("manifest line %d: '%s' needs a '%s' path"%(n,op['op'],k))
+        for k in op:
+            if k != 'op' and k not in paths and k not in flags:
+                raise ValueError("manifest line %d: unknown key '%s' for '%s'"%(n,k,op['op']))
+            if k in flags and not isinstance(op[k], bool):
+                raise ValueError("manifest line %d: '%s' must be true or false"%(n,k))
+        operations.append((n,op))
+    return operations
+
+def check_operation(root:Path, op:dict):
+    """checks of a manifest operation which do not depend on the operations applied before it"""
+    for k in APPLY_ARCHIVE_PATHS[op['op']]:
+        check_within(path=op[k], root=root)
+    if op['op'] == 'add':
+        if not os.path.lexists(op['src']):
+            raise FileNotFoundError(op['src'])
+        check_recursive(path=op['src'],recursive=op.get('recursive', False))
+    elif op['op'] == 'update':
+        check_file(path=op['src'])
+
+def apply_operation(archive:ArchiveImpl, root:Path, op:dict, *, jobs:int=1, processes:bool=False):
+    """run a manifest operation on archive, whose root is root, without committing it"""
+    check_operation(root, op)
+    recursive = op.get('recursive', False)
+    if op['op'] == 'add':
+        if recursive:
+            archive.add_dir(src=op['src'], dst=op['dst'], jobs=jobs, processes=processes, verify=op.get('verify', False), dedup=op.get('dedup', False))
+        else:
+            archive.add_file(src=op['src'], dst=op['dst'], verify=op.get('verify', False), dedup=op.get('dedup', False))
+    elif op['op'] == 'delete':
+        check_recursive(path=op['dst'],recursive=recursive)
+        if recursive:
+            archive.delete_dir(op['dst'])
+        else:
+            archive.delete_file(op['dst'])
+    elif op['op'] == 'move':
+        check_recursive(path=op['src'],recursive=recursive)
+        if recursive:
+            archive.move_dir(src=op['src'],dst=op['dst'])
+        else:
+            archive.move_file(src=op['src'],dst=op['dst'])
+    elif op['op'] == 'update':
+        archive.update_file(src=op['src'], dst=op['dst'], verify=op.get('verify', False))
+
+def cmd_apply(*, src:str, manifest:str='-', jobs:int=1, processes:bool=False) -> int:
+    """apply the operations of manifest, a file or '-' for stdin, to the archive of src and return their number
+
+    The archive is opened once and committed once, so the check file is written once for the whole manifest.
+    All operations are checked before any of them is applied, as far as the operations before them do not matter:
+    their paths are within the archive and the sources of add and update exist.
+    Operations then run in order and stop at the first one failing: its changes to the index are discarded
+    and the operations before it are committed, so that the index matches the files they changed.
+    As with the add command, the files copied by the failed operation stay within the archive.
+    """
+    if manifest == '-':
+        operations = read_manifest(sys.stdin)
+    else:
+        with open(manifest, encoding='utf-8') as f:
+            operations = read_manifest(f)
+    root = ArchiveImpl.get_archive_root(src)
+    for (n,op) in operations:
+        try:
+            check_operation(root, op)
+        except Exception:
+            logging.error("manifest line %d is rejected, no operation is applied"%n)
+            raise
+    archive = ArchiveImpl(root)
+    applied = 0
+    try:
+        for (n,op) in operations:
+            try:
+                with archive.savepoint():
+                    apply_operation(archive, root, op, jobs=jobs, processes=processes)
+            except Exception:
+                logging.error("manifest line %d failed, the %d operations before it are committed"%(n,applied))
+                try:
+                    archive.commit()
+                except Exception:
+                    logging.exception("cannot commit the operations before manifest line %d"%n)
+                raise
+            applied += 1
+        archive.commit()
+    finally:
+        archive.close()
+    logging.info("%d operations applied to archive %s"%(applied,root))
+    return applied
 
 def cmd_args_list(args):
-    cmd_list(src=args.src,recursive=args.recursive)
+    def cmd_print_list(**kwargs):
+        for line in cmd_list_lines(**kwargs):
+            sys.stdout.write(line)
+    try:
+        run_cmd(args, cmd_print_list, src=args.src,recursive=args.recursive,hardlinks=args.hardlinks,snapshot=args.snapshot,max_depth=args.max_depth,fmt=args.format)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # the reading end of a pipe stopped early, as head does: no error on the final flush at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
 
-def cmd_list_core(*, archive:ArchiveImpl, path:Path, content:dict, parents_last=[]) -> str:
-    out = io.StringIO()
-    depth = len(parents_last)
+def render_tree(entries) -> Iterator[str]:
+    """lines of the tree drawing of entries, (depth, is_dir, name, last) in depth first order"""
     extend = '│ '
     extend_last = '  '
-    def p(*args, **kwargs):
-        header = ""
-        for i in range(0,depth):
-            if parents_last[i]:
-                header += extend_last
-            else:
-                header += extend
-        line = header + ' '.join(args)
-        print(line,**kwargs,file=out)
-    nfiles = len(content['files'])
-    for i in range(0,len(content['dirs'])):
-        (child,child_content) = content['dirs'][i]
-        if 0 < nfiles:
-            last = False
+    # header of each depth, built from whether the ancestors are the last ones of their directory
+    headers = ['']
+    for (depth,is_dir,name,last) in entries:
+        del headers[depth:]
+        mark = '└─' if last else '├─'
+        if is_dir:
+            yield headers[-1] + mark + name + '/\n'
+            headers.append(headers[-1] + (extend_last if last else extend))
         else:
-            last = i + 1 == len(content['dirs'])
-        mark = '├─'
-        if last:
-            mark = '└─'
-        p(mark+child.name+'/')
-        child_last = parents_last + [last]
-        child_str = cmd_list_core(
-            archive=archive, 
-            path=path.joinpath(child.name), 
-            content=child_content,
-            parents_last = child_last)
-        print(child_str,end='',file=out)
-    for i in range(0,nfiles):
-        child = content['files'][i]
-        last = i + 1 == nfiles
-        mark = '├─'
-        if last:
-            mark = '└─'
-        p(mark+child.name)
-    return out.getvalue()
-    
-def cmd_list(*, src:str, recursive:bool=False, hardlinks:bool=False) -> str:
+            yield headers[-1] + mark + name + '\n'
+
+# formats of the list command besides the tree, one record per entry: type, mode, size, digest and path
+LIST_FORMATS = ('tree', 'jsonl', 'tsv', 'nul')
+
+def format_records(records, fmt:str) -> Iterator[str]:
+    """lines of records, (path, is_dir, mode, size, algorithm, digest), in format fmt
+
+    jsonl: one JSON object per line
+    tsv: tab separated fields, backslash, tab and newline escaped as \\\\, \\t and \\n in paths
+    nul: tab separated fields ended by a NUL, the path is the last field and is not escaped
+    Modes are the octal permissions, a digest is prefixed by its algorithm.
+    """
+    for (path,is_dir,mode,size,algorithm,digest) in records:
+        kind = 'dir' if is_dir else 'file'
+        mode = '%d'%mode
+        if digest is not None:
+            digest = algorithm + ':' + digest.hex()
+        if fmt == 'jsonl':
+            yield json.dumps({'path':path,'type':kind,'mode':mode,'size':size,'digest':digest}) + '\n'
+            continue
+        fields = [kind, mode, '' if size is None else str(size), digest or '']
+        if fmt == 'tsv':
+            yield '\t'.join(fields + [path.replace('\\','\\\\').replace('\t','\\t').replace('\n','\\n')]) + '\n'
+        elif fmt == 'nul':
+            yield '\t'.join(fields + [path]) + '\0'
+        else:
+            raise ValueError("unknown list format '%s'"%fmt)
+
+def cmd_list_lines(*, src:str, recursive:bool=False, hardlinks:bool=False, snapshot:bool=False, max_depth:int=None, fmt:str='tree') -> Iterator[str]:
+    """lines of the output of the list command, streamed from the archive
+
+    Formats other than 'tree' output records of the content of src without any header, see format_records.
+    """
     root = ArchiveImpl.get_archive_root(src)
     assert root.is_absolute()
-    archive = ArchiveImpl(str(root))
+    archive = ArchiveImpl(str(root), read_only=True)
+    try:
+        yield from list_lines(archive, root, src=src, recursive=recursive, hardlinks=hardlinks, snapshot=snapshot, max_depth=max_depth, fmt=fmt)
+    finally:
+        archive.close()
+
+def list_lines(archive:ArchiveImpl, root:Path, *, src:str, recursive:bool=False, hardlinks:bool=False, snapshot:bool=False, max_depth:int=None, fmt:str='tree') -> Iterator[str]:
+    check_within(path=src, root=root)
+    if fmt != 'tree':
+        if hardlinks or snapshot:
+            raise ValueError("--hardlinks and --snapshot only apply to the tree format")
+        if not os.path.isdir(src):
+            raise NotADirectoryError(src)
+        if not recursive:
+            max_depth = 1
+        yield from format_records(archive.list_records(Path(src).resolve(), max_depth=max_depth), fmt)
+        return
+    yield "archive '"+str(root)+"':\n"
     if hardlinks:
-        raise NotImplementedError()
+        for path in archive.hardlinks(src):
+            yield str(path.relative_to(root.parent))+'\n'
+        return
     if not os.path.isdir(src):
         raise NotADirectoryError(src)
-    out = io.StringIO()
     path = Path(src).resolve()
-    print("archive '"+str(root)+"':",file=out)
-    res = archive.list(path, recursive=recursive)
     rel_path = path.relative_to(root.parent)
     mark=''
     if archive.is_dir(rel_path):
         mark='/'
-    print(str(rel_path.parts[-1])+mark, file=out)
-    return out.getvalue()+cmd_list_core(archive=archive,path=rel_path,content=res)
+    yield str(rel_path.parts[-1])+mark+'\n'
+    if not recursive:
+        max_depth = 1
+    yield from render_tree(archive.list_entries(path, max_depth=max_depth, snapshot=snapshot))
+    
+def cmd_list(*, src:str, recursive:bool=False, hardlinks:bool=False, snapshot:bool=False, max_depth:int=None, fmt:str='tree') -> str:
+    return ''.join(cmd_list_lines(src=src,recursive=recursive,hardlinks=hardlinks,snapshot=snapshot,max_depth=max_depth,fmt=fmt))
     
 def cmd_args_dedup(args):
-    cmd_dedup(src=args.src,hardlink=args.hardlink)
+    cmd_dedup(src=args.src,hardlink=args.hardlink,confirm=args.confirm)
 
-def cmd_dedup(*, src:str, hardlink=False):
+def cmd_dedup(*, src:str, hardlink=False, confirm=False):
     archive = path_to_archive(src)
-    archive.dedup(src,hardlink)
-    archive.commit()
+    try:
+        archive.dedup(src,hardlink,confirm=confirm)
+        archive.commit()
+    finally:
+        archive.close()
 
 def cmd_args_check(args):
-    cmd_check(src=args.src)
+    run_cmd(args, cmd_check, src=args.src,quick=args.quick,jobs=args.jobs,snapshot=args.snapshot)
 
-def cmd_check(*, src:str):
+def cmd_check(*, src:str, quick:bool=False, jobs:int=1, snapshot:bool=False):
+    archive = path_to_archive(src, read_only=True)
+    try:
+        archive.check(quick=quick, jobs=jobs, snapshot=snapshot)
+    finally:
+        archive.close()
+
+def cmd_args_redigest(args):
+    cmd_redigest(src=args.src,algorithm=args.algorithm,jobs=args.jobs)
+
+def cmd_redigest(*, src:str, algorithm:str, jobs:int=1):
     archive = path_to_archive(src)
-    archive.check()
+    try:
+        archive.redigest(algorithm,jobs=jobs)
+        archive.commit()
+    finally:
+        archive.close()
+
+def cmd_args_repair(args):
+    cmd_repair(dst=args.dst,sources=args.sources,recursive=args.recursive)
+
+def cmd_repair(*, dst:str, sources:list, recursive:bool=False):
+    check_recursive(path=dst,recursive=recursive)
+    archive = path_to_archive(dst)
+    try:
+        if recursive:
+            archive.repair_dir(dst,sources)
+        else:
+            archive.repair_file(dst,sources)
+        archive.commit()
+    finally:
+        archive.close()
+
+def cmd_args_repair_index(args):
+    cmd_repair_index(src=args.src)
+
+def cmd_repair_index(*, src:str) -> list:
+    root = ArchiveImpl.get_archive_root(src)
+    pages = ArchiveImpl.repair_index(root)
+    print('%d damaged pages repaired in the index of archive %s'%(len(pages),root))
+    return pages
+
+def cmd_args_du(args):
+    cmd_du(src=args.src)
+
+def cmd_du(*, src:str) -> tuple:
+    archive = path_to_archive(src, read_only=True)
+    try:
+        (size,count) = archive.du(src)
+    finally:
+        archive.close()
+    print('%d\t%d\t%s'%(size,count,src))
+    return (size,count)
+
+def run_cmd(args, cmd, **kwargs):
+    """cmd(**kwargs), or the same command run by the server listening on args.socket if it is set"""
+    if args.socket is None:
+        return cmd(**kwargs)
+    # the server does not run in the current directory
+    for k in ['src','dst']:
+        if k in kwargs:
+            kwargs[k] = os.path.abspath(kwargs[k])
+    client = ArchiveClient(args.socket)
+    try:
+        return client.call(args.command, **kwargs)
+    finally:
+        client.close()
+
+def serve_list(archive:ArchiveImpl, root:Path, out, **kwargs):
+    for line in list_lines(archive, root, **kwargs):
+        out(line)
+
+def serve_add(archive:ArchiveImpl, root:Path, out, *, src:str, dst:str, recursive:bool=False, jobs:int=1, processes:bool=False, verify:bool=False, dedup:bool=False):
+    try:
+        apply_operation(archive, root, {'op': 'add', 'src': src, 'dst': dst, 'recursive': recursive, 'verify': verify, 'dedup': dedup}, jobs=jobs, processes=processes)
+    except Exception:
+        # the archive stays open: the next request must not commit this one
+        archive.rollback()
+        raise
+    archive.commit()
+
+def serve_export(archive:ArchiveImpl, root:Path, out, *, src:str, dst:str, recursive:bool=False, jobs:int=1, snapshot:bool=False):
+    check_recursive(path=src,recursive=recursive)
+    check_within(path=src, root=root)
+    if recursive:
+        archive.export_dir(src=src, dst=dst, jobs=jobs, snapshot=snapshot)
+    else:
+        archive.export_file(src=src, dst=dst)
+
+def serve_check(archive:ArchiveImpl, root:Path, out, *, src:str, quick:bool=False, jobs:int=1, snapshot:bool=False):
+    check_within(path=src, root=root)
+    archive.check(quick=quick, jobs=jobs, snapshot=snapshot)
+
+# commands answered by the server, with the keyword arguments of the cmd_ functions
+SERVER_COMMANDS = {'list': serve_list, 'add': serve_add, 'export': serve_export, 'check': serve_check}
+
+def cmd_args_serve(args):
+    cmd_serve(src=args.src,socket_path=args.socket)
+
+def archive_server(*, src:str, socket_path:str) -> ArchiveServer:
+    """server of the archive of src on the unix socket socket_path, see ArchiveServer"""
+    root = ArchiveImpl.get_archive_root(src)
+    return ArchiveServer(socket_path, root, ArchiveImpl, SERVER_COMMANDS)
+
+def cmd_serve(*, src:str, socket_path:str):
+    """keep the archive of src open and answer the list, add, export and check commands sent to socket_path, until interrupted"""
+    server = archive_server(src=src, socket_path=socket_path)
+    logging.info("serving archive %s on %s"%(server.root,socket_path))
+    # stopped by kill as by Ctrl-C, the archive is closed and the socket removed either way
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 def get_archive_impl_dirs():
     return ArchiveImpl.get_impl_dirs()
@@ -222,16 +519,33 @@ if __name__ == '__main__':
     parser_dedup.set_defaults(func=cmd_args_dedup)
     parser_check = subparsers.add_parser('check', help='Sanity check')
     parser_check.set_defaults(func=cmd_args_check)
+    parser_redigest = subparsers.add_parser('redigest', help='Switch the archive to another digest algorithm')
+    parser_redigest.set_defaults(func=cmd_args_redigest)
+    parser_repair = subparsers.add_parser('repair', help='Repair damaged files using other copies of the archive')
+    parser_repair.set_defaults(func=cmd_args_repair)
+    parser_repair_index = subparsers.add_parser('repair-index', help='Repair the index database using the parity of its check file')
+    parser_repair_index.set_defaults(func=cmd_args_repair_index)
+    parser_du = subparsers.add_parser('du', help='Output the size and the number of files of a file or a directory')
+    parser_du.set_defaults(func=cmd_args_du)
+    parser_apply = subparsers.add_parser('apply', help='Apply a manifest of add, delete, move and update operations with a single commit')
+    parser_apply.set_defaults(func=cmd_args_apply)
+    parser_serve = subparsers.add_parser('serve', help='Keep an archive open and answer the commands sent to a unix socket')
+    parser_serve.set_defaults(func=cmd_args_serve)
     
     # add common options
     for p in subparsers.choices.values():
-        if p not in [parser_new, parser_list]:
+        if p not in [parser_new, parser_list, parser_redigest, parser_repair_index, parser_du, parser_apply, parser_serve]:
             p.add_argument('--recursive', help='Needed when the operation is on a directory', action='store_true')
         elif p in [parser_list]:
             p.add_argument('--recursive', help='Recurse in sub directories', action='store_true')
+    for (name,p) in subparsers.choices.items():
+        if name in SERVER_COMMANDS:
+            p.add_argument('--socket', help='Send the command to the server listening on this unix socket, see serve', type=str, default=None)
+        p.set_defaults(command=name)
         
     # new command
     parser_new.add_argument('dst', help='Destination path', type=str)
+    parser_new.add_argument('--algorithm', help='Digest algorithm of the files', choices=list(ALGORITHMS), default=params.DEFAULT_ALGORITHM)
     
     # mkdir command
     parser_mkdir.add_argument('dst', help='Destination path', type=str)
@@ -239,6 +553,10 @@ if __name__ == '__main__':
     # add command
     parser_add.add_argument('src', help='Source path', type=str)
     parser_add.add_argument('dst', help='Destination path', type=str)
+    parser_add.add_argument('--jobs', help='Number of files hashed concurrently', type=int, default=1)
+    parser_add.add_argument('--processes', help='Hash with worker processes instead of threads', action='store_true')
+    parser_add.add_argument('--verify', help='Read back the files written in the archive to check them', action='store_true')
+    parser_add.add_argument('--dedup', help='Hardlink the files whose content is already in the archive instead of copying them', action='store_true')
     
     # delete command
     parser_delete.add_argument('dst', help='Target path', type=str)
@@ -250,23 +568,58 @@ if __name__ == '__main__':
     # export command
     parser_export.add_argument('src', help='Source path', type=str)
     parser_export.add_argument('dst', help='Destination path', type=str)
+    parser_export.add_argument('--jobs', help='Number of exported files checked concurrently', type=int, default=1)
+    parser_export.add_argument('--snapshot', help='Load the whole index in memory first, faster for large trees', action='store_true')
     
     # update command
     parser_update.add_argument('src', help='Source path', type=str)
     parser_update.add_argument('dst', help='Destination path', type=str)
+    parser_update.add_argument('--verify', help='Read back the file written in the archive to check it', action='store_true')
 
     # list command
     parser_list.add_argument('src', help='Source path', type=str)
-    #parser_list.add_argument('--hardlinks', help='list files hardlinked with src', action='store_true')
+    parser_list.add_argument('--hardlinks', help='list files hardlinked with src', action='store_true')
+    parser_list.add_argument('--snapshot', help='Load the whole index in memory first, faster for large trees', action='store_true')
+    parser_list.add_argument('--max-depth', help='With --recursive, levels of sub directories listed', type=int, default=None)
+    parser_list.add_argument('--format', help='Tree drawing, or one record per entry for other tools', choices=LIST_FORMATS, default='tree')
     
     # dedup command
     parser_dedup.add_argument('src', help='Source path', type=str)
     parser_dedup.add_argument('--hardlink', help='Turn all equivalent files to hard links', action='store_true')
     #parser_dedup.add_argument('--softlink', help='Turn all equivalent files to soft links', action='store_true')
     parser_dedup.add_argument('--remove', help='Delete all equivalent files', action='store_true')
+    parser_dedup.add_argument('--confirm', help='Compare the content of equivalent files before deduplicating them', action='store_true')
     
     # check command
     parser_check.add_argument('src', help='Source path', type=str)
+    parser_check.add_argument('--quick', help='Hash only the files whose size, times or inode changed', action='store_true')
+    parser_check.add_argument('--jobs', help='Number of files hashed concurrently', type=int, default=1)
+    parser_check.add_argument('--snapshot', help='Load the whole index in memory first, faster for large trees', action='store_true')
+    
+    # redigest command
+    parser_redigest.add_argument('src', help='Path within the archive', type=str)
+    parser_redigest.add_argument('--algorithm', help='New digest algorithm', choices=list(ALGORITHMS), required=True)
+    parser_redigest.add_argument('--jobs', help='Number of files hashed concurrently', type=int, default=1)
+    
+    # repair command
+    parser_repair.add_argument('dst', help='Target path', type=str)
+    parser_repair.add_argument('--from', help='Root of another copy of the archive, can be repeated', type=str, dest='sources', action='append', required=True)
+
+    # repair-index command
+    parser_repair_index.add_argument('src', help='Path within the archive', type=str)
+
+    # du command
+    parser_du.add_argument('src', help='Source path', type=str)
+
+    # apply command
+    parser_apply.add_argument('src', help='Path within the archive', type=str)
+    parser_apply.add_argument('manifest', help='JSON lines file of operations, - for stdin', type=str, nargs='?', default='-')
+    parser_apply.add_argument('--jobs', help='Number of files hashed concurrently by recursive adds', type=int, default=1)
+    parser_apply.add_argument('--processes', help='Hash with worker processes instead of threads', action='store_true')
+
+    # serve command
+    parser_serve.add_argument('src', help='Path within the archive', type=str)
+    parser_serve.add_argument('--socket', help='Path of the unix socket', type=str, required=True)
     
     args = parser.parse_args()
     logging.basicConfig(format='%(message)s', level=args.log_level)
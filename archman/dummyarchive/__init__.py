@@ -7,12 +7,14 @@ Limitations:
 """
 
 from pathlib import Path, PurePath
+from contextlib import nullcontext
 import os
 from archman.dummyarchive import params
 from archman import Archive,NotAFileError,FsUtils,BaseDir,BaseFile
 import logging
 import shutil
-import hashlib
+import filecmp
+from archman.duplicates import DuplicateFinder
 
 class DummyArchive(Archive):
     
@@ -43,7 +45,7 @@ class DummyArchive(Archive):
     def chmod(path, mode):
         Path(path).chmod(mode)
 
-    def __init__(self,root_path: str, user_root_path: str=None):
+    def __init__(self,root_path: str, user_root_path: str=None, *, read_only: bool=False):
         self.root_path = Path(root_path)
         assert self.root_path.exists()
         assert user_root_path is None
@@ -58,7 +60,7 @@ class DummyArchive(Archive):
         path = self.resolve_path(path)
         return path.is_dir
         
-    def list(self, path: Path, recursive = False) -> dict:
+    def list(self, path: Path, recursive = False, *, snapshot=False) -> dict:
         path = self.resolve_path(path)
         dirs = list()
         files = list()
@@ -166,6 +168,15 @@ class DummyArchive(Archive):
 
     def commit(self) -> None:
         pass
+
+    def rollback(self) -> None:
+        pass
+
+    def savepoint(self):
+        return nullcontext()
+
+    def close(self) -> None:
+        pass
     
     def export_file(self, src:str, dst:str) -> None:
         src_file = Path(src).name
@@ -185,7 +196,7 @@ class DummyArchive(Archive):
         
         shutil.copyfile(src=s,dst=d,follow_symlinks=False) 
 
-    def export_dir(self, src: str, dst:str) -> None:
+    def export_dir(self, src: str, dst:str, *, jobs: int=1, snapshot=False) -> None:
         src_file = Path(src).name
         s_parent = Path(src).parent.resolve()
         s = s_parent.joinpath(src_file)
@@ -202,36 +213,57 @@ class DummyArchive(Archive):
             raise FileNotFoundError(str(d_parent))
         shutil.copytree(src=s,dst=d,symlinks=True) # preserve symlinks
  
-    def dedup(self, src: str, hardlink=False) -> None:
+    def dedup(self, src: str, hardlink=False, *, confirm=False) -> None:
         src_dir = Path(src).resolve()
         if not src_dir.is_dir():
             raise NotADirectoryError(str(src_dir))
         logging.info("dedup %s"%src_dir)
-        index = {}
+        paths = []
         for path, dirs, files in os.walk(src_dir):
             for f in files:
                 file_path = os.path.join(path,f)
                 if os.path.islink(file_path):
                     print("soft link found: %s"%file_path)
                     continue
-                dat = open(file_path,'rb').read()
-                dig = hashlib.sha256(dat).digest()
-                if dig in index:
-                    org = index[dig]
-                    if not FsUtils.are_hardlinked(org,file_path):
-                        logging.info("duplicated files found: %s and %s"%(org,file_path))
-                        if org.endswith(".dup"):
-                            keep = file_path
-                            other = org
-                        else:
-                            keep = org 
-                            other = file_path
-                        index[dig] = keep                        
-                        os.remove(other)
-                        if hardlink:
-                            os.link(keep,other)
-                else:
-                    index[dig] = file_path
+                paths.append(file_path)
+        finder = DuplicateFinder()
+        for group in finder.groups(paths):
+            keep = next((p for p in group if not p.endswith(".dup")), group[0])
+            for other in group:
+                if other == keep or FsUtils.are_hardlinked(keep,other):
+                    continue
+                if confirm and not filecmp.cmp(keep,other,shallow=False):
+                    logging.warning("%s and %s have the same digest but different contents"%(keep,other))
+                    continue
+                logging.info("duplicated files found: %s and %s"%(keep,other))
+                os.remove(other)
+                if hardlink:
+                    os.link(keep,other)
+        logging.info("dedup stats: %s"%finder.stats)
     
-    def check(self):
-        pass
\ No newline at end of file
+    def check(self, quick=False, *, jobs=1, snapshot=False):
+        pass
+
+    def hardlinks(self, path):
+        p = Path(path).parent.resolve().joinpath(Path(path).name)
+        st = os.lstat(p)
+        out = []
+        for root, dirs, files in os.walk(self.root_path):
+            for f in files:
+                fp = Path(root).joinpath(f)
+                fst = os.lstat(fp)
+                if (fst.st_dev,fst.st_ino) == (st.st_dev,st.st_ino):
+                    out.append(fp)
+        return sorted(out)
+
+    def du(self, path):
+        p = Path(path).resolve()
+        if not p.is_dir() or p.is_symlink():
+            return (os.lstat(p).st_size, 1)
+        size = 0
+        count = 0
+        for root, dirs, files in os.walk(p):
+            for f in files:
+                size += os.lstat(os.path.join(root,f)).st_size
+                count += 1
+        return (size, count)
\ No newline at end of file
@@ -0,0 +1,94 @@
+"""Find files with the same content while reading as little of them as possible"""
+
+import os
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from archman.sqlarchive.digest import DigestEngine
+
+class DuplicateFinder(object):
+    """Group files by content in three stages, each one reading only the candidates left by the previous one
+
+    1. size: a file whose size is unique has no duplicate and is not read at all
+    2. partial digest of the first and last edge_size bytes
+    3. full digest
+
+    Files of at most 2 * edge_size bytes are fully read by stage 2 and skip stage 3.
+    Digests are computed by engine, with its algorithm and its block size, the files of a stage
+    are read by jobs workers, see DigestEngine.ordered_map.
+    stats counts the bytes each stage read and avoided reading.
+    """
+
+    def __init__(self, *, edge_size: int = 64 * 1024, engine: DigestEngine = None, jobs: int = 1, processes: bool = False):
+        self.edge_size = edge_size
+        self.engine = engine or DigestEngine()
+        self.jobs = jobs
+        self.processes = processes
+        self.stats = {
+            'files': 0,
+            'bytes': 0,
+            # bytes of the files with a unique size
+            'size_avoided': 0,
+            'partial_read': 0,
+            # bytes of the files told apart by their partial digest, minus what was read of them
+            'partial_avoided': 0,
+            'full_read': 0,
+        }
+
+    def _partial_digest(self, path, size: int) -> bytes:
+        h = self.engine.new()
+        with open(path, 'rb') as f:
+            if size <= 2 * self.edge_size:
+                h.update(f.read())
+            else:
+                h.update(f.read(self.edge_size))
+                f.seek(size - self.edge_size)
+                h.update(f.read(self.edge_size))
+        return h.digest()
+
+    def _digests(self, fn, paths: List, *args) -> dict:
+        """fn(path, *args) of each path, computed by the workers of the finder"""
+        results = DigestEngine.ordered_map(fn, ((path,) + args for path in paths), jobs=self.jobs, processes=self.processes)
+        return dict(zip(paths, results))
+
+    @staticmethod
+    def _groups(paths: Iterable, key) -> List[List]:
+        groups = {}
+        for path in paths:
+            groups.setdefault(key(path), []).append(path)
+        return list(groups.values())
+
+    def groups(self, paths: Iterable) -> Iterator[List]:
+        """lists of the paths with the same content, in the order of paths
+
+        Symlinks are followed, callers should filter them out if they must be left untouched.
+        """
+        sizes = {}
+        for path in paths:
+            sizes[path] = os.path.getsize(path)
+            self.stats['files'] += 1
+            self.stats['bytes'] += sizes[path]
+        for by_size in DuplicateFinder._groups(sizes, lambda p: sizes[p]):
+            size = sizes[by_size[0]]
+            if len(by_size) < 2:
+                self.stats['size_avoided'] += size
+                continue
+            if size == 0:
+                yield by_size
+                continue
+            partial_size = min(size, 2 * self.edge_size)
+            self.stats['partial_read'] += partial_size * len(by_size)
+            partial = self._digests(self._partial_digest, by_size, size)
+            for by_partial in DuplicateFinder._groups(by_size, partial.get):
+                if len(by_partial) < 2:
+                    self.stats['partial_avoided'] += size - partial_size
+                    continue
+                if size <= 2 * self.edge_size:
+                    yield by_partial
+                    continue
+                self.stats['full_read'] += size * len(by_partial)
+                # symlinks are followed, as by the size stage
+                full = self._digests(self.engine.digest_file, by_partial)
+                for by_digest in DuplicateFinder._groups(by_partial, full.get):
+                    if len(by_digest) > 1:
+                        yield by_digest
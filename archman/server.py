@@ -0,0 +1,128 @@
+"""Local socket API keeping an archive open between commands
+
+Requests and replies are JSON lines. A request is {"cmd": name, "kwargs": {...}},
+its reply is any number of {"out": text} followed by {"result": value} or {"error": message, "type": name}.
+"""
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+
+# output of a command buffered before it is sent to the client
+OUTPUT_BUFFER = 64 * 1024
+
+class ServerError(Exception):
+    """exception raised by a command on the server, type is the name of its class"""
+    def __init__(self, type, msg):
+        super().__init__("%s: %s"%(type,msg))
+        self.type = type
+
+class _Output(object):
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.buffer = []
+        self.size = 0
+
+    def write(self, text: str):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= OUTPUT_BUFFER:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            _send(self.wfile, {'out': ''.join(self.buffer)})
+            self.buffer = []
+            self.size = 0
+
+def _send(wfile, message: dict):
+    wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # a client may send several requests on its connection
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                handler = self.server.handlers[request['cmd']]
+            except (ValueError, KeyError, TypeError) as e:
+                _send(self.wfile, {'error': 'bad request: %s'%e, 'type': 'ValueError'})
+                continue
+            out = _Output(self.wfile)
+            try:
+                result = handler(self.server.archive, self.server.root, out.write, **request.get('kwargs', {}))
+            except Exception as e:
+                logging.debug("request %s failed"%request['cmd'], exc_info=True)
+                out.flush()
+                _send(self.wfile, {'error': str(e), 'type': type(e).__name__})
+                continue
+            out.flush()
+            _send(self.wfile, {'result': result})
+            self.wfile.flush()
+
+class ArchiveServer(socketserver.UnixStreamServer):
+    """serves the requests of ArchiveClient one at a time with an archive kept open
+
+    handlers[name](archive, root, out, **kwargs) runs command name, out(text) sends its output
+    and its return value ends the reply. open_archive(root) opens the archive in the thread
+    serving requests, the sqlite connection of its index belongs to that thread.
+    The archive should only be changed through the server while it runs: the check file
+    kept by the open archive does not follow the commits of other processes.
+    """
+    def __init__(self, socket_path: str, root, open_archive, handlers: dict):
+        self.root = root
+        self.open_archive = open_archive
+        self.handlers = handlers
+        self.archive = None
+        # only the user running the server may connect, from the moment the socket exists
+        umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, _RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.archive = self.open_archive(self.root)
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self.archive.close()
+            self.archive = None
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+class ArchiveClient(object):
+    """connection to an ArchiveServer"""
+
+    def __init__(self, socket_path: str):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.file = self.sock.makefile('rwb')
+
+    def call(self, cmd: str, *, out=None, **kwargs):
+        """result of command cmd run by the server with kwargs, its output is passed to out, stdout by default
+
+        Raise ServerError if the command fails on the server.
+        """
+        if out is None:
+            out = sys.stdout.write
+        _send(self.file, {'cmd': cmd, 'kwargs': kwargs})
+        self.file.flush()
+        for line in self.file:
+            reply = json.loads(line)
+            if 'out' in reply:
+                out(reply['out'])
+            elif 'error' in reply:
+                raise ServerError(reply['type'], reply['error'])
+            else:
+                return reply['result']
+        raise ConnectionError("the server closed the connection")
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
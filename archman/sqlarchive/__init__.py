@@ -1,14 +1,22 @@
 from pathlib import Path,PurePath
 import os
-from archman.sqlarchive.db import IndexDb,FileIndex,FolderIndex
+from archman.sqlarchive.db import IndexDb,FileIndex,FolderIndex,ReaderPool
 from archman.sqlarchive.check import RepairInfo
+from archman.sqlarchive.snapshot import TreeSnapshot
+from archman.sqlarchive.digest import DigestEngine, FileDigest
 from archman import Archive, NotWithinArchiveError
 import shutil
+import filecmp
+import stat
 import logging
+import time
+from contextlib import contextmanager
 from archman.sqlarchive import params
 from archman import NotAFileError,DirectoryNotFoundError,FileIntegrityError,FsUtils
 import pysatl
-import hashlib
+from typing import Iterator
+from typing import List
+from typing import Tuple
 
 
 
@@ -30,7 +38,8 @@ class SqlArchive(Archive):
         raise NotWithinArchiveError("'"+str(Path(p).resolve())+"' is not within an archive")
     
     @staticmethod
-    def create_archive(root_path: str): # TODO: declar type of return value ('Archive' gives undefined error)
+    def create_archive(root_path: str, *, algorithm: str=params.DEFAULT_ALGORITHM): # TODO: declar type of return value ('Archive' gives undefined error)
+        DigestEngine(algorithm=algorithm) # reject unsupported algorithms before creating anything
         root = Path(root_path)
         root.mkdir(mode=params.READ_WRITE,exist_ok=False)
         idx = root.joinpath(params.INDEX_DIR)
@@ -38,22 +47,39 @@ class SqlArchive(Archive):
         # create database
         db_file = str(idx.joinpath(params.INDEX_FILE).resolve())
         db = IndexDb(db_file,root=root,create=True)
+        db.set_setting('algorithm',algorithm)
+        db.commit()
+        db.checkpoint()
         # create check file
         check_file = str(idx.joinpath(params.CHECK_FILE).resolve())
         check = RepairInfo(check_file,db_file,create=True)
+        db.close()
         #idx.chmod(mode=params.READ_ONLY)
         #root.chmod(mode=params.READ_ONLY)
         return SqlArchive(root_path)
     
+    @staticmethod
+    def repair_index(root_path: str) -> List[int]:
+        """rebuild the damaged pages of the index database from the parity of the check file, return their numbers"""
+        index_dir = Path(root_path).resolve().joinpath(params.INDEX_DIR)
+        repair_info = RepairInfo(index_dir.joinpath(params.CHECK_FILE), index_dir.joinpath(params.INDEX_FILE), verify='lazy')
+        return repair_info.repair()
+
     @staticmethod
     def digest(data: bytes) -> bytes:
-        dig = hashlib.sha256(data).digest()
+        dig = DigestEngine().digest(data)
         return dig
     
     def chmod(path, mode):
         Path(path).chmod(mode)
 
-    def __init__(self,root_path: str, user_root_path: str=None):
+    def __init__(self,root_path: str, user_root_path: str=None, *, block_size: int=params.BLOCK_SIZE, db_check: str=params.DB_CHECK_ON_OPEN, read_only: bool=False):
+        """open the archive at root_path
+
+        A read-only archive can be used while another process modifies it, see ReaderPool.
+        Its index is upgraded first if it was written by an older version.
+        """
+        self.read_only = read_only
         self.root_path = Path(root_path).resolve()
         if user_root_path is not None:
             raise NotImplementedError()
@@ -61,8 +87,43 @@ class SqlArchive(Archive):
         self.index_dir = self.root_path.joinpath(params.INDEX_DIR)
         self.db_file = self.index_dir.joinpath(params.INDEX_FILE)
         self.check_file = self.index_dir.joinpath(params.CHECK_FILE)
-        self.repair_info = RepairInfo(self.check_file, self.db_file)
-        self.db = IndexDb(self.db_file, root=root_path)
+        # the index is verified before sqlite reads any of it
+        self.repair_info = self._open_repair_info(block_size, db_check)
+        if read_only and IndexDb.needs_upgrade(self.db_file):
+            # just verified, the writer rewrites the check file of the upgraded index
+            SqlArchive(root_path, block_size=block_size, db_check='lazy').close()
+            self.repair_info = self._open_repair_info(block_size, 'lazy')
+        self.db = IndexDb(self.db_file, root=root_path, read_only=read_only)
+        self._closed = False
+        # read-only connections of the jobs of check and export_dir, opened when first needed
+        self._readers = None
+        # archives created before the algorithm became a setting use sha256
+        algorithm = self.db.get_setting('algorithm','sha256')
+        self.digest_engine = DigestEngine(algorithm=algorithm, block_size=block_size, chunk_size=params.CHUNK_SIZE)
+        self._digest_engines = {(algorithm,params.CHUNK_SIZE): self.digest_engine}
+        if self.db.upgraded:
+            # the schema or the journal mode changed, rewrite the check file
+            self.commit(rebuild=True)
+
+    def _open_repair_info(self, block_size: int, db_check: str) -> RepairInfo:
+        if not self.read_only:
+            return RepairInfo(self.check_file, self.db_file, block_size=block_size, verify=db_check)
+        # a writer may be between a checkpoint and the update of the check file, give it some time
+        deadline = time.monotonic() + params.DB_BUSY_TIMEOUT
+        while True:
+            try:
+                return RepairInfo(self.check_file, self.db_file, block_size=block_size, verify=db_check)
+            except FileIntegrityError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def _engine(self, algorithm: str, chunk_size: int = None) -> DigestEngine:
+        """digest engine for algorithm, files indexed before a redigest may still use another one than the archive's"""
+        key = (algorithm,chunk_size)
+        if key not in self._digest_engines:
+            self._digest_engines[key] = DigestEngine(algorithm=algorithm, block_size=self.digest_engine.block_size, chunk_size=chunk_size)
+        return self._digest_engines[key]
         
 
     def resolve_path(self, path: Path):
@@ -74,9 +135,14 @@ class SqlArchive(Archive):
         path = self.resolve_path(path)
         return path.is_dir
     
-    def list_id(self, dir_id, recursive = False):
-        dirs = list(self.db.folders(parent_id=dir_id))
-        files = list(self.db.files(parent_id=dir_id))   
+    def list_id(self, dir_id, recursive = False, *, tree: TreeSnapshot = None):
+        if tree is None:
+            dirs = list(self.db.folders(parent_id=dir_id))
+            files = list(self.db.files(parent_id=dir_id))   
+        else:
+            i = tree.folder(dir_id)
+            dirs = [(tree.folder_uid[c], tree.folder_index(c)) for c in tree.children(i)]
+            files = [(tree.file_uid[j], tree.file_index(j)) for j in tree.files(i)]
         dirs_tuples = list()
         for d in dirs:
             dirs_tuples.append((d[1],{'dirs':[],'files':[]}))
@@ -89,18 +155,65 @@ class SqlArchive(Archive):
         if recursive:
             rec_dirs = list()
             for (uid,child) in dirs:
-                content = self.list_id(uid, recursive=True)
+                content = self.list_id(uid, recursive=True, tree=tree)
                 item = (child,content)
                 rec_dirs.append(item) 
             out['dirs'] = rec_dirs
         return out
     
-    def list(self, path, recursive = False):
+    def hardlinks(self, path) -> List[Path]:
+        """paths of the files sharing the inode of path, path included, from the index"""
+        p = Path(path)
+        (uid,f) = self.db.file_from_path(p.parent.resolve().joinpath(p.name))
+        return sorted(self.db.path_from_file_uid(id) for id in self.db.hardlinks(uid))
+
+    def du(self, path) -> Tuple[int,int]:
+        """size and number of files of path, read from the totals kept by the index"""
+        p = Path(path).resolve()
+        if p.is_dir() and not p.is_symlink():
+            (uid,folder) = self.db.folder_from_path(p)
+            return self.db.folder_totals(uid)
+        (uid,f) = self.db.file_from_path(p)
+        return (f.size or 0, 1)
+
+    def list(self, path, recursive = False, *, snapshot: bool=False):
+        """content of path, from a snapshot of the whole index if snapshot is set, see load_snapshot"""
         out = {}
         dir_id = self.db.folder_from_path(path)[0]
-        return self.list_id(dir_id,recursive=recursive)
+        tree = self.load_snapshot() if snapshot else None
+        return self.list_id(dir_id,recursive=recursive,tree=tree)
+
+    def list_entries(self, path, *, max_depth: int=None, snapshot: bool=False) -> Iterator[Tuple[int,bool,str,bool]]:
+        """see Archive.list_entries, streamed by a single query of the index or from a snapshot"""
+        dir_id = self.db.folder_from_path(path)[0]
+        if snapshot:
+            return self.load_snapshot().walk_entries(dir_id, max_depth)
+        return self.db.walk_entries(dir_id, max_depth)
+
+    def list_records(self, path, *, max_depth: int=None) -> Iterator[Tuple[str,bool,int,int,str,bytes]]:
+        """(path, is_dir, mode, size, algorithm, digest) of the content of path streamed from the index, see IndexDb.walk_records"""
+        dir_id = self.db.folder_from_path(path)[0]
+        return self.db.walk_records(dir_id, max_depth)
+
+    def load_snapshot(self) -> TreeSnapshot:
+        """the folders and files of the index in compact in-memory columns
+
+        Loading it reads the whole index once, walking it afterwards runs no query:
+        faster for operations on most of the tree of a large archive, slower for small parts of it.
+        """
+        return TreeSnapshot(self.db)
+
+    def _walk(self, path: Path, tree: TreeSnapshot = None):
+        if tree is None:
+            return self.db.walk(path)
+        return tree.walk_id(self.db.folder_from_path(path)[0])
     
-    def add_file(self, src: str, dst:str) -> None:
+    def add_file(self, src: str, dst:str, *, verify: bool=False, dedup: bool=False) -> None:
+        """add src to the archive as dst
+
+        With dedup, src is hashed first and hardlinked to a file of the archive with the same content
+        if there is one, see _find_copy, it is copied otherwise.
+        """
         src_file = Path(src).name
         s_parent = Path(src).parent.resolve()
         s = s_parent.joinpath(src_file)
@@ -116,33 +229,104 @@ class SqlArchive(Archive):
         if not d_parent.exists():
             raise FileNotFoundError(str(d_parent))
         
-        # write the file within the archive
+        # write the file within the archive, hashing it on the fly
         d_parent.chmod(params.READ_WRITE)
-        shutil.copyfile(src=s,dst=d,follow_symlinks=False)
+        linked_inodes = set()
+        if dedup:
+            digest = next(self._dedup_paths([(s,d)],verify=verify,copy_stat=False,linked_inodes=linked_inodes))
+        else:
+            digest = self.digest_engine.copy_path(s,d,verify=verify,copy_stat=False)
         d_parent.chmod(params.READ_ONLY)
         # update index database, in memory for now
-        self._add_file_in_db(src=s,dst=d)
+        self._add_file_in_db(src=s,dst=d,digest=digest)
+        self._refresh_links(linked_inodes)
 
-    def _compute_file_hash(self,f: Path) -> bytes:
-        if f.is_symlink():
-            target = os.readlink(f)
-            digest = self.digest(target.encode('utf8'))
-        else:
-            digest = self.digest(f.read_bytes())
+    def _find_copy(self, src: Path, digest: FileDigest, added: dict) -> Path:
+        """a regular file of the archive with the content and the permissions of src, None if there is none
+
+        added maps digests to the files copied by the current operation, which may not be in DB yet.
+        A file of the index is only a candidate if its size and mtime still match the index.
+        """
+        st = os.lstat(src)
+        candidates = []
+        if digest.digest in added:
+            candidates.append((added[digest.digest],None))
+        for (uid,f) in self.db.files_with_digest(self.digest_engine.algorithm,digest.digest):
+            candidates.append((self.db.path_from_folder_uid(f.parent_id).joinpath(f.name),f))
+        for (path,f) in candidates:
+            try:
+                pst = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            if not stat.S_ISREG(pst.st_mode) or pst.st_size != st.st_size or stat.S_IMODE(pst.st_mode) != stat.S_IMODE(st.st_mode):
+                continue
+            if f is not None and (f.size,f.mtime_ns) != (pst.st_size,pst.st_mtime_ns):
+                continue
+            return path
+        return None
+
+    def _dedup_paths(self, pairs, *, jobs: int=1, processes: bool=False, verify: bool=False, copy_stat: bool=True, linked_inodes: set) -> Iterator[FileDigest]:
+        """like DigestEngine.copy_paths, but files whose content is in the archive already are hardlinked to it
+
+        Sources are hashed first by jobs workers, then hardlinked or copied in order by the calling thread.
+        The inodes which got new links are added to linked_inodes.
+        """
+        pairs = list(pairs)
+        added = {}
+        digests = DigestEngine.ordered_map(self.digest_engine.index_path,((src,) for (src,dst) in pairs),jobs=jobs,processes=processes)
+        for ((src,dst),digest) in zip(pairs,digests):
+            if not os.path.islink(src):
+                existing = self._find_copy(src,digest,added)
+                if existing is not None:
+                    try:
+                        os.link(existing,dst)
+                    except OSError as e:
+                        # another file system
+                        logging.debug("cannot link %s to %s: %s"%(dst,existing,e))
+                    else:
+                        logging.debug("%s hardlinked to %s"%(dst,existing))
+                        linked_inodes.add(os.lstat(dst).st_ino)
+                        self.db.link_inode(os.lstat(dst).st_ino,digest.digest)
+                        yield digest
+                        continue
+            copied = self.digest_engine.copy_path(src,dst,verify=verify,copy_stat=copy_stat)
+            if copied.digest != digest.digest:
+                raise FileIntegrityError("%s changed while it was added"%str(src))
+            added.setdefault(digest.digest,dst)
+            yield copied
+
+    def _refresh_links(self, inodes: set):
+        # a new link changes the ctime of all the files sharing the inode
+        for inode in inodes:
+            for uid in self.db.files_with_inode(inode):
+                self._update_file_stat(self.db.path_from_file_uid(uid))
+
+    def _compute_file_hash(self,f: Path, algorithm: str = None) -> bytes:
+        if algorithm is None:
+            algorithm = self.digest_engine.algorithm
+        digest = self._engine(algorithm).digest_path(f)
         logging.debug(pysatl.Utils.hexstr(digest) + ': '+str(f))
         return digest
 
-    def _compute_file_index(self, src:Path, dst: Path = None):
+    def _compute_file_index(self, src:Path, dst: Path = None, digest: FileDigest = None, algorithm: str = None):
         if dst is None:
             dst = src
+        if algorithm is None:
+            algorithm = self.digest_engine.algorithm
         folder_id = self.db.folder_from_path(dst.parent)[0]
-        digest = self._compute_file_hash(src)
+        if digest is None:
+            digest = FileDigest(self._compute_file_hash(src,algorithm))
         mode = int(oct(src.stat().st_mode)[-3:])
         dfi = FileIndex(
             parent_id=folder_id,
             name = dst.name,
-            digest = digest,
-            mode = mode)
+            digest = digest.digest,
+            mode = mode,
+            algorithm = algorithm)
+        if digest.chunks is not None:
+            dfi.chunk_size = self.digest_engine.chunk_size
+            dfi.merkle_root = self.digest_engine.merkle_root(digest.chunks)
+        dfi.set_stat(os.lstat(dst))
         return dfi
     
     def _compute_dir_index(self, src:Path, dst: Path = None):
@@ -156,11 +340,11 @@ class SqlArchive(Archive):
             mode = mode)
         return dfi
     
-    def _add_file_in_db(self,src: Path, dst: Path):
+    def _add_file_in_db(self,src: Path, dst: Path, digest: FileDigest = None):
         logging.debug('adding file ' + str(src) + ' to ' + str(dst) + ' in archive' + str(self.root_path))
-        dfi = self._compute_file_index(src,dst)
+        dfi = self._compute_file_index(src,dst,digest)
         #self.root_path.joinpath(params.INDEX_FOLDER).chmod(params.READ_WRITE)
-        self.db.add_file(dfi)
+        self.db.add_file(dfi, digest.chunks if digest is not None else None)
         #self.root_path.joinpath(params.INDEX_FOLDER).chmod(params.READ_ONLY)
         
     def _add_dir_in_db(self,src: Path, dst: Path):    
@@ -174,7 +358,13 @@ class SqlArchive(Archive):
         #self.root_path.chmod(params.READ_ONLY)
         #self.root_path.joinpath(params.INDEX_FOLDER).chmod(params.READ_ONLY)
         
-    def add_dir(self, src: str, dst:str) -> None:
+    def add_dir(self, src: str, dst:str, *, jobs: int=1, processes: bool=False, verify: bool=False, dedup: bool=False) -> None:
+        """add src and its content to the archive as dst
+
+        Files hardlinked together within src are hardlinked together within the archive.
+        With dedup, files are hashed first and those whose content is in the archive already are hardlinked to it,
+        see add_file.
+        """
         src_file = Path(src).name
         s_parent = Path(src).parent.resolve()
         s = s_parent.joinpath(src_file)
@@ -190,27 +380,76 @@ class SqlArchive(Archive):
         if not d_parent.exists():
             raise FileNotFoundError(str(d_parent))
         
-        # write the files within the archive
+        # list all sub directories and files, parents always come before their content
+        entries = []
+        # first destination of each source inode with several links, the next ones are hardlinked to it
+        inodes = {}
+        links = {}
+        for root,dirs,files in os.walk(s,topdown=True,followlinks=False):
+            r = Path(root)
+            rel_path = r.relative_to(s)
+            dst_root = d.joinpath(rel_path)
+            for file in files:
+                entries.append((r.joinpath(file),dst_root.joinpath(file),False))
+                st = os.lstat(r.joinpath(file))
+                if st.st_nlink > 1 and stat.S_ISREG(st.st_mode):
+                    key = (st.st_dev,st.st_ino)
+                    if key in inodes:
+                        links[dst_root.joinpath(file)] = inodes[key]
+                    else:
+                        inodes[key] = dst_root.joinpath(file)
+            for dir in dirs:
+                entries.append((r.joinpath(dir),dst_root.joinpath(dir),True))
+
+        # create the directories within the archive, symlinks to directories are preserved
         d_parent.chmod(params.READ_WRITE)
-        shutil.copytree(src=s,dst=d,symlinks=True)
-        d_parent.chmod(params.READ_ONLY)
+        d.mkdir()
+        for (src,dst,is_dir) in entries:
+            if is_dir:
+                if src.is_symlink():
+                    os.symlink(os.readlink(src),dst)
+                else:
+                    dst.mkdir()
 
         # update index database, in memory for now
-        self._add_dir_in_db(src=s,dst=d)
+        with self.db.bulk_ingest():
+            self._add_dir_in_db(src=s,dst=d)
 
-        # add all sub directories and files in DB
-        for root,dirs,files in os.walk(d,topdown=True,followlinks=False):
-            r = Path(root)
-            rel_path = r.relative_to(d)
-            src_root = s.joinpath(rel_path)
-            for file in files:
-                src = src_root.joinpath(file)
-                dst = r.joinpath(file)
-                self._add_file_in_db(src=src,dst=dst)
-            for dir in dirs:
-                src = src_root.joinpath(dir)
-                dst = r.joinpath(dir)
-                self._add_dir_in_db(src=src,dst=dst)
+            # copy and hash files concurrently in a single read of the source,
+            # a single writer adds them in DB in walk order
+            file_pairs = ((src,dst) for (src,dst,is_dir) in entries if not is_dir and dst not in links)
+            linked_inodes = set()
+            if dedup:
+                digests = self._dedup_paths(file_pairs,jobs=jobs,processes=processes,verify=verify,linked_inodes=linked_inodes)
+            else:
+                digests = self.digest_engine.copy_paths(file_pairs,jobs=jobs,processes=processes,verify=verify)
+            targets = set(links.values())
+            linked_digests = {}
+            for (src,dst,is_dir) in entries:
+                if is_dir:
+                    self._add_dir_in_db(src=src,dst=dst)
+                elif dst in links:
+                    # hardlinks are preserved, their content is neither copied nor hashed again
+                    target = links[dst]
+                    os.link(target,dst)
+                    digest = linked_digests[target]
+                    self._add_file_in_db(src=src,dst=dst,digest=digest)
+                    linked_inodes.add(os.lstat(dst).st_ino)
+                    self.db.link_inode(os.lstat(dst).st_ino,digest.digest)
+                else:
+                    digest = next(digests)
+                    if dst in targets:
+                        linked_digests[dst] = digest
+                    self._add_file_in_db(src=src,dst=dst,digest=digest)
+
+        self._refresh_links(linked_inodes)
+
+        # directories metadata last, writing their content changed them
+        for (src,dst,is_dir) in reversed(entries):
+            if is_dir:
+                shutil.copystat(src,dst,follow_symlinks=False)
+        shutil.copystat(s,d)
+        d_parent.chmod(params.READ_ONLY)
 
     def delete_file(self, dst:str) -> None:
         logging.info('deleting file ' + str(dst) + ' from archive' + str(self.root_path))
@@ -224,7 +463,7 @@ class SqlArchive(Archive):
         (id,f) = self.db.folder_from_path(dst)
         self.db.delete_folder(id)
 
-    def update_file(self, src: str, dst:str) -> None:
+    def update_file(self, src: str, dst:str, *, verify: bool=False) -> None:
         #self.delete_file(dst)
         #self.add_file(src=src,dst=dst)
         s = Path(src)
@@ -240,12 +479,16 @@ class SqlArchive(Archive):
         if not d_parent.exists():
             raise FileNotFoundError(str(d_parent))
         (id_f,f) = self.db.file_from_path(d)
-        # write the file within the archive
+        # write the file within the archive, hashing it on the fly
         d_parent.chmod(params.READ_WRITE)
-        shutil.copyfile(src=s,dst=d,follow_symlinks=False)
+        if d.is_symlink() or os.lstat(d).st_nlink > 1:
+            # replace the link itself, not the file it points to nor the other links to its inode
+            os.remove(d)
+        digest = self.digest_engine.copy_path(s,d,verify=verify,copy_stat=False)
         d_parent.chmod(params.READ_ONLY)
-        dfi = self._compute_file_index(s,d)
+        dfi = self._compute_file_index(s,d,digest)
         self.db.update_file(uid=id_f,val=dfi)
+        self.db.set_chunks(id_f,digest.chunks)
 
     def move_file(self, src: str, dst:str) -> None:
         s = Path(src).resolve()
@@ -263,9 +506,12 @@ class SqlArchive(Archive):
         shutil.move(src,dst)
         (id_dst,f) = self.db.folder_from_path(d_parent)
         (id_f,f) = self.db.file_from_path(s)
-        dfi = self._compute_file_index(d)
+        dfi = self._compute_file_index(d,algorithm=f.algorithm)
         assert f.digest == dfi.digest
         assert f.mode == dfi.mode
+        # same content, same chunks
+        dfi.chunk_size = f.chunk_size
+        dfi.merkle_root = f.merkle_root
         self.db.update_file(uid=id_f,val=dfi)
 
     def move_dir(self, src: str, dst:str) -> None:
@@ -288,17 +534,77 @@ class SqlArchive(Archive):
         assert f.mode == dfi.mode
         self.db.update_folder(uid=id_src,val=dfi)
 
-    def commit(self) -> None:
+    def commit(self, rebuild: bool=False) -> None:
+        """commit the index and refresh the digests of the pages it changed in the check file"""
         #self.root_path.joinpath(params.INDEX_FOLDER).chmod(params.READ_WRITE)
         #self.db_file.chmod(params.READ_WRITE)
+        if self.read_only:
+            raise RuntimeError("archive '%s' is opened read-only"%self.root_path)
         self.db.commit()
+        dirty_pages = self.db.wal_pages()
+        complete = self.db.checkpoint()
         #self.db_file.chmod(params.READ_ONLY)
         #self.check_file.chmod(params.READ_WRITE)
-        os.remove(self.check_file)
-        check = RepairInfo(self.check_file,self.db_file,create=True)
+        # pages of an incomplete checkpoint may be in the database file already
+        if rebuild:
+            self.repair_info.rebuild()
+        else:
+            self.repair_info.update(dirty_pages)
+        if not complete:
+            logging.warning("index of archive '%s' is in use by readers, its WAL is kept until the next commit or close"%self.root_path)
         #self.check_file.chmod(params.READ_ONLY)
         #self.root_path.joinpath(params.INDEX_FOLDER).chmod(params.READ_ONLY)
     
+    def rollback(self) -> None:
+        """discard the changes of the index since the last commit, the files already written within the archive stay"""
+        self.db.rollback()
+
+    def savepoint(self):
+        """context manager discarding the changes of the index made within the block if it fails, see rollback"""
+        return self.db.savepoint()
+
+    def close(self) -> None:
+        """close the index, uncommitted changes are lost
+
+        The WAL kept by a commit while readers were active is written to the database file
+        by the last connection to close, if it is not checkpointed here: the check file is refreshed
+        for its pages once the index is closed, from whatever the database file then holds.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._readers is not None:
+            self._readers.close()
+        if self.read_only:
+            self.db.close()
+            return
+        self.db.conn.rollback()
+        dirty_pages = self.db.wal_pages()
+        self.db.checkpoint()
+        self.db.close()
+        if dirty_pages:
+            self.repair_info.update(dirty_pages)
+
+    @property
+    def readers(self) -> ReaderPool:
+        if self._readers is None:
+            self._readers = ReaderPool(str(self.db_file), root=str(self.root_path))
+        return self._readers
+
+    @contextmanager
+    def _index(self, jobs: int):
+        """index for a job: self.db when jobs run in the calling thread, a pooled read-only one otherwise"""
+        if jobs <= 1:
+            yield self.db
+            return
+        with self.readers.reader() as db:
+            yield db
+
+    def _check_jobs(self, jobs: int):
+        # readers only see committed changes
+        if jobs > 1 and self.db.conn.in_transaction:
+            raise RuntimeError("archive '%s' has uncommitted changes, commit them before running several jobs"%self.root_path)
+
     def export_file(self, src:str, dst:str) -> None:
         src_file = Path(src).name
         s_parent = Path(src).parent.resolve()
@@ -316,24 +622,65 @@ class SqlArchive(Archive):
             raise FileNotFoundError(str(d_parent))
         shutil.copyfile(src=s,dst=d,follow_symlinks=False) 
         (id,sfi) = self.db.file_from_path(s)
-        self.check_exported_file_integrity(s,d,sfi)
+        self.check_exported_file_integrity(s,d,sfi,id)
 
-    def check_file_integrity(self, path: Path, file_index: FileIndex):
-        dig = self._compute_file_hash(path)
-        if file_index.digest != dig:
-            raise FileIntegrityError("%s digest:\n%s\nexpected:\n%s"%(
+    @staticmethod
+    def _check_digest(path: Path, dig: bytes, expected: bytes, details: str = ''):
+        if expected != dig:
+            raise FileIntegrityError("%s digest:\n%s\nexpected:\n%s%s"%(
                 str(path),
                 pysatl.Utils.hexstr(dig),
-                pysatl.Utils.hexstr(file_index.digest)
+                pysatl.Utils.hexstr(expected),
+                details
                 ))
 
-    def check_exported_file_integrity(self, s: Path, d: Path, file_index: FileIndex):
+    def check_file_integrity(self, path: Path, file_index: FileIndex, uid: int = None, *, db: IndexDb = None):
+        """raise FileIntegrityError if path does not match file_index
+
+        When the uid of the file is given and the file has chunk digests, the error lists the damaged byte ranges.
+        The chunk digests are read from db, self.db by default.
+        """
+        dig = self._compute_file_hash(path,file_index.algorithm)
+        details = ''
+        if dig != file_index.digest and uid is not None and file_index.chunk_size is not None:
+            ranges = self.damaged_ranges(path,uid,file_index,db=db)
+            details = "\ndamaged byte ranges: " + ', '.join(['[%d,%d)'%r for r in ranges])
+        self._check_digest(path,dig,file_index.digest,details)
+
+    def damaged_chunks(self, path: Path, uid: int, file_index: FileIndex, *, db: IndexDb = None) -> List[int]:
+        """numbers of the chunks of path which do not match their digest in DB"""
+        expected = (db or self.db).chunks(uid)
+        engine = self._engine(file_index.algorithm,file_index.chunk_size)
+        if engine.merkle_root(expected) != file_index.merkle_root:
+            raise FileIntegrityError("%s: chunk digests in DB do not match their root"%str(path))
+        actual = []
+        if os.path.lexists(path):
+            actual = engine.index_path(path).chunks or []
+        return [i for i in range(0,len(expected)) if i >= len(actual) or actual[i] != expected[i]]
+
+    def damaged_ranges(self, path: Path, uid: int, file_index: FileIndex, *, db: IndexDb = None) -> List[Tuple[int,int]]:
+        """damaged byte ranges of path as (start, end) tuples, end excluded"""
+        chunk_size = file_index.chunk_size
+        ranges = []
+        for i in self.damaged_chunks(path,uid,file_index,db=db):
+            start = i * chunk_size
+            end = min(start + chunk_size, file_index.size)
+            if len(ranges) and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0],end)
+            else:
+                ranges.append((start,end))
+        if os.path.lexists(path) and os.lstat(path).st_size > file_index.size:
+            # extra data at the end
+            ranges.append((file_index.size,os.lstat(path).st_size))
+        return ranges
+
+    def check_exported_file_integrity(self, s: Path, d: Path, file_index: FileIndex, uid: int = None, *, db: IndexDb = None):
         try:
             self.check_file_integrity(d,file_index)
         except Exception as e:
             logging.warning(e)
             logging.warning("digest mismatch between DB and destination file %s"%d)
-            self.check_file_integrity(s,file_index)
+            self.check_file_integrity(s,file_index,uid,db=db)
             # retry
             shutil.copyfile(src=s,dst=d,follow_symlinks=False) 
             try:
@@ -341,7 +688,13 @@ class SqlArchive(Archive):
             except:
                 raise Exception("Copy to %s is unreliable"%str(d))   
 
-    def export_dir(self, src: str, dst:str) -> None:
+    def export_dir(self, src: str, dst:str, *, jobs: int=1, snapshot: bool=False) -> None:
+        """export src to dst and check the exported files, jobs of them at once
+
+        Several jobs read the index with read-only connections, it must not have uncommitted changes.
+        The tree is walked from a snapshot of the index if snapshot is set, see load_snapshot.
+        """
+        self._check_jobs(jobs)
         s = Path(src).resolve()
         d = Path(dst).resolve()
         d_parent = d.parent
@@ -355,55 +708,223 @@ class SqlArchive(Archive):
         if not d_parent.exists():
             raise FileNotFoundError(str(d_parent))
         shutil.copytree(src=s,dst=d,symlinks=True) # preserve symlinks
-        for root_id,files,dirs in self.db.walk(s):
-            root = self.db.path_from_folder_uid(root_id)
-            rel_path = root.relative_to(s)
-            dst_base = d / rel_path
-            for (id,f) in files:
-                sf = root / f.name
-                df = dst_base / f.name
-                self.check_exported_file_integrity(sf,df,f)
-            for (id,dir) in dirs:
-                dst_dir = dst_base / dir.name
-                if not dst_dir.exists():
-                    raise FileNotFoundError(dst_dir)
+        tree = self.load_snapshot() if snapshot else None
+        def exported_files():
+            for root_id,root,files,dirs in self._walk(s,tree):
+                rel_path = root.relative_to(s)
+                dst_base = d / rel_path
+                for (id,f) in files:
+                    yield (root / f.name, dst_base / f.name, f, id)
+                for (id,dir) in dirs:
+                    dst_dir = dst_base / dir.name
+                    if not dst_dir.exists():
+                        raise FileNotFoundError(dst_dir)
+        def check(sf, df, f, id):
+            with self._index(jobs) as db:
+                self.check_exported_file_integrity(sf,df,f,id,db=db)
+        for _ in DigestEngine.ordered_map(check,exported_files(),jobs=jobs,processes=False):
+            pass
                 
-    def dedup(self, src: str, hardlink=False) -> None:
+    def dedup(self, src: str, hardlink=False, *, confirm=False) -> None:
+        """hardlink or delete the files within src which have the same content
+
+        Duplicates are found from the digests in the index, files are not read unless confirm is set:
+        then each duplicate is compared byte for byte with the file kept.
+        The file kept is the first one by path whose name does not end with '.dup'.
+        Symlinks are left untouched.
+        """
         src_dir = Path(src).resolve()
         if not src_dir.is_dir():
             raise NotADirectoryError(str(src_dir))
         logging.info("dedup %s"%src_dir)
-        index = {}
-        for path, dirs, files in os.walk(src_dir):
-            for f in files:
-                file_path = os.path.join(path,f)
-                if os.path.islink(file_path):
-                    print("soft link found: %s"%file_path)
+        (folder_id,folder) = self.db.folder_from_path(src_dir)
+        for group in self.db.duplicates(folder_id):
+            # symlinks are digested by their target, their digest may match a file containing it
+            paths = []
+            for (uid,path) in group:
+                if path.is_symlink():
+                    logging.debug("soft link found: %s"%path)
+                else:
+                    paths.append(path)
+            if len(paths) < 2:
+                continue
+            keep = next((p for p in paths if not p.name.endswith(".dup")), paths[0])
+            for other in paths:
+                if other == keep or FsUtils.are_hardlinked(keep,other):
+                    continue
+                if confirm and not filecmp.cmp(keep,other,shallow=False):
+                    logging.warning("%s and %s have the same digest but different contents"%(keep,other))
                     continue
-                dat = open(file_path,'rb').read()
-                dig = hash(dat)
-                if dig in index:
-                    org = index[dig]
-                    if not FsUtils.are_hardlinked(org,file_path):
-                        logging.info("duplicated files found: %s and %s"%(org,file_path))
-                        if org.endswith(".dup"):
-                            keep = file_path
-                            other = org
-                        else:
-                            keep = org 
-                            other = file_path
-                        index[dig] = keep                        
-                        if hardlink:
-                            os.remove(other)
-                            os.link(keep,other)
-                        else:
-                            self.delete_file(other)
+                logging.info("duplicated files found: %s and %s"%(keep,other))
+                if hardlink:
+                    os.remove(other)
+                    os.link(keep,other)
+                    # both paths changed inode or link count
+                    self._update_file_stat(keep)
+                    self._update_file_stat(other)
+                    (uid,f) = self.db.file_from_path(keep)
+                    self.db.link_inode(f.inode,f.digest)
                 else:
-                    index[dig] = file_path
+                    self.delete_file(other)
     
-    def check(self):
-        for root_id,files,dirs in self.db.walk(self.root_path):
-            root = self.db.path_from_folder_uid(root_id)
+    def redigest(self, algorithm: str, *, jobs: int=1, batch: int=1000) -> int:
+        """switch the archive to another digest algorithm, return the number of files processed
+
+        Files are added with the new algorithm as soon as this starts. Existing files are
+        processed by batches, each batch is committed so the archive stays usable and an
+        interrupted migration resumes where it stopped: each file carries its own algorithm.
+        Each file is read once to check its current digest and compute the new ones.
+        """
+        DigestEngine(algorithm=algorithm)
+        logging.info("redigest archive %s with %s"%(str(self.root_path),algorithm))
+        self.db.set_setting('algorithm',algorithm)
+        self.digest_engine = self._engine(algorithm,params.CHUNK_SIZE)
+        self.commit()
+        count = 0
+        while True:
+            todo = list(self.db.files_to_redigest(algorithm,batch))
+            if 0 == len(todo):
+                break
+            paths = [self.db.path_from_folder_uid(f.parent_id).joinpath(f.name) for (uid,f) in todo]
+            index_path = lambda path,old: self.digest_engine.index_path(path,extra_algorithms=[old])
+            results = DigestEngine.ordered_map(index_path,((path,f.algorithm) for (path,(uid,f)) in zip(paths,todo)),jobs=jobs,processes=False)
+            for ((uid,f),path,res) in zip(todo,paths,results):
+                self._check_digest(path,res.extra[f.algorithm],f.digest)
+                f.digest = res.digest
+                f.algorithm = algorithm
+                f.set_stat(os.lstat(path))
+                f.chunk_size = None
+                f.merkle_root = None
+                if res.chunks is not None:
+                    f.chunk_size = self.digest_engine.chunk_size
+                    f.merkle_root = self.digest_engine.merkle_root(res.chunks)
+                self.db.update_file(uid=uid,val=f)
+                self.db.set_chunks(uid,res.chunks)
+            count += len(todo)
+            self.commit()
+            logging.info("%d files redigested"%count)
+        return count
+
+    def _fetch_chunk(self, others: List[Path], no: int, file_index: FileIndex, expected: bytes) -> bytes:
+        engine = self._engine(file_index.algorithm,file_index.chunk_size)
+        for other in others:
+            try:
+                with open(other,'rb') as f:
+                    f.seek(no * file_index.chunk_size)
+                    data = f.read(file_index.chunk_size)
+            except OSError as e:
+                logging.debug(e)
+                continue
+            if engine.digest(data) == expected:
+                return data
+            logging.info("chunk %d of %s is damaged"%(no,str(other)))
+        raise FileIntegrityError("chunk %d of %s is damaged in all copies"%(no,file_index.name))
+
+    def _repair_whole_file(self, d: Path, file_index: FileIndex, others: List[Path]) -> int:
+        engine = self._engine(file_index.algorithm)
+        for other in others:
+            if not os.path.lexists(other):
+                continue
+            if engine.digest_path(other) != file_index.digest:
+                logging.info("%s is damaged"%str(other))
+                continue
+            d.parent.chmod(params.READ_WRITE)
+            if os.path.lexists(d):
+                os.remove(d)
+            engine.copy_path(other,d,copy_stat=False)
+            d.parent.chmod(params.READ_ONLY)
+            return os.lstat(d).st_size
+        raise FileIntegrityError("%s is damaged in all copies"%str(d))
+
+    def repair_file(self, dst: str, sources: List[str]) -> int:
+        """repair a file of the archive using other copies of the archive, return the number of bytes fetched
+
+        Only the damaged chunks are read from the copies. The copies may be damaged as well,
+        as long as each damaged chunk is intact in at least one of them.
+        Files without chunk digests are fetched whole from the first intact copy.
+        """
+        d = Path(dst).parent.resolve().joinpath(Path(dst).name)
+        (uid,f) = self.db.file_from_path(d)
+        rel_path = d.relative_to(self.root_path)
+        others = [Path(src).resolve().joinpath(rel_path) for src in sources]
+        logging.info('repairing ' + str(d) + ' from ' + ', '.join(map(str,others)))
+        if f.chunk_size is None or f.size is None or os.path.islink(d) or any(map(os.path.islink,others)):
+            fetched = self._repair_whole_file(d,f,others)
+        else:
+            expected = self.db.chunks(uid)
+            damaged = self.damaged_chunks(d,uid,f)
+            if not os.path.lexists(d):
+                d.parent.chmod(params.READ_WRITE)
+                open(d,'wb').close()
+                d.parent.chmod(params.READ_ONLY)
+            mode = os.stat(d).st_mode
+            os.chmod(d,mode | stat.S_IWUSR)
+            fetched = 0
+            try:
+                with open(d,'r+b') as fo:
+                    for no in damaged:
+                        data = self._fetch_chunk(others,no,f,expected[no])
+                        fo.seek(no * f.chunk_size)
+                        fo.write(data)
+                        fetched += len(data)
+                    fo.truncate(f.size)
+            finally:
+                os.chmod(d,mode)
+        self.check_file_integrity(d,f,uid)
+        self._update_file_stat(d)
+        logging.info('%d bytes fetched to repair %s'%(fetched,str(d)))
+        return fetched
+
+    def repair_dir(self, dst: str, sources: List[str]) -> int:
+        """repair all damaged files within a directory of the archive, see repair_file"""
+        fetched = 0
+        for root_id,root,files,dirs in self.db.walk(Path(dst).resolve()):
+            for (uid,f) in files:
+                sf = root / f.name
+                if os.path.lexists(sf) and self._compute_file_hash(sf,f.algorithm) == f.digest:
+                    continue
+                fetched += self.repair_file(sf,sources)
+        return fetched
+
+    def _update_file_stat(self, path: Path):
+        (id_f,f) = self.db.file_from_path(path)
+        f.set_stat(os.lstat(path))
+        self.db.update_file(uid=id_f,val=f)
+
+    def _check_file(self, sf: Path, quick: bool, jobs: int, entry: Tuple[int,FileIndex] = None):
+        with self._index(jobs) as db:
+            uid,dfi = entry or db.file_from_path(sf)
+            if quick and dfi.stat_signature() == FileIndex.stat_signature_of(os.lstat(sf)):
+                logging.debug('unchanged: '+str(sf))
+                return
+            self.check_file_integrity(sf,dfi,uid,db=db)
+
+    def check(self, quick=False, *, jobs: int=1, snapshot: bool=False):
+        """check that the archive content matches the index
+
+        In quick mode, files whose stat signature (size, mtime, ctime, inode)
+        did not change since they were indexed are not hashed again.
+        The content of an inode shared by several files is hashed once.
+        The index database is fully verified against the check file in both modes.
+        Files are hashed by jobs threads, which read the index with read-only connections:
+        it must not have uncommitted changes then.
+        The tree is walked from a snapshot of the index if snapshot is set, see load_snapshot.
+        """
+        self._check_jobs(jobs)
+        self.repair_info.verify('full')
+        tree = self.load_snapshot() if snapshot else None
+        for _ in DigestEngine.ordered_map(self._check_file,self._files_to_check(quick,jobs,tree),jobs=jobs,processes=False):
+            pass
+        logging.debug("path caches: %s"%self.db.cache_stats())
+
+    def _files_to_check(self, quick: bool, jobs: int, tree: TreeSnapshot = None):
+        """arguments of _check_file for each file in the index, after checking the folder which contains it"""
+        shared_inodes = self.db.shared_inodes()
+        checked_inodes = set()
+        for root_id,root,files,dirs in self._walk(self.root_path,tree):
+            # the snapshot already has the index of each file, the index database is queried for it otherwise
+            entries = {f.name: (uid,f) for (uid,f) in files} if tree is not None else {}
+            digests = {f.name: f.digest for (uid,f) in files} if shared_inodes else {}
             # get rid of UIDs
             files = list(map(lambda x: x[1].name, files))
             dirs = list(map(lambda x: x[1].name, dirs))
@@ -438,12 +959,19 @@ class SqlArchive(Archive):
                 # check that the file exist
                 if sf not in fs_files:
                     raise FileNotFoundError(sf)
+                if shared_inodes:
+                    # another link to an inode already checked, with the same digest in DB
+                    inode = os.lstat(sf).st_ino
+                    if shared_inodes.get(inode) == digests[f]:
+                        if inode in checked_inodes:
+                            logging.debug('hardlink of a checked inode: '+str(sf))
+                            continue
+                        checked_inodes.add(inode)
                 # check its content match the digest in DB    
-                uid,dfi = self.db.file_from_path(sf)
-                self.check_file_integrity(sf,dfi)
+                yield (sf,quick,jobs,entries.get(f))
             
             for d in dirs:
                 sd = root / d
                 # check the directory exist in FS
                 if sd not in fs_dirs:
-                    raise DirectoryNotFoundError(sd)
\ No newline at end of file
+                    raise DirectoryNotFoundError(sd)
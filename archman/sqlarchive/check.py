@@ -1,35 +1,278 @@
 import os
-import hashlib
+import random
+import struct
+import logging
+from collections import namedtuple
+from typing import Iterable
+from typing import List
 
-from archman import FileIntegrityError 
+from archman import FileIntegrityError
+from archman.sqlarchive import params
+from archman.sqlarchive.digest import DigestEngine
+
+# geometry of a check file
+CheckLayout = namedtuple('CheckLayout', ['page_size','n_pages','group_size'])
 
 class RepairInfo(object):
-    def __init__(self, path, target_path, *, create = False):
+    """Redundant information to check and repair the index database
+
+    The check file holds one record per group of consecutive pages of the SQLite file:
+    the digest of each page of the group followed by the XOR of all its pages (the parity).
+    - a commit only refreshes the records of the groups it changed,
+    - opening an archive can verify a sample of the pages,
+    - a damaged page is rebuilt from the parity and the other pages of its group,
+      provided no other page of the group is damaged.
+    Check files written by older versions hold a single digest of the whole file:
+    they are verified as such and replaced at the next commit.
+    """
+    MAGIC = b'ARCHMANC'
+    VERSION = 2
+    # magic, version, page size, number of pages, pages per group
+    HEADER = struct.Struct('<8sIIQI')
+    DIGEST_SIZE = 32
+    VERIFY_MODES = ('full', 'sample', 'lazy')
+
+    def __init__(self, path, target_path, *, create = False, block_size = params.BLOCK_SIZE, verify = 'full'):
         self.path = path
         self.target_path = target_path
+        self.digest_engine = DigestEngine(algorithm='sha256', block_size=block_size)
+        self.legacy = False
 
         if not os.path.exists(target_path):
             raise FileNotFoundError(target_path)
-        
+
         if create:
             if os.path.exists(path):
                 raise FileExistsError(path)
-            with open(path,'wb') as fo:
-                with open(target_path,'rb') as fi:
-                    # dummy implementation: just compute sha256 over the whole file
-                    digest = hashlib.sha256(fi.read()).digest()
-                    fo.write(digest)
+            self.rebuild()
         else:
             if not os.path.exists(path):
                 raise FileNotFoundError(path)
+            self.verify(verify)
+
+    @staticmethod
+    def page_size_of(target_path) -> int:
+        """page size of a SQLite database, read from its header"""
+        with open(target_path,'rb') as f:
+            header = f.read(100)
+        if len(header) < 100 or header[0:16] != b'SQLite format 3\x00':
+            raise FileIntegrityError(f"{target_path} is not a SQLite database")
+        page_size = int.from_bytes(header[16:18],byteorder='big')
+        if page_size == 1:
+            page_size = 65536
+        return page_size
+
+    @staticmethod
+    def _record_size(layout: CheckLayout) -> int:
+        return layout.group_size * RepairInfo.DIGEST_SIZE + layout.page_size
+
+    @staticmethod
+    def _record_offset(layout: CheckLayout, k: int) -> int:
+        return RepairInfo.HEADER.size + k * RepairInfo._record_size(layout)
+
+    @staticmethod
+    def _digest_offset(layout: CheckLayout, no: int) -> int:
+        (k, i) = divmod(no - 1, layout.group_size)
+        return RepairInfo._record_offset(layout, k) + i * RepairInfo.DIGEST_SIZE
+
+    @staticmethod
+    def _parity_offset(layout: CheckLayout, k: int) -> int:
+        return RepairInfo._record_offset(layout, k) + layout.group_size * RepairInfo.DIGEST_SIZE
+
+    @staticmethod
+    def _n_groups(layout: CheckLayout) -> int:
+        return (layout.n_pages + layout.group_size - 1) // layout.group_size
+
+    @staticmethod
+    def _xor(pages: Iterable[bytes], page_size: int) -> bytes:
+        acc = 0
+        for data in pages:
+            acc ^= int.from_bytes(data,byteorder='little')
+        return acc.to_bytes(page_size,byteorder='little')
+
+    def _page_digest(self, no: int, data: bytes) -> bytes:
+        # the page number is digested too so that swapped pages are detected
+        h = self.digest_engine.new()
+        h.update(no.to_bytes(8,byteorder='little'))
+        h.update(data)
+        return h.digest()
+
+    def _read_page(self, fd, layout: CheckLayout, no: int) -> bytes:
+        return os.pread(fd.fileno(), layout.page_size, (no - 1) * layout.page_size)
+
+    def _read_group(self, fd, layout: CheckLayout, k: int) -> List[tuple]:
+        """(page number, data) of the pages of group k"""
+        first = k * layout.group_size + 1
+        last = min(first + layout.group_size, layout.n_pages + 1)
+        data = os.pread(fd.fileno(), (last - first) * layout.page_size, (first - 1) * layout.page_size)
+        return [(no, data[(no - first) * layout.page_size:(no - first + 1) * layout.page_size]) for no in range(first, last)]
+
+    def _read_header(self, fc) -> CheckLayout:
+        size = os.fstat(fc.fileno()).st_size
+        if size == RepairInfo.DIGEST_SIZE:
+            # written by an older version
+            return None
+        header = os.pread(fc.fileno(), RepairInfo.HEADER.size, 0)
+        if len(header) != RepairInfo.HEADER.size:
+            raise FileIntegrityError(f"{self.path}: truncated header")
+        (magic, version, page_size, n_pages, group_size) = RepairInfo.HEADER.unpack(header)
+        if magic != RepairInfo.MAGIC or version != RepairInfo.VERSION or page_size == 0 or group_size == 0:
+            raise FileIntegrityError(f"{self.path}: bad header")
+        layout = CheckLayout(page_size, n_pages, group_size)
+        if size != RepairInfo._record_offset(layout, RepairInfo._n_groups(layout)):
+            raise FileIntegrityError(f"{self.path}: size {size} does not match its number of pages {n_pages}")
+        return layout
+
+    def _verify_legacy(self):
+        digest = self.digest_engine.digest_file(self.target_path)
+        with open(self.path,'rb') as fi:
+            ref_digest = fi.read()
+        if digest != ref_digest:
+            raise FileIntegrityError(f"{self.path} vs {self.target_path} digest mismatch:\nreference digest: {ref_digest}\nactual digest: {digest}.")
+
+    def damaged_pages(self, mode = 'full') -> List[int]:
+        """numbers of the pages of the target which do not match the check file
+
+        mode is one of:
+        - 'full': all pages are checked
+        - 'sample': the first, the last and params.DB_CHECK_SAMPLES random pages are checked
+        - 'lazy': only the size of the target is checked
+        A target whose size changed cannot be checked page by page and raises FileIntegrityError,
+        so does a mismatch with a check file written by an older version.
+        """
+        if mode not in RepairInfo.VERIFY_MODES:
+            raise ValueError("unknown verify mode '%s'"%mode)
+        with open(self.path,'rb') as fc:
+            layout = self._read_header(fc)
+            if layout is None:
+                self.legacy = True
+                self._verify_legacy()
+                return []
+            target_size = os.path.getsize(self.target_path)
+            if target_size != layout.page_size * layout.n_pages:
+                raise FileIntegrityError(f"{self.path} vs {self.target_path} size mismatch:\nreference size: {layout.page_size * layout.n_pages}\nactual size: {target_size}.")
+            if mode == 'full':
+                pages = range(1, layout.n_pages + 1)
+            elif mode == 'sample':
+                pages = set([1, layout.n_pages])
+                pages.update(random.sample(range(1, layout.n_pages + 1), min(layout.n_pages, params.DB_CHECK_SAMPLES)))
+                pages = sorted(pages)
+            else:
+                pages = []
+            damaged = []
+            with open(self.target_path,'rb') as fd:
+                for no in pages:
+                    digest = self._page_digest(no, self._read_page(fd, layout, no))
+                    ref_digest = os.pread(fc.fileno(), RepairInfo.DIGEST_SIZE, RepairInfo._digest_offset(layout, no))
+                    if digest != ref_digest:
+                        damaged.append(no)
+            return damaged
+
+    def verify(self, mode = 'full'):
+        """check the target against the check file, see damaged_pages for mode"""
+        damaged = self.damaged_pages(mode)
+        if damaged:
+            raise FileIntegrityError(f"{self.path} vs {self.target_path} digest mismatch on pages {damaged}.")
+
+    def rebuild(self):
+        """write the check file from scratch"""
+        page_size = RepairInfo.page_size_of(self.target_path)
+        layout = CheckLayout(page_size, os.path.getsize(self.target_path) // page_size, params.DB_PARITY_GROUP)
+        with open(self.path,'wb') as fo:
+            fo.write(RepairInfo.HEADER.pack(RepairInfo.MAGIC, RepairInfo.VERSION, layout.page_size, layout.n_pages, layout.group_size))
+            with open(self.target_path,'rb') as fd:
+                for k in range(RepairInfo._n_groups(layout)):
+                    fo.write(self._record(layout, self._read_group(fd, layout, k)))
+        self.legacy = False
+
+    def _record(self, layout: CheckLayout, group: List[tuple], digests: bytes = b'', dirty: set = None) -> bytes:
+        """record of a group: digests of its pages then their parity
+
+        Only the pages in dirty are digested, the digests of the other pages are taken from digests.
+        When dirty is None, all pages are digested.
+        """
+        record = bytearray(layout.group_size * RepairInfo.DIGEST_SIZE)
+        record[0:len(digests)] = digests
+        for (no, data) in group:
+            if dirty is None or no in dirty:
+                i = (no - 1) % layout.group_size
+                record[i * RepairInfo.DIGEST_SIZE:(i + 1) * RepairInfo.DIGEST_SIZE] = self._page_digest(no, data)
+        # slots past the last page are cleared
+        used = len(group) * RepairInfo.DIGEST_SIZE
+        record[used:] = bytes(len(record) - used)
+        record += RepairInfo._xor([data for (_, data) in group], layout.page_size)
+        return bytes(record)
+
+    def update(self, dirty_pages: Iterable[int]):
+        """refresh the records of the groups holding pages listed in dirty_pages or added since the last update
+
+        Only the pages of these groups are read. The pages of these groups that are not dirty
+        must still match their digests, otherwise the new parity would carry their damage.
+        """
+        if self.legacy:
+            self.rebuild()
+            return
+        with open(self.path,'r+b') as fc:
+            old = self._read_header(fc)
+            page_size = RepairInfo.page_size_of(self.target_path)
+            if page_size != old.page_size or old.group_size != params.DB_PARITY_GROUP:
+                fc.close()
+                self.rebuild()
+                return
+            layout = CheckLayout(page_size, os.path.getsize(self.target_path) // page_size, old.group_size)
+            pages = set([no for no in dirty_pages if no <= layout.n_pages])
+            pages.update(range(old.n_pages + 1, layout.n_pages + 1))
+            groups = set([(no - 1) // layout.group_size for no in pages])
+            if layout.n_pages < old.n_pages and layout.n_pages % layout.group_size:
+                # the last group lost some pages
+                groups.add((layout.n_pages - 1) // layout.group_size)
+            groups = sorted(groups)
+            with open(self.target_path,'rb') as fd:
+                for k in groups:
+                    for (no, data) in self._read_group(fd, layout, k):
+                        if no in pages or no > old.n_pages:
+                            continue
+                        ref_digest = os.pread(fc.fileno(), RepairInfo.DIGEST_SIZE, RepairInfo._digest_offset(old, no))
+                        if self._page_digest(no, data) != ref_digest:
+                            raise FileIntegrityError(f"{self.target_path}: page {no} is damaged, repair the index before committing")
+                for k in groups:
+                    digests = b''
+                    if k < RepairInfo._n_groups(old):
+                        digests = os.pread(fc.fileno(), layout.group_size * RepairInfo.DIGEST_SIZE, RepairInfo._record_offset(old, k))
+                    record = self._record(layout, self._read_group(fd, layout, k), digests, pages)
+                    os.pwrite(fc.fileno(), record, RepairInfo._record_offset(layout, k))
+            fc.truncate(RepairInfo._record_offset(layout, RepairInfo._n_groups(layout)))
+            os.pwrite(fc.fileno(), RepairInfo.HEADER.pack(RepairInfo.MAGIC, RepairInfo.VERSION, layout.page_size, layout.n_pages, layout.group_size), 0)
+        logging.debug(f"{self.path}: {len(pages)} of {layout.n_pages} pages digested, {len(groups)} parity pages computed")
+
+    def repair(self, pages: Iterable[int] = None) -> List[int]:
+        """rebuild in place the damaged pages of the target and return their numbers
 
-            with open(target_path,'rb') as fi:
-                # dummy implementation: just compute sha256 over the whole file
-                digest = hashlib.sha256(fi.read()).digest()
-            
-            with open(path,'rb') as fi:
-                ref_digest = fi.read()
-            
-            if digest != ref_digest:
-                raise FileIntegrityError(f"{path} vs {target_path} digest mismatch:\nreference digest: {ref_digest}\nactual digest: {digest}.")
-            
\ No newline at end of file
+        When pages is None, all pages are checked to find the damaged ones.
+        Only the groups holding damaged pages are read.
+        """
+        with open(self.path,'rb') as fc:
+            layout = self._read_header(fc)
+        if layout is None:
+            raise FileIntegrityError(f"{self.path} was written by an older version and holds no parity, {self.target_path} cannot be repaired")
+        if pages is None:
+            pages = self.damaged_pages('full')
+        pages = sorted(set(pages))
+        groups = {}
+        for no in pages:
+            groups.setdefault((no - 1) // layout.group_size, []).append(no)
+        for (k, nos) in groups.items():
+            if len(nos) > 1:
+                raise FileIntegrityError(f"{self.target_path}: pages {nos} are damaged, at most one page per group of {layout.group_size} can be repaired")
+        with open(self.path,'rb') as fc:
+            with open(self.target_path,'r+b') as fd:
+                for (k, [no]) in sorted(groups.items()):
+                    parity = os.pread(fc.fileno(), layout.page_size, RepairInfo._parity_offset(layout, k))
+                    others = [data for (n, data) in self._read_group(fd, layout, k) if n != no]
+                    data = RepairInfo._xor([parity] + others, layout.page_size)
+                    ref_digest = os.pread(fc.fileno(), RepairInfo.DIGEST_SIZE, RepairInfo._digest_offset(layout, no))
+                    if self._page_digest(no, data) != ref_digest:
+                        raise FileIntegrityError(f"{self.target_path}: page {no} cannot be repaired, its parity or the check file is damaged too")
+                    os.pwrite(fd.fileno(), data, (no - 1) * layout.page_size)
+                    logging.info(f"{self.target_path}: page {no} repaired")
+        return pages
@@ -1,18 +1,26 @@
 import sqlite3
 from sqlite3 import Error
 import os
+import struct
+import itertools
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Generator
 from typing import Tuple
 from typing import Iterator
+from typing import List
 from archman.sqlarchive import params
 import logging
 class DbUtils(object):
     @staticmethod
-    def create_connection(db_file, *, create = False):
+    def create_connection(db_file, *, create = False, read_only = False):
         """ create a database connection to the SQLite database
             specified by db_file. Raise an error if the file don't exist
         :param db_file: database file
+        :param read_only: open the file read-only, the connection can then be used from any thread (one at a time)
         :return: Connection object or None
         """
         if not os.path.exists(db_file):
@@ -21,9 +29,33 @@ class DbUtils(object):
         else:
             if create:
                 raise FileExistsError(db_file)
-        conn = sqlite3.connect(db_file)
+        if read_only:
+            uri = Path(db_file).resolve().as_uri() + '?mode=ro'
+            return sqlite3.connect(uri, uri=True, timeout=params.DB_BUSY_TIMEOUT, check_same_thread=False, cached_statements=params.DB_STATEMENT_CACHE)
+        conn = sqlite3.connect(db_file, timeout=params.DB_BUSY_TIMEOUT, cached_statements=params.DB_STATEMENT_CACHE)
         return conn
 
+    @staticmethod
+    def release_wal(db_file):
+        """remove the empty WAL and its shared memory file left by read-only connections to db_file
+
+        A read-only connection cannot remove them when it closes, the last read-write one does:
+        one without changes is opened and closed, it does nothing while other connections are open.
+        A WAL holding pages is left to the writer, whose check file does not cover them yet.
+        """
+        wal = str(db_file) + '-wal'
+        if not os.path.exists(wal) or os.path.getsize(wal) > 0:
+            return
+        try:
+            conn = sqlite3.connect(db_file, timeout=0)
+            try:
+                conn.execute("PRAGMA schema_version").fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            # a read-only file system or a writer holding a lock, the files are harmless
+            logging.debug("cannot remove the WAL of '%s': %s"%(db_file,e))
+
     @staticmethod
     def create_table(conn, create_table_sql):
         """ create a table from the create_table_sql statement
@@ -40,31 +72,23 @@ class DbUtils(object):
 
     
     def _results(self, cursor, item=None):
-        cur = cursor
-        while True:
-            res = cur.fetchmany(200)
-            if not res:
-                break
-            for r in res:
-                if item is None:
-                    yield r
-                else:
-                    yield r[item]
+        # the cursor fetches rows in batches itself
+        if item is None:
+            return cursor
+        return (r[item] for r in cursor)
+
+    # one statement per table, so the connection reuses its prepared statement
+    _from_uid_sql = {}
 
     def _get_from_uid(self, table, uid):
-        cur = self.conn.cursor()
         if uid is None:
             return None
-        sql = '''SELECT * FROM %s WHERE UID = ?'''%table
-        args = (uid,)
-        cur.execute(sql,args)
-        res = list(self._results(cur))
-        if len(res) != 1:
-            raise Exception()
-        r  = res[0]
-        uid2 = r[0]
-        if uid != uid2:
-            raise Exception()
+        sql = DbUtils._from_uid_sql.get(table)
+        if sql is None:
+            sql = DbUtils._from_uid_sql[table] = '''SELECT * FROM %s WHERE UID = ?'''%table
+        r = self.conn.execute(sql,(uid,)).fetchone()
+        if r is None:
+            raise Exception("no row with UID %d in table %s"%(uid,table))
         return r
 
     def _enum_distinct(self,table,field):
@@ -74,7 +98,41 @@ class DbUtils(object):
         return self._results(cur,0)
 
 
+class LruCache(object):
+    """Bounded mapping dropping the least recently used entries, with hit and miss counters"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """cached value of key, None when it is not cached"""
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses}
+
 class FolderIndex(object):
+    __slots__ = ('parent_id', 'name', 'mode')
 
     def __init__(self, *, parent_id=None, name=None, mode=None):
         self.parent_id = parent_id
@@ -82,30 +140,76 @@ class FolderIndex(object):
         self.mode = mode
 
 class FileIndex(object):
+    __slots__ = ('parent_id', 'name', 'digest', 'mode', 'algorithm', 'chunk_size', 'merkle_root', 'size', 'mtime_ns', 'ctime_ns', 'inode')
 
-    def __init__(self, *, parent_id=None, name=None, digest=None, mode=None):
+    def __init__(self, *, parent_id=None, name=None, digest=None, mode=None, size=None, mtime_ns=None, ctime_ns=None, inode=None, algorithm=params.DEFAULT_ALGORITHM, chunk_size=None, merkle_root=None):
         self.parent_id = parent_id
         self.name = name
         self.digest = digest
         self.mode = mode
+        # algorithm used to compute digest
+        self.algorithm = algorithm
+        # size of the chunks digested in the chunks table and root of their hash tree, None when there are no chunks
+        self.chunk_size = chunk_size
+        self.merkle_root = merkle_root
+        # stat signature of the file within the archive, None for files indexed by older versions
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.ctime_ns = ctime_ns
+        self.inode = inode
+
+    @staticmethod
+    def stat_signature_of(st: os.stat_result) -> Tuple[int,int,int,int]:
+        return (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+
+    def stat_signature(self) -> Tuple[int,int,int,int]:
+        return (self.size, self.mtime_ns, self.ctime_ns, self.inode)
+
+    def set_stat(self, st: os.stat_result):
+        (self.size, self.mtime_ns, self.ctime_ns, self.inode) = FileIndex.stat_signature_of(st)
 
 
 class IndexDb(DbUtils):
+    # stored in 'PRAGMA user_version', databases with an older version are upgraded when opened
+    SCHEMA_VERSION = 7
 
-    def __init__(self, path:str, *,root:str, create = False):
+    def __init__(self, path:str, *,root:str, create = False, read_only = False):
+        """index database at path, see ReaderPool about read_only"""
         self.path = path
+        self.read_only = read_only
         self.root = Path(root).resolve()
+        # set when opening changed the schema of an existing database
+        self.upgraded = False
+        # relative path parts of a folder -> UID and UID -> path of a folder,
+        # cleared whenever a folder is renamed, moved or deleted
+        self.folder_uid_cache = LruCache(params.PATH_CACHE_SIZE)
+        self.folder_path_cache = LruCache(params.PATH_CACHE_SIZE)
+        # rows buffered in bulk mode, None otherwise
+        self._bulk_files = None
+        self._bulk_chunks = None
+        self._bulk_totals = None
+        self._next_file_uid = None
 
         # create a database connection
-        self.conn = DbUtils.create_connection(path,create=create)
+        self.conn = DbUtils.create_connection(path,create=create,read_only=read_only)
         if self.conn is None:
             raise RuntimeError("cannot connect to database '%s'"%path)
+        if read_only:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != IndexDb.SCHEMA_VERSION:
+                raise RuntimeError("database '%s' has schema version %d, open it for writing once to upgrade it to %d"%(path,version,IndexDb.SCHEMA_VERSION))
+            # changes when another connection commits, see _sync_path_caches
+            self._data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            return
+        self._set_wal_mode(create)
 
         DbUtils.create_table(self.conn, """ CREATE TABLE IF NOT EXISTS folders (
                                             UID integer PRIMARY KEY,
                                             PARENT_UID integer,
                                             NAME text NOT NULL,
                                             MODE integer NOT NULL,
+                                            TOTAL_SIZE integer NOT NULL DEFAULT 0,
+                                            TOTAL_FILES integer NOT NULL DEFAULT 0,
                                             FOREIGN KEY (PARENT_UID) REFERENCES folders (UID) ON DELETE RESTRICT
                                         ); """)
 
@@ -115,9 +219,17 @@ class IndexDb(DbUtils):
                                             NAME text NOT NULL,
                                             DIGEST blob NOT NULL,
                                             MODE integer NOT NULL,
+                                            SIZE integer,
+                                            MTIME_NS integer,
+                                            CTIME_NS integer,
+                                            INODE integer,
+                                            ALGO text NOT NULL DEFAULT 'sha256',
+                                            CHUNK_SIZE integer,
+                                            MERKLE_ROOT blob,
                                             FOREIGN KEY (PARENT_UID) REFERENCES folders (UID) ON DELETE RESTRICT
                                         ); """)
         
+        # inodes shared by several files of the archive (hardlinks), with the digest of their content
         DbUtils.create_table(self.conn, """ CREATE TABLE IF NOT EXISTS inodes (
                                             UID integer PRIMARY KEY,
                                             NO integer NOT NULL,
@@ -135,6 +247,21 @@ class IndexDb(DbUtils):
                                             FOREIGN KEY (INODE_UID) REFERENCES inodes (UID) ON DELETE RESTRICT
                                         ); """)
         
+        DbUtils.create_table(self.conn, """ CREATE TABLE IF NOT EXISTS chunks (
+                                            FILE_UID integer NOT NULL,
+                                            NO integer NOT NULL,
+                                            DIGEST blob NOT NULL,
+                                            PRIMARY KEY (FILE_UID, NO),
+                                            FOREIGN KEY (FILE_UID) REFERENCES files (UID) ON DELETE RESTRICT
+                                        ) WITHOUT ROWID; """)
+        
+        DbUtils.create_table(self.conn, """ CREATE TABLE IF NOT EXISTS settings (
+                                            NAME text PRIMARY KEY,
+                                            VALUE text NOT NULL
+                                        ); """)
+        
+        self._upgrade(create)
+
         if create:
             # create the root directory
             dfi = FolderIndex(
@@ -144,34 +271,368 @@ class IndexDb(DbUtils):
             self.add_folder(dfi)
             self.commit()
     
+    @staticmethod
+    def needs_upgrade(path: str) -> bool:
+        """whether opening the database at path for writing would change its schema or journal mode"""
+        conn = DbUtils.create_connection(path,read_only=True)
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        finally:
+            conn.close()
+            DbUtils.release_wal(path)
+        return version != IndexDb.SCHEMA_VERSION or journal_mode != 'wal'
+
+    def _columns(self, table):
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA table_info(%s)"%table)
+        return [r[1] for r in self._results(cur)]
+
+    def _upgrade(self, create):
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA user_version")
+        version = cur.fetchone()[0]
+        if version > IndexDb.SCHEMA_VERSION:
+            raise RuntimeError("database '%s' has schema version %d, this version of archman supports up to %d"%(self.path,version,IndexDb.SCHEMA_VERSION))
+        if version == IndexDb.SCHEMA_VERSION:
+            return
+        if version < 1:
+            # stat signature of files
+            columns = self._columns("files")
+            for column in ["SIZE","MTIME_NS","CTIME_NS","INODE"]:
+                if column not in columns:
+                    cur.execute("ALTER TABLE files ADD COLUMN %s integer"%column)
+        if version < 2:
+            # digest algorithm of each file, all files indexed so far used sha256
+            if "ALGO" not in self._columns("files"):
+                cur.execute("ALTER TABLE files ADD COLUMN ALGO text NOT NULL DEFAULT 'sha256'")
+        if version < 3:
+            # chunk digests, the chunks table itself is created above
+            columns = self._columns("files")
+            if "CHUNK_SIZE" not in columns:
+                cur.execute("ALTER TABLE files ADD COLUMN CHUNK_SIZE integer")
+            if "MERKLE_ROOT" not in columns:
+                cur.execute("ALTER TABLE files ADD COLUMN MERKLE_ROOT blob")
+        if version < 4:
+            # names are unique within a folder, the indexes also serve path resolution and listing
+            for table in ["folders","files"]:
+                cur.execute("SELECT PARENT_UID, NAME FROM %s GROUP BY PARENT_UID, NAME HAVING COUNT(*) > 1 LIMIT 1"%table)
+                r = cur.fetchone()
+                if r is not None:
+                    raise RuntimeError("database '%s' has several %s named '%s' in folder %d"%(self.path,table,r[1],r[0]))
+                cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS %s_parent_name ON %s (PARENT_UID, NAME)"%(table,table))
+        if version < 5:
+            # files with the same content
+            cur.execute("CREATE INDEX IF NOT EXISTS files_digest ON files (ALGO, DIGEST)")
+        if version < 6:
+            # size and number of files of each folder with all its sub folders
+            columns = self._columns("folders")
+            for column in ["TOTAL_SIZE","TOTAL_FILES"]:
+                if column not in columns:
+                    cur.execute("ALTER TABLE folders ADD COLUMN %s integer NOT NULL DEFAULT 0"%column)
+            self._backfill_sizes()
+            self.compute_totals()
+        if version < 7:
+            # hardlinked files, those created by dedup so far share their inode and their digest
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS inodes_no ON inodes (NO)")
+            cur.execute("CREATE INDEX IF NOT EXISTS files_inode ON files (INODE)")
+            cur.execute(''' INSERT OR IGNORE INTO inodes(NO,DIGEST)
+                        SELECT INODE, MIN(DIGEST) FROM files WHERE INODE IS NOT NULL
+                        GROUP BY INODE HAVING COUNT(*) > 1 AND COUNT(DISTINCT DIGEST) = 1 ''')
+        cur.execute("PRAGMA user_version = %d"%IndexDb.SCHEMA_VERSION)
+        self.conn.commit()
+        if not create:
+            logging.info("database '%s' upgraded from schema version %d to %d"%(self.path,version,IndexDb.SCHEMA_VERSION))
+            self.upgraded = True
+
+    def _backfill_sizes(self):
+        # files indexed before version 1 have no size, it is read from their copy in the archive
+        cur = self.conn.cursor()
+        sizes = []
+        for (uid,) in cur.execute("SELECT UID FROM files WHERE SIZE IS NULL").fetchall():
+            path = self.path_from_file_uid(uid)
+            try:
+                sizes.append((os.lstat(path).st_size, uid))
+            except FileNotFoundError:
+                logging.warning("'%s' is missing, its size is not counted in the totals of its folders"%path)
+        cur.executemany("UPDATE files SET SIZE = ? WHERE UID = ?", sizes)
+
+    def _set_wal_mode(self, create):
+        # pages written by a transaction stay in the WAL until checkpoint(),
+        # so wal_pages() tells which pages of the database file the check file must refresh
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA wal_autocheckpoint = 0")
+        cur.execute("PRAGMA journal_mode")
+        if cur.fetchone()[0] != 'wal':
+            cur.execute("PRAGMA journal_mode = WAL")
+            if not create:
+                logging.info("database '%s' switched to WAL mode"%self.path)
+                self.upgraded = True
+
     def commit(self):
+        self.flush()
         self.conn.commit() 
 
+    def rollback(self):
+        """discard the changes made since the last commit"""
+        self.conn.rollback()
+        # the caches may hold folders of the discarded changes
+        self._clear_path_caches()
+
+    @contextmanager
+    def savepoint(self):
+        """discard the changes made within the block if it fails, keeping the ones made before it"""
+        self.flush()
+        # releasing the outermost savepoint would commit, the block is nested in a transaction
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        self.conn.execute("SAVEPOINT block")
+        try:
+            yield self
+            self.flush()
+        except BaseException:
+            self.conn.execute("ROLLBACK TO block")
+            self.conn.execute("RELEASE block")
+            self._clear_path_caches()
+            raise
+        self.conn.execute("RELEASE block")
+
+    @contextmanager
+    def bulk_ingest(self):
+        """buffer the files added within the block and write them with the settings of params.BULK_PRAGMAS
+
+        Files are written by batches of params.BULK_BATCH rows. The previous settings are restored
+        when the block ends, whether it fails or not, before the block is committed by commit().
+        Buffered files are not visible to queries until they are flushed.
+        """
+        cur = self.conn.cursor()
+        saved = {}
+        for (name,value) in params.BULK_PRAGMAS.items():
+            cur.execute("PRAGMA %s"%name)
+            saved[name] = cur.fetchone()[0]
+            cur.execute("PRAGMA %s = %s"%(name,value))
+        # UIDs are given before the rows are written so that chunks can refer to them
+        cur.execute("SELECT IFNULL(MAX(UID),0) + 1 FROM files")
+        self._next_file_uid = cur.fetchone()[0]
+        self._bulk_files = []
+        self._bulk_chunks = []
+        self._bulk_totals = {}
+        try:
+            yield self
+            self.flush()
+        finally:
+            self._bulk_files = None
+            self._bulk_chunks = None
+            self._bulk_totals = None
+            for (name,value) in saved.items():
+                cur.execute("PRAGMA %s = %s"%(name,value))
+
+    def flush(self):
+        """write the rows buffered in bulk mode"""
+        if not self._bulk_files:
+            return
+        cur = self.conn.cursor()
+        cur.executemany(''' INSERT INTO files(UID,PARENT_UID,NAME,DIGEST,MODE,SIZE,MTIME_NS,CTIME_NS,INODE,ALGO,CHUNK_SIZE,MERKLE_ROOT)
+              VALUES(?,?,?,?,?,?,?,?,?,?,?,?) ''', self._bulk_files)
+        cur.executemany(''' INSERT INTO chunks(FILE_UID,NO,DIGEST) VALUES(?,?,?)''', self._bulk_chunks)
+        self._bulk_files.clear()
+        self._bulk_chunks.clear()
+        for (folder_uid,(size,count)) in self._bulk_totals.items():
+            self._add_to_totals(folder_uid,size,count)
+        self._bulk_totals.clear()
+
+    def cache_stats(self) -> dict:
+        """hit and miss counters of the path caches, see params.PATH_CACHE_SIZE"""
+        return {'folder_uid': self.folder_uid_cache.stats(), 'folder_path': self.folder_path_cache.stats()}
+
+    def _clear_path_caches(self):
+        self.folder_uid_cache.clear()
+        self.folder_path_cache.clear()
+
+    def _sync_path_caches(self):
+        # a read-only connection does not see the folders renamed by the writer, only that the database changed
+        if not self.read_only:
+            return
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self._clear_path_caches()
+
+    def close(self):
+        self.conn.close()
+        if self.read_only:
+            DbUtils.release_wal(self.path)
+
+    # WAL file format, see https://www.sqlite.org/fileformat.html#the_write_ahead_log
+    WAL_HEADER = struct.Struct('>IIIIIIII')
+    WAL_FRAME_HEADER = struct.Struct('>IIIIII')
+    WAL_MAGIC = (0x377f0682, 0x377f0683)
+
+    def wal_pages(self) -> set:
+        """numbers of the pages written in the WAL since the last checkpoint"""
+        pages = set()
+        try:
+            f = open(str(self.path) + '-wal','rb')
+        except FileNotFoundError:
+            return pages
+        with f:
+            header = f.read(IndexDb.WAL_HEADER.size)
+            if len(header) < IndexDb.WAL_HEADER.size:
+                return pages
+            (magic, _, page_size, _, salt1, salt2, _, _) = IndexDb.WAL_HEADER.unpack(header)
+            if magic not in IndexDb.WAL_MAGIC:
+                raise RuntimeError("bad WAL header in '%s-wal'"%self.path)
+            while True:
+                frame = f.read(IndexDb.WAL_FRAME_HEADER.size)
+                if len(frame) < IndexDb.WAL_FRAME_HEADER.size:
+                    break
+                (no, _, s1, s2, _, _) = IndexDb.WAL_FRAME_HEADER.unpack(frame)
+                if (s1, s2) != (salt1, salt2):
+                    # left over from before the last reset of the WAL
+                    break
+                pages.add(no)
+                f.seek(page_size, os.SEEK_CUR)
+        return pages
+
+    def checkpoint(self) -> bool:
+        """write the content of the WAL to the database file and empty the WAL
+
+        Readers still on an older snapshot are waited for up to params.DB_BUSY_TIMEOUT seconds.
+        Return False if some remain: the WAL may then be only partly written to the database file,
+        it is kept and its pages are reported again by wal_pages() until a checkpoint completes.
+        """
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        (busy, _, _) = cur.fetchone()
+        return not busy
+
+    # columns read by _file_from_row and _folder_from_row, in their order
+    FILE_COLUMNS = 'UID, PARENT_UID, NAME, DIGEST, MODE, SIZE, MTIME_NS, CTIME_NS, INODE, ALGO, CHUNK_SIZE, MERKLE_ROOT'
+    FOLDER_COLUMNS = 'UID, PARENT_UID, NAME, MODE'
+
+    @staticmethod
+    def _file_from_row(r) -> FileIndex:
+        # positional unpacking, without the keyword arguments of the constructor
+        o = FileIndex.__new__(FileIndex)
+        (_, o.parent_id, o.name, o.digest, o.mode, o.size, o.mtime_ns, o.ctime_ns, o.inode, o.algorithm, o.chunk_size, o.merkle_root) = r
+        return o
+
+    @staticmethod
+    def _folder_from_row(r) -> FolderIndex:
+        o = FolderIndex.__new__(FolderIndex)
+        (_, o.parent_id, o.name, o.mode) = r
+        return o
+
+    def get_setting(self, name, default=None):
+        cur = self.conn.cursor()
+        cur.execute('''SELECT VALUE FROM settings WHERE NAME = ?''',(name,))
+        r = cur.fetchone()
+        if r is None:
+            return default
+        return r[0]
+
+    def set_setting(self, name, value):
+        cur = self.conn.cursor()
+        cur.execute(''' INSERT INTO settings(NAME,VALUE) VALUES(?,?)
+                    ON CONFLICT(NAME) DO UPDATE SET VALUE = excluded.VALUE ''', (name,value))
+
+    FILE_FROM_UID_SQL = 'SELECT ' + FILE_COLUMNS + ' FROM files WHERE UID = ?'
+    FOLDER_FROM_UID_SQL = 'SELECT ' + FOLDER_COLUMNS + ' FROM folders WHERE UID = ?'
+
     def file_from_uid(self, uid):
         if uid is None:
             return None
-        r=self._get_from_uid("files", uid)
-        return FileIndex(parent_id=r[1], name=r[2], digest=r[3], mode=r[4])
+        r = self.conn.execute(IndexDb.FILE_FROM_UID_SQL,(uid,)).fetchone()
+        if r is None:
+            raise Exception("no row with UID %d in table files"%uid)
+        return self._file_from_row(r)
 
     def folder_from_uid(self, uid):
         if uid is None:
             return None
-        r=self._get_from_uid("folders", uid)
-        return FolderIndex(parent_id=r[1], name=r[2], mode=r[3])
+        r = self.conn.execute(IndexDb.FOLDER_FROM_UID_SQL,(uid,)).fetchone()
+        if r is None:
+            raise Exception("no row with UID %d in table folders"%uid)
+        return self._folder_from_row(r)
+
+    def _add_to_totals(self, folder_uid, size, count):
+        """add size and count to the totals of a folder and of all its ancestors"""
+        if folder_uid is None or (size == 0 and count == 0):
+            return
+        cur = self.conn.cursor()
+        cur.execute(''' WITH RECURSIVE ancestors(UID) AS (
+                        SELECT ?
+                        UNION ALL
+                        SELECT folders.PARENT_UID FROM folders JOIN ancestors ON folders.UID = ancestors.UID
+                        WHERE folders.PARENT_UID IS NOT NULL
+                    )
+                    UPDATE folders SET TOTAL_SIZE = TOTAL_SIZE + ?, TOTAL_FILES = TOTAL_FILES + ?
+                    WHERE UID IN ancestors ''', (folder_uid,size,count))
+
+    def compute_totals(self):
+        """compute the totals of all folders from scratch"""
+        cur = self.conn.cursor()
+        cur.execute(''' CREATE TEMP TABLE IF NOT EXISTS folder_totals (UID integer PRIMARY KEY, SIZE integer, FILES integer) ''')
+        cur.execute(''' DELETE FROM folder_totals ''')
+        # each folder paired with itself and all its ancestors
+        cur.execute(''' WITH RECURSIVE ancestors(FOLDER_UID, UID) AS (
+                        SELECT UID, UID FROM folders
+                        UNION ALL
+                        SELECT ancestors.FOLDER_UID, folders.PARENT_UID FROM folders JOIN ancestors ON folders.UID = ancestors.UID
+                        WHERE folders.PARENT_UID IS NOT NULL
+                    )
+                    INSERT INTO folder_totals(UID,SIZE,FILES)
+                    SELECT ancestors.UID, SUM(IFNULL(files.SIZE,0)), COUNT(files.UID)
+                    FROM ancestors JOIN files ON files.PARENT_UID = ancestors.FOLDER_UID
+                    GROUP BY ancestors.UID ''')
+        cur.execute(''' UPDATE folders SET
+                        TOTAL_SIZE = IFNULL((SELECT SIZE FROM folder_totals WHERE folder_totals.UID = folders.UID),0),
+                        TOTAL_FILES = IFNULL((SELECT FILES FROM folder_totals WHERE folder_totals.UID = folders.UID),0) ''')
+        cur.execute(''' DELETE FROM folder_totals ''')
+
+    def folder_totals(self, folder_uid) -> Tuple[int,int]:
+        """size and number of files of a folder with all its sub folders"""
+        cur = self.conn.cursor()
+        cur.execute(''' SELECT TOTAL_SIZE, TOTAL_FILES FROM folders WHERE UID = ? ''', (folder_uid,))
+        return cur.fetchone()
 
-    def add_file(self, file: FileIndex):
+    def add_file(self, file: FileIndex, chunks: List[bytes] = None):
+        """add a file with the digests of its chunks, return its UID, see bulk_ingest"""
         args = (
             file.parent_id,
             file.name,
             file.digest,
             file.mode,
+            file.size,
+            file.mtime_ns,
+            file.ctime_ns,
+            file.inode,
+            file.algorithm,
+            file.chunk_size,
+            file.merkle_root,
             )
         if file.parent_id is None:
             raise ValueError("parent_id cannot be null")
         # TODO: check if it exist already
+        if self._bulk_files is not None:
+            uid = self._next_file_uid
+            self._next_file_uid += 1
+            self._bulk_files.append((uid,) + args)
+            (size,count) = self._bulk_totals.get(file.parent_id,(0,0))
+            self._bulk_totals[file.parent_id] = (size + (file.size or 0),count + 1)
+            if chunks:
+                self._bulk_chunks.extend((uid,no,digest) for (no,digest) in enumerate(chunks))
+            if len(self._bulk_files) >= params.BULK_BATCH:
+                self.flush()
+            return uid
         cur = self.conn.cursor()
-        cur.execute(''' INSERT INTO files(PARENT_UID,NAME,DIGEST,MODE)
-              VALUES(?,?,?,?) ''', args)
+        cur.execute(''' INSERT INTO files(PARENT_UID,NAME,DIGEST,MODE,SIZE,MTIME_NS,CTIME_NS,INODE,ALGO,CHUNK_SIZE,MERKLE_ROOT)
+              VALUES(?,?,?,?,?,?,?,?,?,?,?) ''', args)
+        uid = cur.lastrowid
+        if chunks:
+            self.set_chunks(uid,chunks)
+        self._add_to_totals(file.parent_id,file.size or 0,1)
+        return uid
     
     def update_file(self, uid: int, val: FileIndex):
         args = (
@@ -179,24 +640,104 @@ class IndexDb(DbUtils):
             val.name,
             val.digest,
             val.mode,
+            val.size,
+            val.mtime_ns,
+            val.ctime_ns,
+            val.inode,
+            val.algorithm,
+            val.chunk_size,
+            val.merkle_root,
             uid,
             )
         if val.parent_id is None:
             raise ValueError("parent_id cannot be null")
         cur = self.conn.cursor()
+        cur.execute(''' SELECT PARENT_UID, SIZE, INODE FROM files WHERE UID = ? ''', (uid,))
+        (old_parent_id,old_size,old_inode) = cur.fetchone()
+        if old_parent_id != val.parent_id or old_size != val.size:
+            self._add_to_totals(old_parent_id,-(old_size or 0),-1)
+            self._add_to_totals(val.parent_id,val.size or 0,1)
         cur.execute(''' UPDATE files 
                     SET 
                         PARENT_UID = ?,
                         NAME = ?,
                         DIGEST = ?,
-                        MODE = ?
+                        MODE = ?,
+                        SIZE = ?,
+                        MTIME_NS = ?,
+                        CTIME_NS = ?,
+                        INODE = ?,
+                        ALGO = ?,
+                        CHUNK_SIZE = ?,
+                        MERKLE_ROOT = ?
                     WHERE
                         UID = ? 
                ''', args)
+        if old_inode != val.inode:
+            self._prune_inodes([old_inode])
     
+    def files_to_redigest(self, algorithm, limit) -> Generator[Tuple[int,FileIndex],None,None]:
+        """at most limit files whose digest was not computed with algorithm"""
+        cur = self.conn.cursor()
+        cur.execute('SELECT ' + IndexDb.FILE_COLUMNS + ' FROM files WHERE ALGO != ? ORDER BY UID LIMIT ?',(algorithm,limit))
+        for r in self._results(cur):
+            yield (r[0], self._file_from_row(r))
+
     def delete_file(self, file_uid):
         cur = self.conn.cursor()
-        cur.execute(''' DELETE FROM files WHERE UID=%d'''%file_uid)
+        cur.execute(''' SELECT PARENT_UID, SIZE, INODE FROM files WHERE UID = ? ''', (file_uid,))
+        (parent_id,size,inode) = cur.fetchone()
+        self._add_to_totals(parent_id,-(size or 0),-1)
+        cur.execute(''' DELETE FROM chunks WHERE FILE_UID = ?''', (file_uid,))
+        cur.execute(''' DELETE FROM files WHERE UID = ?''', (file_uid,))
+        self._prune_inodes([inode])
+
+    def link_inode(self, inode: int, digest: bytes):
+        """record that several files share inode, whose content has digest"""
+        cur = self.conn.cursor()
+        cur.execute(''' INSERT INTO inodes(NO,DIGEST) VALUES(?,?)
+                    ON CONFLICT(NO) DO UPDATE SET DIGEST = excluded.DIGEST ''', (inode,digest))
+
+    def shared_inodes(self) -> dict:
+        """digest of each inode shared by several files"""
+        return dict(self.conn.execute(''' SELECT NO, DIGEST FROM inodes '''))
+
+    def files_with_digest(self, algorithm, digest) -> Generator[Tuple[int,FileIndex],None,None]:
+        """files whose content has digest with algorithm, found with the files_digest index"""
+        cur = self.conn.cursor()
+        cur.execute('SELECT ' + IndexDb.FILE_COLUMNS + ' FROM files WHERE ALGO = ? AND DIGEST = ? ORDER BY UID',(algorithm,digest))
+        for r in cur:
+            yield (r[0], self._file_from_row(r))
+
+    def files_with_inode(self, inode) -> List[int]:
+        """UIDs of the files indexed with inode, ordered by UID"""
+        return [r[0] for r in self.conn.execute(''' SELECT UID FROM files WHERE INODE = ? ORDER BY UID ''', (inode,))]
+
+    def hardlinks(self, file_uid) -> List[int]:
+        """UIDs of the files sharing the inode of file_uid, itself included, ordered by UID"""
+        cur = self.conn.cursor()
+        cur.execute(''' SELECT files.UID FROM files JOIN inodes ON inodes.NO = files.INODE
+                    WHERE files.INODE = (SELECT INODE FROM files WHERE UID = ?) ORDER BY files.UID ''', (file_uid,))
+        return [r[0] for r in cur] or [file_uid]
+
+    def _prune_inodes(self, inodes):
+        # an inode left with a single file is not shared anymore, its number may be reused by the file system.
+        # Only the inodes of the changed files are counted, with the files_inode index
+        self.conn.cursor().executemany(''' DELETE FROM inodes WHERE NO = ? AND (SELECT COUNT(*) FROM files WHERE INODE = ?) < 2 ''',
+            ((inode,inode) for inode in inodes if inode is not None))
+
+    def set_chunks(self, file_uid, chunks):
+        """replace the chunk digests of a file, chunks can be None to remove them"""
+        cur = self.conn.cursor()
+        cur.execute(''' DELETE FROM chunks WHERE FILE_UID = ?''', (file_uid,))
+        if chunks:
+            cur.executemany(''' INSERT INTO chunks(FILE_UID,NO,DIGEST) VALUES(?,?,?)''',
+                ((file_uid,no,digest) for (no,digest) in enumerate(chunks)))
+
+    def chunks(self, file_uid):
+        cur = self.conn.cursor()
+        cur.execute(''' SELECT DIGEST FROM chunks WHERE FILE_UID = ? ORDER BY NO''', (file_uid,))
+        return [r[0] for r in cur]
 
     def add_folder(self, f: FolderIndex):
         args = (
@@ -222,7 +763,11 @@ class IndexDb(DbUtils):
         if val.parent_id is None:
             if val.name != params.ROOT_DIR:
                 raise ValueError("parent_id cannot be null")
+        # the folder may be renamed or moved with all its descendants
+        self._clear_path_caches()
         cur = self.conn.cursor()
+        cur.execute(''' SELECT PARENT_UID, TOTAL_SIZE, TOTAL_FILES FROM folders WHERE UID = ? ''', (uid,))
+        (old_parent_id,size,count) = cur.fetchone()
         cur.execute(''' UPDATE folders
                     SET 
                         PARENT_UID = ?,
@@ -231,6 +776,9 @@ class IndexDb(DbUtils):
                     WHERE
                         UID = ? 
                ''', args)
+        if old_parent_id != val.parent_id:
+            self._add_to_totals(old_parent_id,-size,-count)
+            self._add_to_totals(val.parent_id,size,count)
     
     @staticmethod
     def file_filter(*, file=None, parent_id=None, name=None, digest=None, mode=None):
@@ -266,15 +814,13 @@ class IndexDb(DbUtils):
 
     def files(self, *, parent_id=None, name=None, digest=None, mode=None) -> Generator[Tuple[int,FileIndex],None,None]:
         cur = self.conn.cursor()
-        sql = '''SELECT * FROM files'''
+        sql = 'SELECT ' + IndexDb.FILE_COLUMNS + ' FROM files'
         (f,args) = self.file_filter(parent_id=parent_id, name=name, digest=digest, mode=mode)
         sql += f
         cur.execute(sql,args)
 
-        for r in self._results(cur):
-            uid = r[0]
-            o = FileIndex(parent_id=r[1], name=r[2], digest=r[3], mode=r[4])
-            yield (uid, o)
+        for r in cur:
+            yield (r[0], self._file_from_row(r))
 
     @staticmethod
     def folder_filter(*, folder=None, parent_id=None, name=None, mode=None):
@@ -305,88 +851,249 @@ class IndexDb(DbUtils):
 
     def folders(self, *, parent_id=None, name=None, mode=None) -> Generator[Tuple[int,FolderIndex],None,None]:
         cur = self.conn.cursor()
-        sql = '''SELECT * FROM folders'''
+        sql = 'SELECT ' + IndexDb.FOLDER_COLUMNS + ' FROM folders'
         (f,args) = self.folder_filter(parent_id=parent_id, name=name, mode=mode)
         sql += f
         cur.execute(sql,args)
 
-        for r in self._results(cur):
-            uid = r[0]
-            folder = FolderIndex(parent_id=r[1], name=r[2], mode=r[3])
-            yield (uid, folder)
+        for r in cur:
+            yield (r[0], self._folder_from_row(r))
+
+    def _folder_uid(self, parts: Tuple[str,...], path: Path) -> int:
+        if not parts:
+            return 1
+        uid = self.folder_uid_cache.get(parts)
+        if uid is not None:
+            return uid
+        parent_id = self._folder_uid(parts[:-1], path)
+        # one lookup in the folders_parent_name index
+        r = self.conn.execute('SELECT UID FROM folders WHERE PARENT_UID = ? AND NAME = ?',(parent_id,parts[-1])).fetchone()
+        if r is None:
+            raise Exception("folder '%s' not found in db, part: '%s'"%(path,parts[-1]))
+        uid = r[0]
+        self.folder_uid_cache.put(parts, uid)
+        return uid
 
     def folder_from_path(self, path) -> Tuple[int,FolderIndex]:
+        self._sync_path_caches()
         p = Path(path).resolve()
         pr = p.relative_to(self.root)
-        parent_id = 1
-        parent = None
-        for part in pr.parts:
-            children = self.folders(parent_id=parent_id)
-            found = False
-            for (uid,child) in children:
-                if part == child.name:
-                    parent_id = uid
-                    parent = child
-                    found = True
-                    break
-            if not found:
-                raise Exception("folder '%s' not found in db, part: '%s'"%(p,part))
-        if parent is None:
-            # happens for the root directory
-            parent = self.folder_from_uid(parent_id)
-        return (parent_id,parent)
+        uid = self._folder_uid(pr.parts, p)
+        return (uid,self.folder_from_uid(uid))
     
     def file_from_path(self, path: Path) -> Tuple[int,FileIndex]:
         (parent_id,parent) = self.folder_from_path(path.parent)
-        res = list(self.files(parent_id = parent_id, name = path.name))
-        assert len(res) == 1
-        return res[0]
+        r = self.conn.execute('SELECT ' + IndexDb.FILE_COLUMNS + ' FROM files WHERE PARENT_UID = ? AND NAME = ?',(parent_id,path.name)).fetchone()
+        assert r is not None
+        return (r[0], self._file_from_row(r))
 
     def path_from_folder_uid(self, folder_uid) -> Path:
-        part_id = folder_uid
-        parts = list()
-        while(part_id is not None):
-            di = self.folder_from_uid(part_id)
-            parts.append(di.name)
-            part_id = di.parent_id
-        path = Path(self.root)
-        for part in reversed(parts):
-            path = path.joinpath(part)
+        self._sync_path_caches()
+        return self._folder_path(folder_uid)
+
+    def _folder_path(self, folder_uid) -> Path:
+        path = self.folder_path_cache.get(folder_uid)
+        if path is not None:
+            return path
+        di = self.folder_from_uid(folder_uid)
+        if di.parent_id is None:
+            path = Path(self.root)
+        else:
+            path = self._folder_path(di.parent_id).joinpath(di.name)
+        self.folder_path_cache.put(folder_uid, path)
         return path
 
     def path_from_file_uid(self, file_uid) -> Path:
         fi = self.file_from_uid(file_uid)
-        path = self.path_from_folder_id(fi.parent_id)
+        path = self.path_from_folder_uid(fi.parent_id)
         path = path.joinpath(fi.name)
         return path
 
     def walk(self, path):
         (parent_id,parent) = self.folder_from_path(path)
         return self.walk_id(parent_id)
-    
-    def walk_id(self,parent_id):
-        files = list(self.files(parent_id = parent_id))
-        dirs = list(self.folders(parent_id = parent_id))
-        yield (parent_id,files,dirs)
-        for (id,dfi) in dirs:
-            yield from self.walk_id(id)
+
+    # folders below a folder with their paths relative to it
+    TREE_CTE = ''' WITH RECURSIVE tree(UID, PATH) AS (
+                        SELECT ?, ''
+                        UNION ALL
+                        SELECT folders.UID, CASE WHEN tree.PATH = '' THEN folders.NAME ELSE tree.PATH || '/' || folders.NAME END
+                        FROM folders JOIN tree ON folders.PARENT_UID = tree.UID
+                    ) '''
+    WALK_FOLDERS_SQL = TREE_CTE + ''' SELECT UID, PATH FROM tree ORDER BY PATH '''
+    WALK_DIRS_SQL = TREE_CTE + ''' SELECT tree.PATH, folders.UID, folders.PARENT_UID, folders.NAME, folders.MODE
+                    FROM tree JOIN folders ON folders.PARENT_UID = tree.UID ORDER BY tree.PATH, folders.NAME '''
+    WALK_FILES_SQL = TREE_CTE + ''' SELECT tree.PATH, files.UID, files.PARENT_UID, files.NAME, files.DIGEST, files.MODE, files.SIZE, files.MTIME_NS,
+                        files.CTIME_NS, files.INODE, files.ALGO, files.CHUNK_SIZE, files.MERKLE_ROOT
+                    FROM tree JOIN files ON files.PARENT_UID = tree.UID ORDER BY tree.PATH, files.NAME '''
+
+    def walk_id(self, parent_id) -> Iterator[Tuple[int,Path,list,list]]:
+        """(folder_id, path, files, dirs) for parent_id and each folder below it, a folder always comes before its content
+
+        The folders, their sub folders and their files are read by three queries sorted by folder path
+        and merged while they stream, so memory does not depend on the size of the tree.
+        """
+        base = self.path_from_folder_uid(parent_id)
+        def groups(sql):
+            cur = self.conn.cursor()
+            cur.execute(sql,(parent_id,))
+            return itertools.groupby(self._results(cur), key=lambda r: r[0])
+        cur = self.conn.cursor()
+        cur.execute(IndexDb.WALK_FOLDERS_SQL,(parent_id,))
+        dir_groups = groups(IndexDb.WALK_DIRS_SQL)
+        file_groups = groups(IndexDb.WALK_FILES_SQL)
+        next_dirs = next(dir_groups, None)
+        next_files = next(file_groups, None)
+        for (uid,path) in self._results(cur):
+            dirs = []
+            if next_dirs is not None and next_dirs[0] == path:
+                dirs = [(r[1], self._folder_from_row(r[1:])) for r in next_dirs[1]]
+                next_dirs = next(dir_groups, None)
+            files = []
+            if next_files is not None and next_files[0] == path:
+                files = [(r[1], self._file_from_row(r[1:])) for r in next_files[1]]
+                next_files = next(file_groups, None)
+            yield (uid, base.joinpath(path) if path else base, files, dirs)
+
+    # folders and files below a folder in depth first order, sub folders before files and both sorted by name:
+    # the queue of the recursion is ordered by KEY, the names from the top folder separated by char(1)
+    # and prefixed by 0 for folders and 1 for files, so an entry is extracted right after its parent
+    ENTRIES_CTE = ''' WITH RECURSIVE entries(KEY, DEPTH, UID, PARENT_UID, IS_DIR, NAME, PATH, MODE, SIZE, ALGO, DIGEST) AS (
+                        SELECT '', 0, ?, NULL, 1, '', '', NULL, NULL, NULL, NULL
+                        UNION ALL
+                        SELECT entries.KEY || char(1) || '0' || folders.NAME, entries.DEPTH + 1, folders.UID, folders.PARENT_UID, 1, folders.NAME,
+                            CASE WHEN entries.PATH = '' THEN folders.NAME ELSE entries.PATH || '/' || folders.NAME END,
+                            folders.MODE, folders.TOTAL_SIZE, NULL, NULL
+                        FROM entries JOIN folders ON folders.PARENT_UID = entries.UID WHERE entries.IS_DIR AND entries.DEPTH < ?
+                        UNION ALL
+                        SELECT entries.KEY || char(1) || '1' || files.NAME, entries.DEPTH + 1, files.UID, files.PARENT_UID, 0, files.NAME,
+                            CASE WHEN entries.PATH = '' THEN files.NAME ELSE entries.PATH || '/' || files.NAME END,
+                            files.MODE, files.SIZE, files.ALGO, files.DIGEST
+                        FROM entries JOIN files ON files.PARENT_UID = entries.UID WHERE entries.IS_DIR AND entries.DEPTH < ?
+                        ORDER BY 1
+                    ) '''
+    ENTRIES_SQL = ENTRIES_CTE + ''' SELECT DEPTH, IS_DIR, NAME, CASE WHEN IS_DIR
+                        THEN NOT EXISTS (SELECT 1 FROM folders WHERE PARENT_UID = entries.PARENT_UID AND NAME > entries.NAME)
+                            AND NOT EXISTS (SELECT 1 FROM files WHERE PARENT_UID = entries.PARENT_UID)
+                        ELSE NOT EXISTS (SELECT 1 FROM files WHERE PARENT_UID = entries.PARENT_UID AND NAME > entries.NAME) END
+                    FROM entries WHERE DEPTH > 0 '''
+    RECORDS_SQL = ENTRIES_CTE + ''' SELECT PATH, IS_DIR, MODE, SIZE, ALGO, DIGEST FROM entries WHERE DEPTH > 0 '''
+
+    def walk_entries(self, parent_id, max_depth: int = None) -> Iterator[Tuple[int,bool,str,bool]]:
+        """(depth, is_dir, name, last) of the folders and files below parent_id, depth first
+
+        Sub folders come before files, both sorted by name, last tells if an entry is the last one of its folder.
+        Depth is 1 for the content of parent_id, entries deeper than max_depth are not read.
+        A single query streams the entries, only the pending siblings of the current path are queued by SQLite.
+        """
+        for (depth,is_dir,name,last) in self._entries(IndexDb.ENTRIES_SQL, parent_id, max_depth):
+            yield (depth, bool(is_dir), name, bool(last))
+
+    def walk_records(self, parent_id, max_depth: int = None) -> Iterator[Tuple[str,bool,int,int,str,bytes]]:
+        """(path, is_dir, mode, size, algorithm, digest) of the folders and files below parent_id, in the order of walk_entries
+
+        Paths are relative to parent_id with '/' separators, the size of a folder is the total size of the files below it,
+        its algorithm and digest are None.
+        """
+        for (path,is_dir,mode,size,algorithm,digest) in self._entries(IndexDb.RECORDS_SQL, parent_id, max_depth):
+            yield (path, bool(is_dir), mode, size, algorithm, digest)
+
+    def _entries(self, sql, parent_id, max_depth):
+        if max_depth is None:
+            max_depth = 2**63 - 1
+        cur = self.conn.cursor()
+        cur.execute(sql,(parent_id,max_depth,max_depth))
+        return self._results(cur)
+
+    def duplicates(self, folder_uid) -> Iterator[List[Tuple[int,Path]]]:
+        """groups of (uid, path) of the files below folder_uid with the same digest, ordered by path
+
+        Groups are found with the files_digest index, without reading any file.
+        They are stored in a temporary table first, so the index can be modified while they are consumed.
+        """
+        base = self.path_from_folder_uid(folder_uid)
+        cur = self.conn.cursor()
+        cur.execute(''' CREATE TEMP TABLE IF NOT EXISTS duplicates (ALGO text, DIGEST blob, PATH text, FILE_UID integer) ''')
+        cur.execute(''' DELETE FROM duplicates ''')
+        cur.execute(IndexDb.TREE_CTE + ''' INSERT INTO duplicates(ALGO,DIGEST,PATH,FILE_UID)
+                    SELECT files.ALGO, files.DIGEST, CASE WHEN tree.PATH = '' THEN files.NAME ELSE tree.PATH || '/' || files.NAME END, files.UID
+                    FROM files JOIN tree ON files.PARENT_UID = tree.UID
+                    WHERE (files.ALGO, files.DIGEST) IN (SELECT ALGO, DIGEST FROM files GROUP BY ALGO, DIGEST HAVING COUNT(*) > 1) ''', (folder_uid,))
+        cur.execute(''' SELECT ALGO, DIGEST, PATH, FILE_UID FROM duplicates ORDER BY ALGO, DIGEST, PATH ''')
+        for (key,rows) in itertools.groupby(self._results(cur), key=lambda r: (r[0],r[1])):
+            group = [(r[3], base.joinpath(r[2])) for r in rows]
+            if len(group) > 1:
+                yield group
 
     def delete_folder(self, folder_uid):
-        # delete all files
-        args = (
-                folder_uid,
-                )
+        """delete a folder with all its files and sub folders, in a constant number of statements"""
+        self._clear_path_caches()
         cur = self.conn.cursor()
-        cur.execute(''' DELETE FROM files
+        cur.execute(''' SELECT PARENT_UID, TOTAL_SIZE, TOTAL_FILES FROM folders WHERE UID = ? ''', (folder_uid,))
+        (parent_id,size,count) = cur.fetchone()
+        self._add_to_totals(parent_id,-size,-count)
+        # the temporary table lives outside of the database file
+        cur.execute(''' CREATE TEMP TABLE IF NOT EXISTS deleted_folders (UID integer PRIMARY KEY) ''')
+        cur.execute(''' DELETE FROM deleted_folders ''')
+        cur.execute(''' WITH RECURSIVE subtree(UID) AS (
+                        SELECT ?
+                        UNION ALL
+                        SELECT folders.UID FROM folders JOIN subtree ON folders.PARENT_UID = subtree.UID
+                    )
+                    INSERT INTO deleted_folders(UID) SELECT UID FROM subtree ''', (folder_uid,))
+        cur.execute(''' DELETE FROM chunks
                     WHERE
-                        PARENT_UID = ? 
-                ''', args)
-        # delete all sub folders
-        for uid,dir in self.folders(parent_id=folder_uid):
-            self.delete_folder(uid)
-        # delete folder
-        cur.execute(''' DELETE FROM folders
-                    WHERE
-                        UID = ? 
-                ''', args)
-    
\ No newline at end of file
+                        FILE_UID IN (SELECT UID FROM files WHERE PARENT_UID IN deleted_folders)
+                ''')
+        cur.execute(''' SELECT DISTINCT files.INODE FROM files JOIN inodes ON inodes.NO = files.INODE WHERE files.PARENT_UID IN deleted_folders ''')
+        inodes = [r[0] for r in cur.fetchall()]
+        cur.execute(''' DELETE FROM files WHERE PARENT_UID IN deleted_folders ''')
+        cur.execute(''' DELETE FROM folders WHERE UID IN deleted_folders ''')
+        cur.execute(''' DELETE FROM deleted_folders ''')
+        self._prune_inodes(inodes)
+    
+
+class ReaderPool(object):
+    """Read-only connections to an index database, shared by the threads of a process
+
+    Locking semantics, the index is in WAL mode:
+    - there is a single writer, the IndexDb opened without read_only, used from the thread which opened it
+    - readers never block the writer's transactions nor each other, and are not blocked by them
+    - a reader sees the database as of its last committed transaction when a query starts,
+      it stays on that snapshot until the query has returned all its rows
+    - the checkpoint of a commit waits for the readers on older snapshots, up to params.DB_BUSY_TIMEOUT
+      seconds, see IndexDb.checkpoint
+    - readers in other processes follow the same rules
+    Each reader is given to one thread at a time by reader(), at most size of them at once.
+    """
+
+    def __init__(self, path: str, *, root: str, size: int = params.DB_READERS):
+        self.path = path
+        self.root = root
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._readers = []
+
+    @contextmanager
+    def reader(self):
+        """a read-only IndexDb for the calling thread until the block ends, waits if size readers are in use"""
+        with self._slots:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                db = IndexDb(self.path, root=self.root, read_only=True)
+                with self._lock:
+                    self._readers.append(db)
+            try:
+                yield db
+            finally:
+                self._idle.put(db)
+
+    def close(self):
+        """close all readers, none must be in use"""
+        with self._lock:
+            for db in self._readers:
+                db.close()
+            self._readers.clear()
+        self._idle = queue.LifoQueue()
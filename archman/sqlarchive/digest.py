@@ -0,0 +1,214 @@
+import functools
+import hashlib
+import os
+import shutil
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pathlib import Path
+from typing import BinaryIO
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Tuple
+from archman import FileIntegrityError
+from archman.sqlarchive import params
+
+# supported algorithms, all of them give 32 bytes digests
+ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'blake2b': functools.partial(hashlib.blake2b, digest_size=32),
+    'blake2s': hashlib.blake2s,
+    'sha3_256': hashlib.sha3_256,
+}
+
+# digest of a whole file, digests of its chunks (None when not computed)
+# and digests of the whole file with other algorithms
+FileDigest = namedtuple('FileDigest', ['digest','chunks','extra'], defaults=[None,None])
+
+class StreamDigest(object):
+    """Digest of a stream and of its fixed size chunks, updated block by block"""
+
+    def __init__(self, engine, extra_algorithms: Iterable[str] = ()):
+        self.engine = engine
+        self.h = engine.new()
+        self.extra = {a: ALGORITHMS[a]() for a in extra_algorithms}
+        self.chunks = None
+        if engine.chunk_size is not None:
+            self.chunks = []
+            self.chunk = engine.new()
+            self.filled = 0
+
+    def update(self, block: memoryview):
+        self.h.update(block)
+        for h in self.extra.values():
+            h.update(block)
+        if self.chunks is None:
+            return
+        chunk_size = self.engine.chunk_size
+        while len(block):
+            n = min(len(block), chunk_size - self.filled)
+            self.chunk.update(block[:n])
+            self.filled += n
+            block = block[n:]
+            if self.filled == chunk_size:
+                self.chunks.append(self.chunk.digest())
+                self.chunk = self.engine.new()
+                self.filled = 0
+
+    def result(self) -> FileDigest:
+        chunks = self.chunks
+        if chunks is not None and self.filled:
+            chunks = chunks + [self.chunk.digest()]
+        extra = {a: h.digest() for (a,h) in self.extra.items()}
+        return FileDigest(self.h.digest(), chunks, extra)
+
+class DigestEngine(object):
+    """Compute digests of files without loading them in memory
+
+    Files are read in blocks of block_size bytes into a single reusable buffer,
+    so peak memory does not depend on the size of the file.
+    When chunk_size is set, files are also digested chunk by chunk to locate damages.
+    """
+
+    def __init__(self, *, algorithm: str = params.DEFAULT_ALGORITHM, block_size: int = params.BLOCK_SIZE, chunk_size: int = None):
+        if algorithm not in ALGORITHMS:
+            raise ValueError("unsupported digest algorithm '%s', expected one of %s"%(algorithm,', '.join(ALGORITHMS)))
+        if block_size <= 0:
+            raise ValueError("block_size must be positive, got %d"%block_size)
+        if chunk_size is not None and chunk_size <= 0:
+            raise ValueError("chunk_size must be positive, got %d"%chunk_size)
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+
+    def new(self):
+        return ALGORITHMS[self.algorithm]()
+
+    def digest(self, data: bytes) -> bytes:
+        h = self.new()
+        h.update(data)
+        return h.digest()
+
+    def blocks(self, f: BinaryIO) -> Iterator[memoryview]:
+        """yield the content of f block by block
+
+        The returned views share the same buffer: each one is valid only until the next iteration.
+        """
+        buf = bytearray(self.block_size)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            yield view[:n]
+
+    def digest_stream(self, f: BinaryIO) -> bytes:
+        h = self.new()
+        for block in self.blocks(f):
+            h.update(block)
+        return h.digest()
+
+    def digest_file(self, path: Path) -> bytes:
+        with open(path, 'rb', buffering=0) as f:
+            return self.digest_stream(f)
+
+    def digest_path(self, path: Path) -> bytes:
+        """digest of a file as stored in the index: symlinks are digested by their target"""
+        if os.path.islink(path):
+            target = os.readlink(path)
+            return self.digest(target.encode('utf8'))
+        return self.digest_file(path)
+
+    def merkle_root(self, chunks: List[bytes]) -> bytes:
+        """root of the binary hash tree whose leaves are the chunk digests"""
+        level = list(chunks)
+        if 0 == len(level):
+            return self.digest(b'')
+        while len(level) > 1:
+            nxt = []
+            for i in range(0,len(level)-1,2):
+                nxt.append(self.digest(b'\x01' + level[i] + level[i+1]))
+            if len(level) % 2:
+                nxt.append(level[-1])
+            level = nxt
+        return level[0]
+
+    def index_path(self, path: Path, *, extra_algorithms: Iterable[str] = ()) -> FileDigest:
+        """digest of a file with its chunk digests and its digests for extra_algorithms, reading it only once
+
+        Symlinks are digested by their target and have no chunks.
+        """
+        if os.path.islink(path):
+            data = os.readlink(path).encode('utf8')
+            extra = {a: DigestEngine(algorithm=a).digest(data) for a in extra_algorithms}
+            return FileDigest(self.digest(data), None, extra)
+        sd = StreamDigest(self, extra_algorithms)
+        with open(path, 'rb', buffering=0) as f:
+            for block in self.blocks(f):
+                sd.update(block)
+        return sd.result()
+
+    def digest_paths(self, paths: Iterable[Path], *, jobs: int = 1, processes: bool = False) -> Iterator[bytes]:
+        """digest each path, yielding the results in the order of paths
+
+        With jobs > 1 the files are hashed concurrently by a pool of workers:
+        threads by default since hashlib releases the GIL on large buffers,
+        processes when many small files would make the workers contend on the GIL.
+        At most a few files per worker are in flight so memory stays bounded.
+        """
+        return self.ordered_map(self.digest_path, ((path,) for path in paths), jobs=jobs, processes=processes)
+
+    def copy_file(self, src: Path, dst: Path, *, verify: bool = False) -> FileDigest:
+        """copy src to dst and return the digests of the data, reading src only once
+
+        When verify is set, dst is read back and its digest compared to the one of the data read from src.
+        """
+        sd = StreamDigest(self)
+        with open(src, 'rb', buffering=0) as fi:
+            with open(dst, 'wb') as fo:
+                for block in self.blocks(fi):
+                    sd.update(block)
+                    fo.write(block)
+        res = sd.result()
+        if verify:
+            written = self.digest_file(dst)
+            if written != res.digest:
+                raise FileIntegrityError("%s: copy of %s is corrupted"%(str(dst),str(src)))
+        return res
+
+    def copy_path(self, src: Path, dst: Path, *, verify: bool = False, copy_stat: bool = True) -> FileDigest:
+        """copy a file or a symlink like shutil.copy2 with follow_symlinks=False, return its digests
+
+        With copy_stat cleared, metadata are not copied, like shutil.copyfile.
+        """
+        if os.path.islink(src):
+            target = os.readlink(src)
+            os.symlink(target, dst)
+            res = FileDigest(self.digest(target.encode('utf8')))
+        else:
+            res = self.copy_file(src, dst, verify=verify)
+        if copy_stat:
+            shutil.copystat(src, dst, follow_symlinks=False)
+        return res
+
+    def copy_paths(self, pairs: Iterable[Tuple[Path,Path]], *, jobs: int = 1, processes: bool = False, verify: bool = False) -> Iterator[FileDigest]:
+        """copy each (src, dst) pair, yielding the digests in the order of pairs, see digest_paths"""
+        return self.ordered_map(functools.partial(self.copy_path, verify=verify), pairs, jobs=jobs, processes=processes)
+
+    @staticmethod
+    def ordered_map(fn, args: Iterable[tuple], *, jobs: int, processes: bool) -> Iterator:
+        """fn(*a) for each a in args, computed by a pool of jobs workers and yielded in order"""
+        if jobs <= 1:
+            for a in args:
+                yield fn(*a)
+            return
+        executor_type = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with executor_type(max_workers=jobs) as executor:
+            pending = deque()
+            for a in args:
+                pending.append(executor.submit(fn, *a))
+                if len(pending) >= 4 * jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
@@ -3,4 +3,26 @@ ROOT_DIR = '.'
 INDEX_FILE = 'db.sqlite3'
 CHECK_FILE = 'db_check.bin'
 READ_ONLY = 0o511
-READ_WRITE = 0o777
\ No newline at end of file
+READ_WRITE = 0o777
+BLOCK_SIZE = 1024 * 1024
+DEFAULT_ALGORITHM = 'sha256'
+CHUNK_SIZE = 4 * 1024 * 1024
+# verification of the index database when an archive is opened: 'full', 'sample' or 'lazy'
+DB_CHECK_ON_OPEN = 'sample'
+DB_CHECK_SAMPLES = 16
+# pages of the index database per parity page in the check file, at most one damaged page per group can be repaired
+DB_PARITY_GROUP = 16
+# number of folders whose path and UID are cached by the index database
+PATH_CACHE_SIZE = 4096
+# settings of the index database while add_dir ingests files, the previous ones are restored before the commit.
+# synchronous is left alone: sqlite cannot change it within the transaction of the ingest, and in WAL mode
+# it only matters when that transaction is committed
+BULK_PRAGMAS = {'cache_size': -64 * 1024, 'mmap_size': 256 * 1024 * 1024}
+# files buffered by the index database in bulk mode before they are written
+BULK_BATCH = 1000
+# prepared statements kept by each connection to the index database
+DB_STATEMENT_CACHE = 256
+# seconds a connection to the index database waits for a lock, or a checkpoint for readers
+DB_BUSY_TIMEOUT = 5.0
+# read-only connections to the index database used by concurrent jobs
+DB_READERS = 8
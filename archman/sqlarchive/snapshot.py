@@ -0,0 +1,205 @@
+"""Columnar in-memory copy of the tree of an index database"""
+
+from array import array
+from pathlib import Path
+from typing import Iterator
+from typing import Tuple
+from archman.sqlarchive.db import IndexDb, FileIndex, FolderIndex
+
+class TreeSnapshot(object):
+    """Folders and files of an index loaded with one scan of each table and stored column by column
+
+    Folders and files are identified by their position in the columns, the root folder is 0.
+    Both tables are read sorted by parent and name, so the sub folders and the files of a folder
+    are contiguous: children() and files() are ranges and parent() is an array lookup.
+    Names are interned in a table of distinct names and digests are packed in bytearrays,
+    an entry takes a few dozen bytes instead of a FileIndex with its row and its attribute objects.
+    The snapshot does not follow the changes made to the index after it was loaded.
+    """
+    DIGEST_SIZE = 32
+    # stands for NULL in the integer columns
+    NULL = -2**63
+
+    def __init__(self, db: IndexDb):
+        self.root = db.root
+        # distinct names, name_id columns refer to them
+        self.names = []
+        name_ids = {}
+        def name_id(name):
+            i = name_ids.get(name)
+            if i is None:
+                i = name_ids[name] = len(self.names)
+                self.names.append(name)
+            return i
+        def integer(v):
+            return TreeSnapshot.NULL if v is None else v
+
+        self.folder_uid = array('q')
+        self.folder_parent = array('q')
+        self.folder_name = array('i')
+        self.folder_mode = array('i')
+        # position of each folder, by UID
+        self._positions = {}
+        # parents are resolved once all folders are known, a folder may have a greater UID than its sub folders
+        for (uid,parent_uid,name,mode) in db.conn.execute('SELECT UID, PARENT_UID, NAME, MODE FROM folders ORDER BY PARENT_UID, NAME'):
+            self._positions[uid] = len(self.folder_uid)
+            self.folder_uid.append(uid)
+            self.folder_parent.append(integer(parent_uid))
+            self.folder_name.append(name_id(name))
+            self.folder_mode.append(mode)
+        n_folders = len(self.folder_uid)
+        self.child_first = array('i', bytes(4 * n_folders))
+        self.child_count = array('i', bytes(4 * n_folders))
+        for i in range(n_folders):
+            parent_uid = self.folder_parent[i]
+            if parent_uid == TreeSnapshot.NULL:
+                self.folder_parent[i] = -1
+                continue
+            p = self._positions[parent_uid]
+            self.folder_parent[i] = p
+            if self.child_count[p] == 0:
+                self.child_first[p] = i
+            self.child_count[p] += 1
+
+        self.file_uid = array('q')
+        self.file_parent = array('i')
+        self.file_name = array('i')
+        self.file_mode = array('i')
+        self.file_size = array('q')
+        self.file_mtime_ns = array('q')
+        self.file_ctime_ns = array('q')
+        self.file_inode = array('q')
+        self.file_algorithm = array('b')
+        self.file_chunk_size = array('q')
+        self.file_digest = bytearray()
+        self.file_merkle_root = bytearray()
+        self.algorithms = []
+        self.file_first = array('i', bytes(4 * n_folders))
+        self.file_count = array('i', bytes(4 * n_folders))
+        no_root = bytes(TreeSnapshot.DIGEST_SIZE)
+        for r in db.conn.execute('SELECT ' + IndexDb.FILE_COLUMNS + ' FROM files ORDER BY PARENT_UID, NAME'):
+            (uid,parent_uid,name,digest,mode,size,mtime_ns,ctime_ns,inode,algorithm,chunk_size,merkle_root) = r
+            if len(digest) != TreeSnapshot.DIGEST_SIZE:
+                raise ValueError("digest of file %d has %d bytes, expected %d"%(uid,len(digest),TreeSnapshot.DIGEST_SIZE))
+            p = self._positions[parent_uid]
+            if self.file_count[p] == 0:
+                self.file_first[p] = len(self.file_uid)
+            self.file_count[p] += 1
+            self.file_uid.append(uid)
+            self.file_parent.append(p)
+            self.file_name.append(name_id(name))
+            self.file_mode.append(mode)
+            self.file_size.append(integer(size))
+            self.file_mtime_ns.append(integer(mtime_ns))
+            self.file_ctime_ns.append(integer(ctime_ns))
+            self.file_inode.append(integer(inode))
+            if algorithm not in self.algorithms:
+                self.algorithms.append(algorithm)
+            self.file_algorithm.append(self.algorithms.index(algorithm))
+            self.file_chunk_size.append(integer(chunk_size))
+            self.file_digest += digest
+            self.file_merkle_root += merkle_root or no_root
+
+    def __len__(self) -> int:
+        """number of files"""
+        return len(self.file_uid)
+
+    def nbytes(self) -> int:
+        """memory taken by the columns, without the distinct names"""
+        columns = [v for v in vars(self).values() if isinstance(v, (array, bytearray))]
+        return sum(len(c) * (c.itemsize if isinstance(c, array) else 1) for c in columns)
+
+    def folder(self, uid: int) -> int:
+        """position of the folder with UID uid"""
+        return self._positions[uid]
+
+    def parent(self, i: int) -> int:
+        """position of the parent of folder i, -1 for the root"""
+        return self.folder_parent[i]
+
+    def children(self, i: int) -> range:
+        """positions of the sub folders of folder i, sorted by name"""
+        first = self.child_first[i]
+        return range(first, first + self.child_count[i])
+
+    def files(self, i: int) -> range:
+        """positions of the files of folder i, sorted by name"""
+        first = self.file_first[i]
+        return range(first, first + self.file_count[i])
+
+    def folder_name_of(self, i: int) -> str:
+        return self.names[self.folder_name[i]]
+
+    def file_name_of(self, j: int) -> str:
+        return self.names[self.file_name[j]]
+
+    def digest(self, j: int) -> bytes:
+        return bytes(self.file_digest[j * TreeSnapshot.DIGEST_SIZE:(j + 1) * TreeSnapshot.DIGEST_SIZE])
+
+    def path(self, i: int) -> Path:
+        names = []
+        while self.folder_parent[i] != -1:
+            names.append(self.folder_name_of(i))
+            i = self.folder_parent[i]
+        return self.root.joinpath(*reversed(names))
+
+    def folder_index(self, i: int) -> FolderIndex:
+        p = self.folder_parent[i]
+        return FolderIndex(parent_id=None if p == -1 else self.folder_uid[p], name=self.folder_name_of(i), mode=self.folder_mode[i])
+
+    def file_index(self, j: int) -> FileIndex:
+        def value(column):
+            v = column[j]
+            return None if v == TreeSnapshot.NULL else v
+        chunk_size = value(self.file_chunk_size)
+        merkle_root = None
+        if chunk_size is not None:
+            merkle_root = bytes(self.file_merkle_root[j * TreeSnapshot.DIGEST_SIZE:(j + 1) * TreeSnapshot.DIGEST_SIZE])
+        return FileIndex(
+            parent_id=self.folder_uid[self.file_parent[j]],
+            name=self.file_name_of(j),
+            digest=self.digest(j),
+            mode=self.file_mode[j],
+            size=value(self.file_size),
+            mtime_ns=value(self.file_mtime_ns),
+            ctime_ns=value(self.file_ctime_ns),
+            inode=value(self.file_inode),
+            algorithm=self.algorithms[self.file_algorithm[j]],
+            chunk_size=chunk_size,
+            merkle_root=merkle_root)
+
+    def walk_entries(self, parent_id: int, max_depth: int = None) -> Iterator[Tuple[int,bool,str,bool]]:
+        """same as IndexDb.walk_entries, without any query"""
+        # folders are pushed as their position, files as -1 - their position
+        def push(i, depth):
+            if max_depth is None or depth < max_depth:
+                stack.extend((-1 - j, depth + 1) for j in reversed(self.files(i)))
+                stack.extend((c, depth + 1) for c in reversed(self.children(i)))
+        stack = []
+        push(self.folder(parent_id), 0)
+        while stack:
+            (i,depth) = stack.pop()
+            if i >= 0:
+                p = self.folder_parent[i]
+                last = i + 1 == self.child_first[p] + self.child_count[p] and self.file_count[p] == 0
+                yield (depth, True, self.folder_name_of(i), last)
+                push(i, depth)
+            else:
+                j = -1 - i
+                p = self.file_parent[j]
+                yield (depth, False, self.file_name_of(j), j + 1 == self.file_first[p] + self.file_count[p])
+
+    def walk_id(self, parent_id: int) -> Iterator[Tuple[int,Path,list,list]]:
+        """same as IndexDb.walk_id, without any query
+
+        Folders come depth first with their sub folders sorted by name.
+        FileIndex and FolderIndex objects are only created for the folder being yielded.
+        """
+        stack = [(self.folder(parent_id), self.path(self.folder(parent_id)))]
+        while stack:
+            (i,path) = stack.pop()
+            files = [(self.file_uid[j], self.file_index(j)) for j in self.files(i)]
+            dirs = [(self.folder_uid[c], self.folder_index(c)) for c in self.children(i)]
+            yield (self.folder_uid[i], path, files, dirs)
+            for c in reversed(self.children(i)):
+                stack.append((c, path.joinpath(self.folder_name_of(c))))
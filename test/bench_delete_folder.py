@@ -0,0 +1,62 @@
+"""Time of IndexDb.delete_folder against the former per-folder recursion
+
+python -m test.bench_delete_folder [--depth N] [--fanout N] [--files N]
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from archman.sqlarchive.db import IndexDb, FileIndex
+
+def delete_folder_recursive(db: IndexDb, folder_uid: int):
+    """delete_folder as implemented before the set-based version"""
+    args = (folder_uid,)
+    cur = db.conn.cursor()
+    cur.execute(''' DELETE FROM chunks WHERE FILE_UID IN (SELECT UID FROM files WHERE PARENT_UID = ?) ''', args)
+    cur.execute(''' DELETE FROM files WHERE PARENT_UID = ? ''', args)
+    for uid,dir in list(db.folders(parent_id=folder_uid)):
+        delete_folder_recursive(db, uid)
+    cur.execute(''' DELETE FROM folders WHERE UID = ? ''', args)
+
+def make_tree(db: IndexDb, parent_id: int, depth: int, fanout: int, files: int) -> int:
+    cur = db.conn.cursor()
+    cur.execute(''' INSERT INTO folders(PARENT_UID,NAME,MODE) VALUES(?,?,?) ''', (parent_id, 'd', 0o755))
+    uid = cur.lastrowid
+    levels = [[uid]]
+    for level in range(depth):
+        nxt = []
+        for p in levels[-1]:
+            for i in range(fanout):
+                cur.execute(''' INSERT INTO folders(PARENT_UID,NAME,MODE) VALUES(?,?,?) ''', (p, 'd%d'%i, 0o755))
+                nxt.append(cur.lastrowid)
+        levels.append(nxt)
+    for folders in levels:
+        for p in folders:
+            for i in range(files):
+                db.add_file(FileIndex(parent_id=p, name='f%d'%i, digest=bytes(32), mode=0o644))
+    db.commit()
+    return uid
+
+def bench(depth: int, fanout: int, files: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = IndexDb(str(Path(tmp) / 'db.sqlite3'), root=tmp, create=True)
+        for (name, delete) in [('recursive', delete_folder_recursive), ('set-based', IndexDb.delete_folder)]:
+            uid = make_tree(db, 1, depth, fanout, files)
+            n_folders = db.conn.execute('SELECT COUNT(*) FROM folders').fetchone()[0] - 1
+            n_files = db.conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+            t = time.perf_counter()
+            delete(db, uid)
+            db.commit()
+            elapsed = time.perf_counter() - t
+            assert db.conn.execute('SELECT COUNT(*) FROM folders').fetchone()[0] == 1
+            assert db.conn.execute('SELECT COUNT(*) FROM files').fetchone()[0] == 0
+            print(f"{name}: {n_folders} folders, {n_files} files deleted in {elapsed:.3f} s")
+        db.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark of IndexDb.delete_folder')
+    parser.add_argument('--depth', help='Depth of the tree', type=int, default=4)
+    parser.add_argument('--fanout', help='Sub folders per folder', type=int, default=8)
+    parser.add_argument('--files', help='Files per folder', type=int, default=10)
+    args = parser.parse_args()
+    bench(args.depth, args.fanout, args.files)
@@ -0,0 +1,69 @@
+"""Throughput of the parity of the index check file
+
+python -m test.bench_parity [--size MB] [--damaged N]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+from archman.sqlarchive import params
+from archman.sqlarchive.check import RepairInfo
+
+def make_db(path: Path, size: int):
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE blobs (UID integer PRIMARY KEY, DATA blob NOT NULL)")
+    rng = random.Random(0)
+    row_size = 1000
+    for _ in range(size // row_size):
+        conn.execute("INSERT INTO blobs(DATA) VALUES(?)", (rng.randbytes(row_size),))
+    conn.commit()
+    conn.close()
+
+def bench(size: int, damaged: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = Path(tmp) / 'db.sqlite3'
+        check_file = Path(tmp) / 'db_check.bin'
+        make_db(db_file, size)
+        db_size = os.path.getsize(db_file)
+        page_size = RepairInfo.page_size_of(db_file)
+        n_pages = db_size // page_size
+
+        t = time.perf_counter()
+        repair_info = RepairInfo(str(check_file), str(db_file), create=True)
+        encode = time.perf_counter() - t
+
+        t = time.perf_counter()
+        repair_info.verify('full')
+        verify = time.perf_counter() - t
+
+        # damage one page in distinct groups
+        groups = random.Random(1).sample(range(n_pages // params.DB_PARITY_GROUP), min(damaged, n_pages // params.DB_PARITY_GROUP))
+        pages = [k * params.DB_PARITY_GROUP + 1 + random.Random(k).randrange(params.DB_PARITY_GROUP) for k in groups]
+        with open(db_file, 'r+b') as f:
+            for no in pages:
+                f.seek((no - 1) * page_size + 100)
+                b = f.read(1)
+                f.seek(-1, os.SEEK_CUR)
+                f.write(bytes([b[0] ^ 0x01]))
+
+        t = time.perf_counter()
+        repaired = repair_info.repair(pages)
+        decode = time.perf_counter() - t
+        assert repaired == sorted(pages)
+        repair_info.verify('full')
+
+        mb = db_size / (1024 * 1024)
+        print(f"database: {mb:.1f} MB, {n_pages} pages of {page_size} bytes, check file {os.path.getsize(check_file) / (1024 * 1024):.1f} MB")
+        print(f"encode (rebuild): {encode:.3f} s, {mb / encode:.1f} MB/s")
+        print(f"verify (full):    {verify:.3f} s, {mb / verify:.1f} MB/s")
+        print(f"decode (repair of {len(pages)} pages): {decode:.3f} s, {len(pages) / decode:.0f} pages/s")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark of the index parity')
+    parser.add_argument('--size', help='Size of the database in MB', type=int, default=64)
+    parser.add_argument('--damaged', help='Number of damaged pages to repair', type=int, default=100)
+    args = parser.parse_args()
+    bench(args.size * 1024 * 1024, args.damaged)
@@ -0,0 +1,91 @@
+"""Rows per second of the IndexDb point lookups and scans against the former query layer
+
+python -m test.bench_queries [--folders N] [--files N] [--lookups N]
+"""
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+from archman.sqlarchive.db import IndexDb, FileIndex, FolderIndex
+
+def _former_results(cursor):
+    while True:
+        res = cursor.fetchmany(200)
+        if not res:
+            break
+        for r in res:
+            yield r
+
+def former_file_from_uid(db: IndexDb, uid: int) -> FileIndex:
+    """file_from_uid as implemented before the fast path"""
+    cur = db.conn.cursor()
+    cur.execute('''SELECT * FROM %s WHERE UID = ?'''%'files', (uid,))
+    r = list(_former_results(cur))[0]
+    return FileIndex(parent_id=r[1], name=r[2], digest=r[3], mode=r[4], size=r[5], mtime_ns=r[6], ctime_ns=r[7], inode=r[8], algorithm=r[9], chunk_size=r[10], merkle_root=r[11])
+
+def former_folder_from_uid(db: IndexDb, uid: int) -> FolderIndex:
+    cur = db.conn.cursor()
+    cur.execute('''SELECT * FROM %s WHERE UID = ?'''%'folders', (uid,))
+    r = list(_former_results(cur))[0]
+    return FolderIndex(parent_id=r[1], name=r[2], mode=r[3])
+
+def former_files(db: IndexDb):
+    cur = db.conn.cursor()
+    cur.execute('''SELECT * FROM files''')
+    for r in _former_results(cur):
+        yield (r[0], FileIndex(parent_id=r[1], name=r[2], digest=r[3], mode=r[4], size=r[5], mtime_ns=r[6], ctime_ns=r[7], inode=r[8], algorithm=r[9], chunk_size=r[10], merkle_root=r[11]))
+
+def make_index(db: IndexDb, folders: int, files: int):
+    cur = db.conn.cursor()
+    with db.bulk_ingest():
+        for i in range(folders):
+            cur.execute(''' INSERT INTO folders(PARENT_UID,NAME,MODE) VALUES(?,?,?) ''', (1, 'd%d'%i, 0o755))
+            uid = cur.lastrowid
+            for j in range(files):
+                db.add_file(FileIndex(parent_id=uid, name='f%d'%j, digest=bytes(32), mode=0o644, size=j, mtime_ns=0, ctime_ns=0, inode=j))
+    db.commit()
+
+def rate(n: int, f) -> float:
+    t = time.perf_counter()
+    f()
+    return n / (time.perf_counter() - t)
+
+def bench(folders: int, files: int, lookups: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = IndexDb(str(Path(tmp) / 'db.sqlite3'), root=tmp, create=True)
+        make_index(db, folders, files)
+        n_files = folders * files
+        rng = random.Random(0)
+        file_uids = [rng.randrange(1, n_files + 1) for _ in range(lookups)]
+        folder_uids = [rng.randrange(1, folders + 2) for _ in range(lookups)]
+        paths = [Path(tmp) / ('d%d'%(uid - 2)) for uid in folder_uids if uid > 1]
+
+        def lookups_of(f, uids):
+            return lambda: [f(uid) for uid in uids]
+        def paths_uncached():
+            for p in paths:
+                db._clear_path_caches()
+                db.folder_from_path(p)
+        def walk():
+            for (_, _, fs, _) in db.walk_id(1):
+                pass
+
+        print(f"index: {folders} folders, {n_files} files")
+        for (name, former, current) in [
+                ('file_from_uid', lookups_of(lambda uid: former_file_from_uid(db, uid), file_uids), lookups_of(db.file_from_uid, file_uids)),
+                ('folder_from_uid', lookups_of(lambda uid: former_folder_from_uid(db, uid), folder_uids), lookups_of(db.folder_from_uid, folder_uids)),
+                ]:
+            print(f"{name}: former {rate(lookups, former):.0f} rows/s, current {rate(lookups, current):.0f} rows/s")
+        print(f"folder_from_path (uncached): {rate(len(paths), paths_uncached):.0f} paths/s")
+        print(f"files scan: former {rate(n_files, lambda: list(former_files(db))):.0f} rows/s, current {rate(n_files, lambda: list(db.files())):.0f} rows/s")
+        print(f"walk_id: {rate(n_files, walk):.0f} files/s")
+        db.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark of the IndexDb queries')
+    parser.add_argument('--folders', help='Number of folders', type=int, default=100)
+    parser.add_argument('--files', help='Files per folder', type=int, default=1000)
+    parser.add_argument('--lookups', help='Number of point lookups', type=int, default=100000)
+    args = parser.parse_args()
+    bench(args.folders, args.files, args.lookups)
@@ -0,0 +1,50 @@
+"""Memory and walk time of TreeSnapshot against FileIndex objects and IndexDb.walk_id
+
+python -m test.bench_snapshot [--folders N] [--files N]
+"""
+import argparse
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from archman.sqlarchive.db import IndexDb
+from archman.sqlarchive.snapshot import TreeSnapshot
+from test.bench_queries import make_index
+
+def allocated(f):
+    """memory allocated by f and kept by its result, and the time f takes without tracing"""
+    tracemalloc.start()
+    res = f()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del res
+    t = time.perf_counter()
+    res = f()
+    return (res, size, time.perf_counter() - t)
+
+def walk_time(walk) -> float:
+    t = time.perf_counter()
+    for (uid, path, files, dirs) in walk:
+        pass
+    return time.perf_counter() - t
+
+def bench(folders: int, files: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = IndexDb(str(Path(tmp) / 'db.sqlite3'), root=tmp, create=True)
+        make_index(db, folders, files)
+        n_files = folders * files
+        (rows, rows_size, rows_time) = allocated(lambda: list(db.files()))
+        del rows
+        (tree, tree_size, tree_time) = allocated(lambda: TreeSnapshot(db))
+        print(f"index: {folders} folders, {n_files} files")
+        print(f"FileIndex objects: {rows_size / n_files:.0f} bytes per file, loaded in {rows_time:.3f} s")
+        print(f"snapshot: {tree_size / n_files:.0f} bytes per file, loaded in {tree_time:.3f} s")
+        print(f"walk: IndexDb {walk_time(db.walk_id(1)):.3f} s, snapshot {walk_time(tree.walk_id(1)):.3f} s")
+        db.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark of the tree snapshot')
+    parser.add_argument('--folders', help='Number of folders', type=int, default=100)
+    parser.add_argument('--files', help='Files per folder', type=int, default=1000)
+    args = parser.parse_args()
+    bench(args.folders, args.files)
@@ -12,6 +12,15 @@ import difflib
 from filecmp import dircmp
 import filecmp
 import tempfile
+import hashlib
+import json
+import sqlite3
+import threading
+from archman.sqlarchive.digest import DigestEngine
+from archman.sqlarchive.check import RepairInfo
+from archman.sqlarchive import SqlArchive
+from archman.duplicates import DuplicateFinder
+from archman.server import ArchiveClient, ServerError
 
 test_root = Path('playground')
 test_root.mkdir(exist_ok=True)
@@ -179,6 +188,7 @@ def gen_list_expected_output(path:Path, recursive = False, max_depth=None):
             sort=True,
             exclude_folders=cli.get_archive_impl_dirs(),
             exclude_files=cli.get_archive_impl_files(), 
+            depthlimit=max_depth if recursive else 1,
             printout=False),
         file=expected)
     return expected.getvalue()
@@ -215,6 +225,42 @@ def check_list_generic():
     out = cli.cmd_list(src=dst,recursive=True)
     check_str_equal(out,expected)
 
+def check_list_max_depth():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    dst = archive_root / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=dst, recursive=True)
+    for max_depth in [1,2]:
+        expected = gen_list_expected_output(random_tree_root,recursive=True,max_depth=max_depth)
+        check_str_equal(cli.cmd_list(src=dst,recursive=True,max_depth=max_depth),expected)
+        check_str_equal(cli.cmd_list(src=dst,recursive=True,max_depth=max_depth,snapshot=True),expected)
+    expected = gen_list_expected_output(random_tree_root)
+    check_str_equal(cli.cmd_list(src=dst),expected)
+
+def check_list_formats():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    dst = archive_root / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=dst, recursive=True)
+    records = [json.loads(line) for line in cli.cmd_list(src=dst,recursive=True,fmt='jsonl').splitlines()]
+    expected = set()
+    for root,dirs,files in os.walk(random_tree_root):
+        expected.update(Path(root, f).relative_to(random_tree_root).as_posix() for f in dirs + files)
+    assert set(r['path'] for r in records) == expected
+    for r in records:
+        if r['type'] == 'file' and not (random_tree_root / r['path']).is_symlink():
+            with open(random_tree_root / r['path'], 'rb') as f:
+                assert r['digest'] == 'sha256:' + hashlib.sha256(f.read()).hexdigest()
+            assert r['size'] == os.path.getsize(random_tree_root / r['path'])
+        if r['type'] == 'dir':
+            assert r['digest'] is None
+    tsv = [line.split('\t') for line in cli.cmd_list(src=dst,recursive=True,fmt='tsv').splitlines()]
+    nul = [line.split('\t') for line in cli.cmd_list(src=dst,recursive=True,fmt='nul').split('\0')[:-1]]
+    assert tsv == nul
+    assert [(r['type'],r['mode'],str(r['size']),r['digest'] or '',r['path']) for r in records] == [tuple(f) for f in tsv]
+    top = cli.cmd_list(src=dst,fmt='jsonl').splitlines()
+    assert len(top) == len(os.listdir(random_tree_root))
+
 def check_dirs_equal(a,b):
     cmp = dircmp(a,b)
     assert 0 == len(cmp.left_only)
@@ -254,6 +300,59 @@ def check_dedup_remove():
     cli.cmd_export(src=arch, dst=out, recursive=True)
     check_randomdir(root=out_path,name=random_tree_name,n_duplicated_files=0,n_soft_links=4)
 
+def check_dedup_confirm():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    out = out_path / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=arch, recursive=True)
+    cli.cmd_dedup(src=arch,hardlink=False,confirm=True)
+    cli.cmd_check(src=str(archive_root))
+    cli.cmd_export(src=arch, dst=out, recursive=True)
+    check_randomdir(root=out_path,name=random_tree_name,n_duplicated_files=0,n_soft_links=4)
+
+def check_duplicate_finder():
+    root = test_root / 'duplicates'
+    if root.exists():
+        shutil.rmtree(root)
+    root.mkdir(parents=True)
+    edge = 1024
+    big = bytes(range(256)) * 16
+    middle = bytearray(big)
+    middle[len(big) // 2] ^= 0x01
+    head = bytearray(big)
+    head[0] ^= 0x01
+    contents = {'a': big, 'b': big, 'c': bytes(middle), 'd': bytes(head), 'e': big + b'x', 'f': b'small', 'g': b'small', 'h': b'smalL'}
+    paths = []
+    for (name,data) in contents.items():
+        with open(root / name,'wb') as f:
+            f.write(data)
+        paths.append(root / name)
+    finder = DuplicateFinder(edge_size=edge)
+    groups = sorted([sorted(p.name for p in g) for g in finder.groups(paths)])
+    assert groups == [['a','b'],['f','g']]
+    stats = finder.stats
+    assert stats['files'] == len(contents)
+    assert stats['size_avoided'] == len(big) + 1
+    # 'd' is told apart by its head
+    assert stats['partial_avoided'] == len(big) - 2 * edge
+    # 'a', 'b' and 'c' share their head and tail
+    assert stats['full_read'] == 3 * len(big)
+    # the digests follow the engine, the files of a stage are read by several workers
+    finder = DuplicateFinder(edge_size=edge, engine=DigestEngine(algorithm='blake2b', block_size=1000), jobs=2)
+    assert sorted([sorted(p.name for p in g) for g in finder.groups(paths)]) == groups
+    assert finder.stats == stats
+
+def check_add_dir_jobs():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    out = out_path / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=arch, recursive=True, jobs=4, verify=True)
+    cli.cmd_check(src=str(archive_root))
+    cli.cmd_export(src=arch, dst=out, recursive=True)
+    check_dirs_equal(random_tree_root,out)
+
 def check_export_file():
     clean()
     cli.cmd_new(dst=str(archive_root))
@@ -464,18 +563,528 @@ def check_check():
     cli.cmd_check(src=arch)
     
 
+def check_digest_engine():
+    data = PrngSha256().randbytes(10000)
+    path = out_path / 'digest_engine.bin'
+    with open(path,'wb') as f:
+        f.write(data)
+    expected = hashlib.sha256(data).digest()
+    for block_size in [1,7,4096,10000,1<<20]:
+        assert expected == DigestEngine(block_size=block_size).digest_file(path)
+    
+
+def check_check_quick():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=arch, recursive=True)
+    cli.cmd_check(src=arch, quick=True)
+    target_file = arch / 'Arlen.txt'
+    with open(target_file,"rb") as f:
+        b = bytearray(f.read())
+    b[0] = b[0] ^ 0x01
+    with open(target_file,"wb") as f:
+        f.write(b)
+    try:
+        cli.cmd_check(src=arch, quick=True)
+        raise RuntimeError("Data corruption in data file NOT detected by quick check!")
+    except FileIntegrityError:
+        pass
+
+def check_db_check_file():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=arch, recursive=True)
+    idx = archive_root / params.INDEX_DIR
+    db_file = idx / params.INDEX_FILE
+    check_file = idx / params.CHECK_FILE
+    # the check file is updated incrementally, it must match a check file written from scratch
+    with open(check_file,"rb") as f:
+        incremental = f.read()
+    os.remove(check_file)
+    RepairInfo(str(check_file),str(db_file),create=True)
+    with open(check_file,"rb") as f:
+        assert f.read() == incremental
+    # a damaged page in the middle of the index is detected by a full verification
+    page_size = RepairInfo.page_size_of(db_file)
+    with open(db_file,"rb") as f:
+        b = bytearray(f.read())
+    b[len(b) - page_size // 2] ^= 0x01
+    with open(db_file,"wb") as f:
+        f.write(b)
+    try:
+        RepairInfo(str(check_file),str(db_file),verify='full')
+        raise RuntimeError("Data corruption in index database NOT detected!")
+    except FileIntegrityError:
+        pass
+    # the damaged page is rebuilt from the parity
+    assert cli.cmd_repair_index(src=arch) == [len(b) // page_size]
+    cli.cmd_check(src=arch)
+    # two damaged pages in the same group cannot be rebuilt
+    with open(db_file,"rb") as f:
+        b = bytearray(f.read())
+    b[page_size + 10] ^= 0x01
+    b[2 * page_size + 10] ^= 0x01
+    with open(db_file,"wb") as f:
+        f.write(b)
+    try:
+        cli.cmd_repair_index(src=arch)
+        raise RuntimeError("Repair of 2 pages of the same group NOT refused!")
+    except FileIntegrityError:
+        pass
+
+def check_path_cache():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=arch, recursive=True)
+    archive = SqlArchive(str(archive_root))
+    archive.check()
+    stats = archive.db.cache_stats()
+    assert stats['folder_uid']['hits'] > 0
+    # check walks the index with the paths of its folders, redigest looks up the path of each file
+    archive.redigest('blake2b')
+    stats = archive.db.cache_stats()
+    assert stats['folder_path']['hits'] > 0
+    # moving a directory invalidates the cached paths of its descendants
+    (uid,_) = archive.db.folder_from_path(arch / 'nil')
+    archive.move_dir(src=arch / 'nil', dst=arch / 'nil.moved')
+    assert archive.db.path_from_folder_uid(uid) == (arch / 'nil.moved').resolve()
+    archive.commit()
+    archive.close()
+    cli.cmd_check(src=arch)
+
+def check_concurrent_readers():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    out = out_path / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=arch, recursive=True)
+    cli.cmd_check(src=str(archive_root), jobs=4)
+    cli.cmd_export(src=arch, dst=out, recursive=True, jobs=4)
+    check_dirs_equal(random_tree_root,out)
+    # the last reader removes the WAL files, the check covers every file of the index folder
+    assert sorted(os.listdir(archive_root / params.INDEX_DIR)) == sorted([params.INDEX_FILE, params.CHECK_FILE])
+    # a read-only archive sees the changes of the writer once they are committed
+    writer = SqlArchive(str(archive_root))
+    reader = SqlArchive(str(archive_root), read_only=True)
+    (uid,_) = reader.db.folder_from_path(arch / 'nil')
+    writer.move_dir(src=arch / 'nil', dst=arch / 'nil.moved')
+    assert reader.db.path_from_folder_uid(uid) == (arch / 'nil').resolve()
+    try:
+        writer.check(jobs=2)
+        raise AssertionError("jobs read uncommitted changes")
+    except RuntimeError:
+        pass
+    writer.commit()
+    assert reader.db.path_from_folder_uid(uid) == (arch / 'nil.moved').resolve()
+    reader.check(jobs=4)
+    reader.close()
+    writer.close()
+
+def check_commit_with_readers():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    busy_timeout = params.DB_BUSY_TIMEOUT
+    params.DB_BUSY_TIMEOUT = 0.1
+    try:
+        writer = SqlArchive(str(archive_root))
+        reader = SqlArchive(str(archive_root), read_only=True)
+        # a reader on an older snapshot keeps the commit from checkpointing the WAL
+        reader.db.conn.execute('BEGIN')
+        reader.db.conn.execute('SELECT COUNT(*) FROM folders').fetchall()
+        writer.add_file(src=files_path / 'f0000', dst=archive_root / 'f0000')
+        writer.commit()
+        assert writer.db.wal_pages()
+        reader.db.conn.rollback()
+        reader.close()
+        # the last connection writes the rest of the WAL to the database file
+        writer.close()
+    finally:
+        params.DB_BUSY_TIMEOUT = busy_timeout
+    archive = SqlArchive(str(archive_root), db_check='lazy')
+    assert archive.repair_info.damaged_pages('full') == []
+    archive.close()
+    cli.cmd_check(src=str(archive_root))
+
+def check_bulk_ingest_failure():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    cli.cmd_add(src=files_path / 'f0000', dst=archive_root / 'f0000')
+    arch = archive_root / random_tree_name
+    archive = SqlArchive(str(archive_root))
+    def pragmas():
+        return {name: archive.db.conn.execute("PRAGMA %s"%name).fetchone()[0] for name in ['synchronous'] + list(params.BULK_PRAGMAS)}
+    before = pragmas()
+    # the copy fails after a few batches of files are written to the index
+    copy_paths = archive.digest_engine.copy_paths
+    def failing_copy_paths(pairs, **kwargs):
+        for (n,digest) in enumerate(copy_paths(pairs, **kwargs)):
+            if n == 5:
+                raise OSError("copy failed")
+            yield digest
+    archive.digest_engine.copy_paths = failing_copy_paths
+    bulk_batch = params.BULK_BATCH
+    params.BULK_BATCH = 2
+    try:
+        archive.add_dir(src=random_tree_root, dst=arch)
+        assert False
+    except OSError as e:
+        assert str(e) == "copy failed"
+    finally:
+        params.BULK_BATCH = bulk_batch
+        archive.digest_engine.copy_paths = copy_paths
+    # the settings are restored before anything is committed or rolled back
+    assert pragmas() == before
+    archive.rollback()
+    # the files copied before the failure are not indexed
+    FsUtils.rmtree(str(arch))
+    archive.add_dir(src=random_tree_root / 'pan', dst=archive_root / 'pan')
+    assert pragmas() == before
+    archive.commit()
+    archive.close()
+    archive = SqlArchive(str(archive_root), db_check='lazy')
+    assert archive.repair_info.damaged_pages('full') == []
+    archive.close()
+    assert [json.loads(line)['path'] for line in cli.cmd_list(src=str(archive_root), fmt='jsonl').splitlines()] == ['pan', 'f0000']
+    cli.cmd_check(src=str(archive_root))
+
+def check_tree_snapshot():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    out = out_path / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=arch, recursive=True)
+    # a folder below one created after it
+    cli.cmd_move(src=arch / 'nil', dst=arch / 'pan' / 'nil', recursive=True)
+    assert cli.cmd_list(src=arch,recursive=True,snapshot=True) == cli.cmd_list(src=arch,recursive=True)
+    archive = SqlArchive(str(archive_root))
+    tree = archive.load_snapshot()
+    def values(o):
+        return tuple(getattr(o,a) for a in o.__slots__)
+    def entries(walk):
+        out = {}
+        for (uid,path,files,dirs) in walk:
+            out[uid] = (path, [(id,values(f)) for (id,f) in files], [(id,values(d)) for (id,d) in dirs])
+        return out
+    assert entries(tree.walk_id(1)) == entries(archive.db.walk_id(1))
+    archive.close()
+    cli.cmd_check(src=str(archive_root), quick=True, snapshot=True)
+    cli.cmd_export(src=arch, dst=out, recursive=True, jobs=2, snapshot=True)
+    check_dirs_equal(arch,out)
+
+def check_hardlinks():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    src = out_path / 'linked'
+    (src / 'sub').mkdir(parents=True)
+    shutil.copyfile(files_path / 'f0000', src / 'a')
+    os.link(src / 'a', src / 'b')
+    os.link(src / 'a', src / 'sub' / 'c')
+    shutil.copyfile(files_path / 'f0001', src / 'd')
+    arch = archive_root / 'linked'
+    cli.cmd_add(src=src, dst=arch, recursive=True)
+    # hardlinks are preserved within the archive
+    assert os.lstat(arch / 'a').st_ino == os.lstat(arch / 'sub' / 'c').st_ino
+    out = cli.cmd_list(src=arch / 'b', hardlinks=True)
+    assert out.splitlines()[1:] == ['archive_root/linked/a', 'archive_root/linked/b', 'archive_root/linked/sub/c']
+    cli.cmd_check(src=str(archive_root))
+    # updating a link replaces it, the other links keep their content
+    cli.cmd_update(src=files_path / 'f0001', dst=arch / 'b')
+    cli.cmd_check(src=str(archive_root), jobs=2)
+    archive = SqlArchive(str(archive_root))
+    assert archive.hardlinks(arch / 'b') == [(arch / 'b').resolve()]
+    assert archive.hardlinks(arch / 'a') == [(arch / 'a').resolve(), (arch / 'sub' / 'c').resolve()]
+    archive.close()
+    cli.cmd_delete(dst=arch / 'sub' / 'c')
+    archive = SqlArchive(str(archive_root))
+    assert archive.db.shared_inodes() == {}
+    archive.close()
+    # deleting a folder unshares the inodes of its files
+    src2 = out_path / 'linked2'
+    (src2 / 'sub').mkdir(parents=True)
+    shutil.copyfile(files_path / 'f0002', src2 / 'e')
+    os.link(src2 / 'e', src2 / 'sub' / 'e')
+    arch2 = archive_root / 'linked2'
+    cli.cmd_add(src=src2, dst=arch2, recursive=True)
+    archive = SqlArchive(str(archive_root))
+    assert archive.hardlinks(arch2 / 'e') == [(arch2 / 'e').resolve(), (arch2 / 'sub' / 'e').resolve()]
+    archive.close()
+    cli.cmd_delete(dst=arch2 / 'sub', recursive=True)
+    archive = SqlArchive(str(archive_root))
+    assert archive.db.shared_inodes() == {}
+    archive.close()
+    cli.cmd_check(src=str(archive_root))
+
+def check_add_dedup():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    again = archive_root / 'again'
+    cli.cmd_add(src=random_tree_root,dst=arch, recursive=True)
+    cli.cmd_add(src=random_tree_root,dst=again, recursive=True, jobs=2, dedup=True)
+    cli.cmd_add(src=files_path / 'f0000',dst=archive_root / 'f0000', dedup=True)
+    # the content already archived is hardlinked instead of copied
+    inodes = set()
+    for root,dirs,files in os.walk(arch):
+        inodes.update(os.lstat(Path(root) / f).st_ino for f in files)
+    for root,dirs,files in os.walk(again):
+        for f in files:
+            b = Path(root) / f
+            if not b.is_symlink():
+                assert os.lstat(b).st_ino in inodes
+    check_dirs_equal(random_tree_root,again)
+    cli.cmd_check(src=str(archive_root))
+    cli.cmd_check(src=str(archive_root), quick=True)
+
+def check_apply():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    manifest = out_path / 'manifest.jsonl'
+    operations = [
+        {'op': 'add', 'src': str(random_tree_root), 'dst': str(arch), 'recursive': True},
+        {'op': 'add', 'src': str(files_path / 'f0000'), 'dst': str(archive_root / 'f0000')},
+        {'op': 'move', 'src': str(archive_root / 'f0000'), 'dst': str(arch / 'f0000')},
+        {'op': 'update', 'src': str(files_path / 'f0001'), 'dst': str(arch / 'f0000'), 'verify': True},
+        {'op': 'delete', 'dst': str(arch / 'pan'), 'recursive': True},
+        ]
+    with open(manifest, 'w') as f:
+        f.write('\n'.join(json.dumps(op) for op in operations) + '\n')
+    assert cli.cmd_apply(src=str(archive_root), manifest=str(manifest)) == len(operations)
+    assert filecmp.cmp(files_path / 'f0001', arch / 'f0000', shallow=False)
+    assert not (arch / 'pan').exists()
+    cli.cmd_check(src=str(archive_root))
+    # a wrong line rejects the whole manifest before anything is applied
+    with open(manifest, 'w') as f:
+        f.write(json.dumps({'op': 'delete', 'dst': str(arch / 'f0000')}) + '\n' + json.dumps({'op': 'copy'}) + '\n')
+    try:
+        cli.cmd_apply(src=str(archive_root), manifest=str(manifest))
+        assert False
+    except ValueError:
+        pass
+    assert (arch / 'f0000').exists()
+    cli.cmd_check(src=str(archive_root))
+    # a missing source rejects the whole manifest before anything is applied
+    with open(manifest, 'w') as f:
+        f.write(json.dumps({'op': 'delete', 'dst': str(arch / 'f0000')}) + '\n' + json.dumps({'op': 'add', 'src': str(files_path / 'missing'), 'dst': str(archive_root / 'missing')}) + '\n')
+    try:
+        cli.cmd_apply(src=str(archive_root), manifest=str(manifest))
+        assert False
+    except FileNotFoundError:
+        pass
+    assert (arch / 'f0000').exists()
+    # an operation failing keeps the operations before it, the index matches the archive
+    operations = [
+        {'op': 'add', 'src': str(files_path / 'f0002'), 'dst': str(archive_root / 'f0002')},
+        {'op': 'delete', 'dst': str(arch / 'f0000')},
+        {'op': 'delete', 'dst': str(arch / 'missing')},
+        ]
+    with open(manifest, 'w') as f:
+        f.write('\n'.join(json.dumps(op) for op in operations) + '\n')
+    try:
+        cli.cmd_apply(src=str(archive_root), manifest=str(manifest))
+        assert False
+    except FileNotFoundError:
+        pass
+    paths = [json.loads(line)['path'] for line in cli.cmd_list(src=str(archive_root), fmt='jsonl', recursive=True).splitlines()]
+    assert 'f0002' in paths
+    assert random_tree_name + '/f0000' not in paths
+    cli.cmd_check(src=str(archive_root))
+
+def check_serve():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    out = out_path / random_tree_name
+    socket_path = str(out_path / 'archman.sock')
+    server = cli.archive_server(src=str(archive_root), socket_path=socket_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+        client = ArchiveClient(socket_path)
+        client.call('add', src=str(random_tree_root), dst=str(arch), recursive=True)
+        listing = io.StringIO()
+        client.call('list', out=listing.write, src=str(arch), recursive=True)
+        check_str_equal(listing.getvalue(), gen_list_expected_output(random_tree_root,recursive=True))
+        client.call('export', src=str(arch), dst=str(out), recursive=True)
+        check_dirs_equal(random_tree_root,out)
+        # an error is sent back and the connection stays usable
+        try:
+            client.call('list', out=listing.write, src=str(out_path))
+            assert False
+        except ServerError as e:
+            assert e.type == 'NotWithinArchiveError'
+        client.call('check', src=str(archive_root), quick=True)
+        client.close()
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+    assert not os.path.exists(socket_path)
+    cli.cmd_check(src=str(archive_root))
+
+def fs_du(path):
+    size = 0
+    count = 0
+    for root,dirs,files in os.walk(path):
+        for f in files:
+            size += os.lstat(os.path.join(root,f)).st_size
+            count += 1
+    return (size,count)
+
+def check_du():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=arch, recursive=True)
+    assert cli.cmd_du(src=arch) == fs_du(arch)
+    assert cli.cmd_du(src=arch / 'nil') == fs_du(arch / 'nil')
+    cli.cmd_move(src=arch / 'nil', dst=arch / 'pan' / 'nil', recursive=True)
+    cli.cmd_delete(dst=arch / 'Arlen.txt')
+    cli.cmd_delete(dst=arch / 'lakh', recursive=True)
+    assert cli.cmd_du(src=arch / 'pan') == fs_du(arch / 'pan')
+    assert cli.cmd_du(src=archive_root) == fs_du(arch)
+    # the totals maintained incrementally match totals computed from scratch
+    archive = SqlArchive(str(archive_root))
+    totals = list(archive.db.conn.execute('SELECT UID, TOTAL_SIZE, TOTAL_FILES FROM folders ORDER BY UID'))
+    archive.db.compute_totals()
+    assert totals == list(archive.db.conn.execute('SELECT UID, TOTAL_SIZE, TOTAL_FILES FROM folders ORDER BY UID'))
+    archive.close()
+
+def downgrade_index(root, duplicates=False):
+    """replace the index of the archive at root by one with the schema and check file of the first version
+
+    With duplicates, a file is indexed twice under the same name.
+    """
+    index_dir = root / params.INDEX_DIR
+    db_file = index_dir / params.INDEX_FILE
+    conn = sqlite3.connect(str(db_file))
+    folders = conn.execute('SELECT UID, PARENT_UID, NAME, MODE FROM folders').fetchall()
+    files = conn.execute('SELECT UID, PARENT_UID, NAME, DIGEST, MODE FROM files').fetchall()
+    conn.close()
+    for f in index_dir.iterdir():
+        f.unlink()
+    conn = sqlite3.connect(str(db_file))
+    conn.execute(""" CREATE TABLE folders (UID integer PRIMARY KEY, PARENT_UID integer, NAME text NOT NULL, MODE integer NOT NULL,
+                    FOREIGN KEY (PARENT_UID) REFERENCES folders (UID) ON DELETE RESTRICT) """)
+    conn.execute(""" CREATE TABLE files (UID integer PRIMARY KEY, PARENT_UID integer, NAME text NOT NULL, DIGEST blob NOT NULL, MODE integer NOT NULL,
+                    FOREIGN KEY (PARENT_UID) REFERENCES folders (UID) ON DELETE RESTRICT) """)
+    conn.executemany('INSERT INTO folders VALUES(?,?,?,?)', folders)
+    conn.executemany('INSERT INTO files VALUES(?,?,?,?,?)', files)
+    if duplicates:
+        conn.execute('INSERT INTO files(PARENT_UID,NAME,DIGEST,MODE) SELECT PARENT_UID, NAME, DIGEST, MODE FROM files LIMIT 1')
+    conn.commit()
+    conn.close()
+    with open(db_file,'rb') as f:
+        digest = hashlib.sha256(f.read()).digest()
+    with open(index_dir / params.CHECK_FILE,'wb') as f:
+        f.write(digest)
+
+def check_upgrade():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=arch, recursive=True)
+    downgrade_index(archive_root)
+    # sizes are read from the archive for the files indexed without them
+    assert cli.cmd_du(src=arch) == fs_du(arch)
+    assert cli.cmd_du(src=arch / 'nil') == fs_du(arch / 'nil')
+    check_str_equal(cli.cmd_list(src=arch,recursive=True),gen_list_expected_output(random_tree_root,recursive=True))
+    cli.cmd_check(src=str(archive_root))
+
+def check_upgrade_unique_names():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=arch, recursive=True)
+    downgrade_index(archive_root)
+    archive = SqlArchive(str(archive_root))
+    indexes = [r[0] for r in archive.db.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+    assert 'folders_parent_name' in indexes and 'files_parent_name' in indexes
+    assert archive.db.conn.execute('PRAGMA user_version').fetchone()[0] == archive.db.SCHEMA_VERSION
+    archive.close()
+    # names indexed twice in a folder are reported instead of upgrading
+    downgrade_index(archive_root, duplicates=True)
+    try:
+        SqlArchive(str(archive_root))
+        assert False
+    except RuntimeError as e:
+        assert 'several files named' in str(e)
+    conn = sqlite3.connect(str(archive_root / params.INDEX_DIR / params.INDEX_FILE))
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 0
+    conn.close()
+
+def check_redigest():
+    clean()
+    cli.cmd_new(dst=str(archive_root), algorithm='blake2b')
+    arch = archive_root / random_tree_name
+    out = out_path / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=arch, recursive=True)
+    cli.cmd_check(src=arch)
+    cli.cmd_redigest(src=arch, algorithm='sha256', jobs=2)
+    cli.cmd_check(src=arch)
+    cli.cmd_export(src=arch, dst=out, recursive=True)
+    check_dirs_equal(random_tree_root,out)
+
+def check_repair():
+    clean()
+    cli.cmd_new(dst=str(archive_root))
+    arch = archive_root / random_tree_name
+    cli.cmd_add(src=random_tree_root,dst=arch, recursive=True)
+    copy_root = out_path / 'copy'
+    shutil.copytree(archive_root,copy_root,symlinks=True)
+    target_file = arch / 'Arlen.txt'
+    with open(target_file,"rb") as f:
+        b = bytearray(f.read())
+    b[-1] = b[-1] ^ 0x01
+    with open(target_file,"wb") as f:
+        f.write(b)
+    try:
+        cli.cmd_check(src=arch)
+        raise RuntimeError("Data corruption in data file NOT detected!")
+    except FileIntegrityError as e:
+        assert 'damaged byte ranges: [0,' in str(e)
+    cli.cmd_repair(dst=arch, sources=[copy_root], recursive=True)
+    cli.cmd_check(src=arch)
+    assert filecmp.cmp(random_tree_root / 'Arlen.txt',target_file,shallow=False)
+
 def test_it():
     check_list_empty()
     check_list_generic()
+    check_list_max_depth()
+    check_list_formats()
     check_export_file()
     check_export_dir()
+    check_add_dir_jobs()
     check_dedup_hardlink()
     check_dedup_remove()
+    check_dedup_confirm()
+    check_duplicate_finder()
     check_pure_move()
     check_move()
     check_delete()
     check_update()
     check_check()
+    check_check_quick()
+    check_db_check_file()
+    check_path_cache()
+    check_concurrent_readers()
+    check_commit_with_readers()
+    check_bulk_ingest_failure()
+    check_tree_snapshot()
+    check_hardlinks()
+    check_add_dedup()
+    check_apply()
+    check_serve()
+    check_du()
+    check_upgrade()
+    check_upgrade_unique_names()
+    check_redigest()
+    check_repair()
+    check_digest_engine()
 
 
 if __name__ == '__main__':